@@ -0,0 +1,174 @@
+import importlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+from app.core.metrics import CACHE_LOOKUPS
+
+
+class PrincipalCache(ABC):
+    """
+    Maps username -> last_password_change (as a timestamp) so access tokens can be
+    checked without reading the users table. Entries expire after a short TTL, and
+    are invalidated explicitly whenever a user's tokens are revoked. Async, since
+    every authenticated request checks it on the event loop.
+
+    On a miss, read generation() before the users table and pass it to set(). If
+    the user was invalidated in between, set() drops the now stale timestamp
+    """
+
+    @abstractmethod
+    async def get(self, username: str) -> Optional[float]:
+        """The cached timestamp, or None on a miss"""
+
+    @abstractmethod
+    async def generation(self, username: str) -> int:
+        """A token that changes whenever username is invalidated"""
+
+    @abstractmethod
+    async def set(self, username: str, last_password_change: float, generation: int) -> None:
+        """Cache the timestamp, unless username was invalidated since generation() returned `generation`"""
+
+    @abstractmethod
+    async def invalidate(self, username: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        """Release any connections, on shutdown"""
+
+
+class InMemoryPrincipalCache(PrincipalCache):
+    """
+    Per-process LRU with a TTL. Invalidation only reaches the worker that handled
+    the change, so other workers may accept revoked tokens for up to ttl_seconds.
+    Use a shared backend when running several workers
+    """
+
+    def __init__(self, ttl_seconds: float, maxsize: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        # One counter for all users, and the value it had at each user's last invalidation.
+        # Past maxsize the oldest are forgotten, and any set() older than those is refused
+        self._generation = 0
+        self._invalidated: OrderedDict[str, int] = OrderedDict()
+        self._forgotten_generation = 0
+        # Sync routes run in the threadpool
+        self._lock = threading.Lock()
+
+    # Everything is in memory, so these never actually wait
+
+    async def get(self, username: str) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] <= time.monotonic():
+                CACHE_LOOKUPS.inc(cache="principal", result="miss")
+                return None
+            CACHE_LOOKUPS.inc(cache="principal", result="hit")
+            self._entries.move_to_end(username)
+            return entry[0]
+
+    async def generation(self, username: str) -> int:
+        with self._lock:
+            return self._generation
+
+    async def set(self, username: str, last_password_change: float, generation: int) -> None:
+        with self._lock:
+            if generation < self._forgotten_generation or self._invalidated.get(username, 0) > generation:
+                return
+            self._entries[username] = (last_password_change, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    async def invalidate(self, username: str) -> None:
+        with self._lock:
+            self._entries.pop(username, None)
+            self._generation += 1
+            self._invalidated[username] = self._generation
+            self._invalidated.move_to_end(username)
+            while len(self._invalidated) > self.maxsize:
+                _, forgotten = self._invalidated.popitem(last=False)
+                self._forgotten_generation = max(self._forgotten_generation, forgotten)
+
+
+# Set the entry only if the user's generation is still the one read before the database
+_SET_IF_GENERATION = """
+if tonumber(redis.call('GET', KEYS[2]) or '0') == tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[3])
+end
+"""
+
+
+class RedisPrincipalCache(PrincipalCache):
+    """
+    Shared between workers, so a revocation is seen by all of them immediately.
+    Each user's generation is a counter under generation_prefix, kept for a day
+    after their last invalidation
+    """
+
+    generation_ttl_seconds = 24 * 3600
+
+    def __init__(
+            self,
+            ttl_seconds: float,
+            url: str,
+            prefix: str = "principal:",
+            generation_prefix: str = "principal-generation:"
+    ):
+        import redis.asyncio as redis # type: ignore
+
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.generation_prefix = generation_prefix
+        self.client = redis.Redis.from_url(url)
+        self._set_if_generation = self.client.register_script(_SET_IF_GENERATION)
+
+    async def get(self, username: str) -> Optional[float]:
+        value = await self.client.get(self.prefix + username)
+        CACHE_LOOKUPS.inc(cache="principal", result="miss" if value is None else "hit")
+        return float(value) if value is not None else None
+
+    async def generation(self, username: str) -> int:
+        return int(await self.client.get(self.generation_prefix + username) or 0)
+
+    async def set(self, username: str, last_password_change: float, generation: int) -> None:
+        await self._set_if_generation(
+            keys=[self.prefix + username, self.generation_prefix + username],
+            args=[repr(last_password_change), generation, int(self.ttl_seconds * 1000)]
+        )
+
+    async def invalidate(self, username: str) -> None:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.incr(self.generation_prefix + username)
+            pipe.expire(self.generation_prefix + username, self.generation_ttl_seconds)
+            pipe.delete(self.prefix + username)
+            await pipe.execute()
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def build_principal_cache(
+        backend: str,
+        ttl_seconds: float,
+        maxsize: int = 10000,
+        redis_url: Optional[str] = None
+) -> PrincipalCache:
+    """
+    'memory', 'redis', or the dotted path of a PrincipalCache subclass
+    (e.g. 'myapp.auth.MemcachedPrincipalCache') constructed with ttl_seconds
+    """
+    if backend == "memory":
+        return InMemoryPrincipalCache(ttl_seconds, maxsize)
+    if backend == "redis":
+        if not redis_url:
+            raise ValueError("PRINCIPAL_CACHE_REDIS_URL is required for the redis principal cache")
+        return RedisPrincipalCache(ttl_seconds, redis_url)
+
+    module_name, _, class_name = backend.rpartition(".")
+    if not module_name:
+        raise ValueError(f"Unknown principal cache backend: {backend}")
+    cache_class = getattr(importlib.import_module(module_name), class_name)
+    return cache_class(ttl_seconds=ttl_seconds)
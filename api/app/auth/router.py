@@ -8,8 +8,7 @@ from app.core.dependencies import get_current_user, get_user_service
 from app.core.security import (
     ACCESS_TOKEN_EXPIRE_MINUTES, 
     REFRESH_TOKEN_EXPIRE_DAYS, 
-    create_jwt_token, 
-    hash_password
+    create_jwt_token
 )
 
 router = APIRouter(
@@ -18,28 +17,30 @@ router = APIRouter(
 )
 
 @router.post("/register")
-def register(
+async def register(
     username: str,
     password: str,
     user_svc: UserService = Depends(get_user_service)
 ):
     try:
-        result = user_svc.create_user(username, hash_password(password))
+        result = await user_svc.create_user(username, password)
 
         if not result:
             return {"msg": f"That username is already taken, try another one!"}
         return {"msg": f"Your account has been successfully registered!"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(500, "An Error occurred while attempting to register your user")
 
 @router.post("/login", response_model=Token)
-def login(
+async def login(
     response: Response,
     form_data: OAuth2PasswordRequestForm = Depends(),
     user_svc: UserService = Depends(get_user_service)
 ):
-    user = user_svc.authenticate_user(form_data.username, form_data.password)
+    user = await user_svc.authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
@@ -65,7 +66,7 @@ def login(
     return Token(access_token=access_token)
 
 @router.post("/refresh")
-def refresh_token(
+async def refresh_token(
     request: Request,
     user_svc: UserService = Depends(get_user_service)
 ):
@@ -75,7 +76,7 @@ def refresh_token(
         if not refresh_token:
             raise HTTPException(status_code=401, detail="Missing refresh token")
 
-        new_token = user_svc.refresh_access_token(refresh_token)
+        new_token = await user_svc.refresh_access_token(refresh_token)
         if not new_token:
             raise HTTPException(
                 status_code=401, 
@@ -90,23 +91,23 @@ def refresh_token(
         )
 
 @router.post("/logout")
-def logout(
+async def logout(
     current_user: str = Depends(get_current_user),
     user_svc: UserService = Depends(get_user_service)
 ):
     """Logout user by invalidating all tokens"""
-    user_svc.invalidate_all_tokens(current_user)
+    await user_svc.invalidate_all_tokens(current_user)
     return {"message": "Successfully logged out"}
 
 @router.post("/change-password")
-def change_password(
+async def change_password(
     old_password: str,
     new_password: str,
     current_user: str = Depends(get_current_user),
     user_svc: UserService = Depends(get_user_service)
 ):
     """Change user password"""
-    success = user_svc.change_password(current_user, old_password, hash_password(new_password))
+    success = await user_svc.change_password(current_user, old_password, new_password)
     if not success:
         raise HTTPException(status_code=400, detail="Invalid current password")
     return {"message": "Password changed successfully"}
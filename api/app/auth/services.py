@@ -1,9 +1,12 @@
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from app.auth.cache import PrincipalCache
 from app.auth.schema import TokenResponse
 from app.core.database import User
 from app.core.exceptions import CredentialsException
-from sqlalchemy.orm import Session
+from app.core.metrics import timed
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from jwt import decode, PyJWTError # type: ignore
 from app.core.security import (
@@ -11,46 +14,61 @@ from app.core.security import (
     JWTPayload, 
     SECRET_KEY, 
     ALGORITHM,
-    create_jwt_token, 
-    verify_password
+    PasswordHasher,
+    create_jwt_token
 )
 
 
 class UserService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession, principal_cache: PrincipalCache, hasher: PasswordHasher):
         self.db = db
+        self.principal_cache = principal_cache
+        self.hasher = hasher
 
-    def get_by_username(self, username: str) -> Optional[User]:
+    async def get_by_username(self, username: str) -> Optional[User]:
         stmt = select(User).where(User.username == username)
-        return self.db.scalar(stmt)
+        return await self.db.scalar(stmt)
     
-    def create_user(self, username: str, hashedPassword: str) -> bool:
-        exists = self.get_by_username(username)
+    async def create_user(self, username: str, password: str) -> bool:
+        exists = await self.get_by_username(username)
 
         if exists:
             return False
         
         user = User(
             username=username,
-            hashed_password=hashedPassword,
+            hashed_password=await self.hasher.hash(password),
             last_password_change=datetime.now(timezone.utc)
         )
         self.db.add(user)
-        self.db.commit()
+        try:
+            await self.db.commit()
+        except IntegrityError:
+            # Registered concurrently under the same username
+            await self.db.rollback()
+            return False
         return True
     
-    def authenticate_user(self, username: str, password: str) -> Optional[User]:
-        user = self.get_by_username(username)
+    async def authenticate_user(self, username: str, password: str) -> Optional[User]:
+        user = await self.get_by_username(username)
+        if not user:
+            return None
 
-        if not user or not verify_password(password, user.hashed_password):
+        valid, new_hash = await self.hasher.verify_and_update(password, user.hashed_password)
+        if not valid:
             return None
-        else:
-            return user
+
+        if new_hash:
+            # BCRYPT_ROUNDS changed since this hash was made. Same password, so tokens stay valid
+            user.hashed_password = new_hash
+            await self.db.commit()
+        return user
     
-    def verify_access_token(self, token: str) -> str:
+    async def verify_access_token(self, token: str) -> str:
         """Verify access token and return username"""
         try:
-            payload: JWTPayload = decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            with timed("jwt_verify"):
+                payload: JWTPayload = decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             
             username = payload.get("sub")
             expiry = payload.get("exp")
@@ -63,13 +81,21 @@ class UserService:
             if token_type != "access" or expiry < now:
                 raise CredentialsException()
             
-            # Now check if user exists and password hasn't changed
-            user = self.get_by_username(username)
-            if not user:
-                raise CredentialsException()
+            # Now check if user exists and password hasn't changed,
+            # going to the database only when the principal isn't cached
+            last_password_change = await self.principal_cache.get(username)
+            if last_password_change is None:
+                # Read first, so a revocation committed while we read the user keeps our stale value out
+                generation = await self.principal_cache.generation(username)
+                with timed("user_lookup"):
+                    user = await self.get_by_username(username)
+                if not user:
+                    raise CredentialsException()
+                last_password_change = user.last_password_change.timestamp()
+                await self.principal_cache.set(username, last_password_change, generation)
             
             # Validate token was issued after last password change
-            if issued_at < user.last_password_change.timestamp():
+            if issued_at < last_password_change:
                 raise CredentialsException()
             
             return username
@@ -77,7 +103,7 @@ class UserService:
         except PyJWTError:
             raise CredentialsException()
     
-    def verify_refresh_token(self, token: str) -> str:
+    async def verify_refresh_token(self, token: str) -> str:
         """Verify refresh token and return username"""
         try:
             # First, verify the signature and basic token validity
@@ -98,7 +124,7 @@ class UserService:
                 raise CredentialsException()
             
             # Now check if user exists and password hasn't changed
-            user = self.get_by_username(username)
+            user = await self.get_by_username(username)
             if not user:
                 raise CredentialsException()
             
@@ -111,11 +137,11 @@ class UserService:
         except PyJWTError:
             raise CredentialsException()
     
-    def refresh_access_token(self, refresh_token: str) -> Optional[TokenResponse]:
+    async def refresh_access_token(self, refresh_token: str) -> Optional[TokenResponse]:
         """Create new access token from valid refresh token"""
         try:
             # Verify the refresh token (this also checks user existence)
-            verified_username = self.verify_refresh_token(refresh_token)
+            verified_username = await self.verify_refresh_token(refresh_token)
             
             # Create new access token
             access_token = create_jwt_token(
@@ -129,25 +155,26 @@ class UserService:
         except Exception:
             return None
     
-    def change_password(self, username: str, old_password: str, new_password: str) -> bool:
+    async def change_password(self, username: str, old_password: str, new_password: str) -> bool:
         """Change user password and update last_password_change timestamp"""
-        user = self.authenticate_user(username, old_password)
+        user = await self.authenticate_user(username, old_password)
         if not user:
             return False
         
-        from app.core.security import hash_password
-        user.hashed_password = hash_password(new_password)
+        user.hashed_password = await self.hasher.hash(new_password)
         user.last_password_change = datetime.now(timezone.utc)
         
-        self.db.commit()
+        await self.db.commit()
+        await self.principal_cache.invalidate(username)
         return True
     
-    def invalidate_all_tokens(self, username: str) -> bool:
+    async def invalidate_all_tokens(self, username: str) -> bool:
         """Invalidate all tokens for a user by updating last_password_change"""
-        user = self.get_by_username(username)
+        user = await self.get_by_username(username)
         if not user:
             return False
         
         user.last_password_change = datetime.now(timezone.utc)
-        self.db.commit()
+        await self.db.commit()
+        await self.principal_cache.invalidate(username)
         return True
\ No newline at end of file
@@ -1,15 +1,102 @@
-from datetime import datetime
-from sqlalchemy import DateTime, create_engine
-from sqlalchemy.orm import sessionmaker, MappedAsDataclass, DeclarativeBase
-from sqlalchemy import Integer, String, Text
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+from sqlalchemy import DateTime, Dialect, TypeDecorator, event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import MappedAsDataclass, DeclarativeBase
+from sqlalchemy import Index, Integer, String, Text, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column
 from app.core.config import settings
+from app.core.logging import logger
+from app.core.metrics import DB_QUERY_SECONDS, DB_SLOW_QUERIES
 
-engine = create_engine(
-    settings.SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def async_database_url(url: str) -> str:
+    """Pick the async driver for a plain sqlite:// or postgresql:// URL"""
+    parsed = make_url(url)
+    if parsed.drivername == "sqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    elif parsed.drivername in ("postgresql", "postgres", "postgresql+psycopg2"):
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+    return parsed.render_as_string(hide_password=False)
+
+
+def engine_options(url: str) -> dict[str, Any]:
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        # In-memory databases live on a single connection, so there's no pool to tune
+        return {}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+        "pool_timeout": settings.DB_POOL_TIMEOUT_SECONDS,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+
+DATABASE_URL = async_database_url(settings.SQLALCHEMY_DATABASE_URL)
+engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _tune_sqlite(dbapi_connection: Any, connection_record: Any):
+        # WAL lets history reads carry on while another connection writes,
+        # and with synchronous=NORMAL a commit no longer waits on fsync
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.close()
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool):
+    # On the execution context rather than the connection, so a failed statement leaves nothing behind
+    context.query_started = time.perf_counter()
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _log_query(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool):
+    elapsed = time.perf_counter() - context.query_started
+    DB_QUERY_SECONDS.observe(elapsed)
+    # Only slow statements and a sample of the rest, formatting every one costs too much
+    if elapsed * 1000 >= settings.SLOW_QUERY_MS:
+        DB_SLOW_QUERIES.inc()
+        logger.warning(f"Slow query ({elapsed * 1000:.0f}ms): {statement}")
+    elif settings.SQL_LOG_SAMPLE_RATE and random.random() < settings.SQL_LOG_SAMPLE_RATE:
+        logger.info(f"Query ({elapsed * 1000:.1f}ms): {statement}")
+
+class UTCDateTime(TypeDecorator[datetime]):
+    """
+    Timezone-aware datetimes, stored in UTC. TIMESTAMP WITH TIME ZONE on Postgres, whose
+    asyncpg driver rejects aware values for plain TIMESTAMP. SQLite has no time zones,
+    so it keeps the UTC wall time and values read back are tagged as UTC again.
+    Naive values written are taken to be UTC.
+
+    Postgres tables created before these columns were timezone-aware need converting once:
+        ALTER TABLE users ALTER COLUMN last_password_change TYPE timestamptz USING last_password_change AT TIME ZONE 'UTC';
+        ALTER TABLE sessions ALTER COLUMN created_at TYPE timestamptz USING created_at AT TIME ZONE 'UTC';
+        ALTER TABLE sessions ALTER COLUMN updated_at TYPE timestamptz USING updated_at AT TIME ZONE 'UTC';
+        ALTER TABLE documents ALTER COLUMN created_at TYPE timestamptz USING created_at AT TIME ZONE 'UTC';
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime | None, dialect: Dialect) -> datetime | None:
+        if value is None:
+            return None
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+    def process_result_value(self, value: datetime | None, dialect: Dialect) -> datetime | None:
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
 
 class Base(MappedAsDataclass, DeclarativeBase):
     """subclasses will be converted to dataclasses"""
@@ -20,13 +107,70 @@ class User(Base):
     id: Mapped[int] = mapped_column(Integer, init=False, primary_key=True, index=True)
     username: Mapped[str] = mapped_column(String, unique=True, index=True)
     hashed_password: Mapped[str]
-    last_password_change: Mapped[datetime] = mapped_column(DateTime)
+    last_password_change: Mapped[datetime] = mapped_column(UTCDateTime)
 
 class Message(Base):
     __tablename__ = "message_store"
+    # A session's messages in id order, for history windows and before-id cursors
+    __table_args__ = (Index("ix_message_store_session_id_id", "session_id", "id"),)
 
     id: Mapped[int] = mapped_column(Integer, init=False, primary_key=True, index=True)
-    session_id: Mapped[str] = mapped_column(Text, index=True)
+    session_id: Mapped[str] = mapped_column(Text)
     message: Mapped[str] = mapped_column(Text)
     # type: Mapped[str]  # 'human', 'ai', or 'system'
-    # created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    # created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class ChatSession(Base):
+    __tablename__ = "sessions"
+    # A user's sessions, most recently active first, read as keyset pages
+    __table_args__ = (Index("ix_sessions_owner_updated_at_id", "owner", "updated_at", "session_id"),)
+
+    session_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    owner: Mapped[str] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(UTCDateTime)
+    updated_at: Mapped[datetime] = mapped_column(UTCDateTime)
+    message_count: Mapped[int] = mapped_column(Integer, default=0)
+
+class DocumentRecord(Base):
+    __tablename__ = "documents"
+    __table_args__ = (
+        UniqueConstraint("owner", "content_hash"),
+        UniqueConstraint("owner", "filename"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, init=False, primary_key=True, index=True)
+    owner: Mapped[str] = mapped_column(String, index=True)
+    filename: Mapped[str] = mapped_column(String)
+    content_hash: Mapped[str] = mapped_column(String(64))  # SHA-256 of the file
+    created_at: Mapped[datetime] = mapped_column(UTCDateTime)
+    chunk_ids: Mapped[str] = mapped_column(Text, default="[]")  # JSON list of vector store IDs
+    # The indexed version's file. None until the first is indexed, and for files saved
+    # before each version had a directory of its own, at UPLOAD_DIR/<id>/<filename>
+    path: Mapped[Optional[str]] = mapped_column(Text, nullable=True, default=None)
+    # The indexed version's number, stamped on its chunks as "version". None for documents
+    # indexed before chunks carried one
+    version: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, default=None)
+
+class Corpus(Base):
+    """
+    Counts the changes to each owner's indexed documents, versioning their cached
+    answers across workers, and lists the chunk versions searches must skip
+    """
+    __tablename__ = "corpora"
+
+    owner: Mapped[str] = mapped_column(String, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+    # JSON lists of document versions: being indexed, and replaced or deleted with chunks left to purge
+    pending: Mapped[Optional[str]] = mapped_column(Text, nullable=True, default=None)
+    retired: Mapped[Optional[str]] = mapped_column(Text, nullable=True, default=None)
+
+class IngestJob(Base):
+    """An upload's ingestion progress, so any worker can report on a job another one runs"""
+    __tablename__ = "ingest_jobs"
+
+    job_id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    owner: Mapped[str] = mapped_column(String, index=True)
+    status: Mapped[str] = mapped_column(String)  # 'running', 'done' or 'failed'
+    files: Mapped[str] = mapped_column(Text)  # JSON list of FileIngestStatus
+    created_at: Mapped[datetime] = mapped_column(UTCDateTime)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(UTCDateTime, nullable=True, default=None)
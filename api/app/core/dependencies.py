@@ -1,71 +1,268 @@
+from typing import TYPE_CHECKING, Optional
 from fastapi import Depends
-from sqlalchemy.orm import Session
+from langchain_core.embeddings import Embeddings
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth.cache import build_principal_cache
 from app.auth.services import UserService
-from app.documents.services import DocumentService
+from app.documents.cache import AnswerCache
+from app.documents.history import HistoryWindowCache
+from app.documents.ingestion import IngestionEngine
+from app.documents.singleflight import SingleFlight
+from app.documents.services import DocumentService, build_answer_chain
 from app.core.database import SessionLocal
-from app.core.security import oauth2_scheme
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from app.core.security import PasswordHasher, oauth2_scheme
+from app.core.embeddings import BatchingEmbeddings, LRUByteStore, RemoteEmbeddings, build_embedding_model
+from app.core.exceptions import NotReadyException
+from app.core.llm import ConcurrencyLimiter, LLMRunner, build_chat_model
+from app.core.logging import logger
+from app.core.vector_store import TenantVectorStores
 from app.core.config import settings
+from app.shared.context import count_tokens
+
+if TYPE_CHECKING:
+    import httpx
+    from langchain_core.language_models import BaseChatModel
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # Global variables to store initialized instances
 _embeddings = None
-_vector_store = None
+_embedding_batcher = None
+_remote_embeddings = None
+_query_embedding_cache = None
+_vector_stores = None
 _text_splitter = None
+_ingestion_engine = None
+_answer_cache = None
+_chat_model: Optional["BaseChatModel"] = None
+_llm_http_client: Optional["httpx.AsyncClient"] = None
+_answer_runner: Optional[LLMRunner] = None
+_llm_limiter = ConcurrencyLimiter(
+    settings.LLM_MAX_CONCURRENCY, settings.LLM_MAX_QUEUED, settings.LLM_QUEUE_TIMEOUT_SECONDS
+)
+_ml_ready = False
+_ml_error: Optional[BaseException] = None
+_answer_flights = SingleFlight()
+_history_window = HistoryWindowCache(settings.HISTORY_WINDOW_SIZE, settings.HISTORY_CACHE_SESSIONS)
+_principal_cache = build_principal_cache(
+    settings.PRINCIPAL_CACHE_BACKEND,
+    ttl_seconds=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+    maxsize=settings.PRINCIPAL_CACHE_SIZE,
+    redis_url=settings.PRINCIPAL_CACHE_REDIS_URL
+)
+_password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
 
-def initialize_ml_components():
-    """Initialize ML components once at startup"""
-    global _embeddings, _vector_store, _text_splitter
+def initialize_ml_components(embedding_model: Optional[Embeddings] = None):
+    """
+    Initialize ML components once at startup.
+    embedding_model replaces the configured sentence-transformer (e.g. a fake in benchmarks)
+    """
+    global _embeddings, _embedding_batcher, _remote_embeddings, _query_embedding_cache, _vector_stores, _text_splitter, _ingestion_engine, _answer_cache
+    global _chat_model, _llm_http_client
     
+    # Deferred so importing the app stays fast, these pull in most of LangChain
+    from langchain.embeddings import CacheBackedEmbeddings
+    from langchain.storage import LocalFileStore
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     print("Initializing embeddings...")
-    _embeddings = HuggingFaceEmbeddings()
+    if settings.EMBEDDING_SIDECAR_SOCKET and embedding_model is None:
+        # The sidecar holds the model and batches across workers
+        _remote_embeddings = RemoteEmbeddings(settings.EMBEDDING_SIDECAR_SOCKET)
+        base_embeddings: Embeddings = _remote_embeddings
+    else:
+        _embedding_batcher = BatchingEmbeddings(
+            embedding_model or build_embedding_model(
+                settings.EMBEDDING_MODEL,
+                backend=settings.EMBEDDING_BACKEND,
+                onnx_file=settings.EMBEDDING_ONNX_FILE,
+                threads=settings.EMBEDDING_THREADS
+            ),
+            batch_size=settings.EMBEDDING_BATCH_SIZE,
+            max_wait_ms=settings.EMBEDDING_BATCH_WAIT_MS
+        )
+        base_embeddings = _embedding_batcher
+
+    # Chunk embeddings persist on disk keyed by (model, sha256 of text), so re-indexing
+    # known text skips the model. Query embeddings go through a bounded in-memory LRU.
+    _query_embedding_cache = LRUByteStore(maxsize=settings.QUERY_EMBEDDING_CACHE_SIZE, name="query_embedding")
+    _embeddings = CacheBackedEmbeddings.from_bytes_store(
+        base_embeddings,
+        LocalFileStore(settings.EMBEDDING_CACHE_DIR),
+        namespace=settings.EMBEDDING_MODEL,
+        key_encoder="sha256",
+        query_embedding_cache=_query_embedding_cache
+    )
     
     print("Initializing vector store...")
-    _vector_store = Chroma(embedding_function=_embeddings, persist_directory=settings.CHROME_DIR)
+    _vector_stores = TenantVectorStores(
+        _embeddings,
+        persist_directory=settings.FLAT_VECTOR_DIR if settings.VECTOR_STORE_BACKEND == "flat" else settings.CHROME_DIR,
+        host=settings.CHROMA_HOST,
+        port=settings.CHROMA_PORT,
+        backend=settings.VECTOR_STORE_BACKEND,
+        dtype=settings.FLAT_VECTOR_DTYPE,
+        hnsw=settings.FLAT_VECTOR_HNSW
+    )
     
     print("Initializing text splitter...")
     _text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
+        chunk_size=settings.CHUNK_SIZE,
+        chunk_overlap=settings.CHUNK_OVERLAP,
         length_function=len,
     )
+
+    print("Initializing answer cache...")
+    _answer_cache = AnswerCache(
+        maxsize=settings.ANSWER_CACHE_SIZE,
+        ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+        semantic_threshold=settings.ANSWER_CACHE_SEMANTIC_THRESHOLD
+    )
+
+    print("Initializing LLM client...")
+    _chat_model, _llm_http_client = build_chat_model(
+        settings.OPENAI_KEY,
+        base_url=settings.OPENAI_BASE_URL,
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        connect_timeout=settings.LLM_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=settings.LLM_READ_TIMEOUT_SECONDS
+    )
+
+    print("Initializing ingestion engine...")
+    _ingestion_engine = IngestionEngine(_vector_stores, _text_splitter, _answer_cache)
     
     print("ML components initialization complete!")
 
-def get_db():
-    db = SessionLocal()
+def warm_up_ml_components(embedding_model: Optional[Embeddings] = None):
+    """
+    Initialize the ML components, then push a dummy text through the embedding model
+    and load the token encoding and LLM client, so the first real request doesn't pay for them.
+    Runs in a background thread while the API already serves auth and health routes
+    """
+    global _ml_ready, _ml_error
+
     try:
+        initialize_ml_components(embedding_model)
+
+        print("Warming up ML components...")
+        (_remote_embeddings or _embedding_batcher).embed_documents(["warm-up"]) # type: ignore
+        count_tokens("warm-up", settings.CONTEXT_TOKEN_ENCODING)
+
+        _ml_ready = True
+        print("ML components ready!")
+    except Exception as e:
+        _ml_error = e
+        logger.error(f"ML components failed to start: {e}", exc_info=True)
+
+def ml_status() -> str:
+    """'ready', 'starting' or 'failed'"""
+    if _ml_ready:
+        return "ready"
+    return "failed" if _ml_error is not None else "starting"
+
+def shutdown_ml_components():
+    """Release the background workers started by initialize_ml_components"""
+    if _ingestion_engine is not None:
+        _ingestion_engine.shutdown()
+    if _embedding_batcher is not None:
+        _embedding_batcher.close()
+    if _remote_embeddings is not None:
+        _remote_embeddings.close()
+
+def shutdown_password_hasher():
+    """Stop the bcrypt threads"""
+    _password_hasher.shutdown()
+
+async def close_principal_cache():
+    """Close the shared principal cache's connections, if it has any"""
+    await _principal_cache.close()
+
+async def close_chat_model():
+    """Close the LLM client's pooled connections"""
+    if _llm_http_client is not None:
+        await _llm_http_client.aclose()
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def get_user_service(db: Session = Depends(get_db)):
+def get_user_service(db: AsyncSession = Depends(get_db)):
     from app.auth.services import UserService
-    return UserService(db)
+    return UserService(db, _principal_cache, _password_hasher)
 
-def get_current_user(
+async def get_current_user(
     token: str = Depends(oauth2_scheme),
     user_svc: UserService = Depends(get_user_service)
 ):
     """Dependency to verify & get current user from access token"""
-    return user_svc.verify_access_token(token)
+    return await user_svc.verify_access_token(token)
 
-def get_vector_store():
-    """Get the pre-initialized vector store"""
-    if _vector_store is None:
-        raise RuntimeError("Vector store not initialized. Make sure FastAPI lifespan is properly configured.")
-    return _vector_store
+def get_vector_stores():
+    """Get the pre-initialized per-user vector stores"""
+    if not _ml_ready:
+        raise NotReadyException()
+    return _vector_stores
 
 def get_text_splitter():
     """Get the pre-initialized text splitter"""
-    if _text_splitter is None:
-        raise RuntimeError("Text splitter not initialized. Make sure FastAPI lifespan is properly configured.")
+    if not _ml_ready:
+        raise NotReadyException()
     return _text_splitter
 
+def get_ingestion_engine():
+    """Get the pre-initialized ingestion engine"""
+    if not _ml_ready:
+        raise NotReadyException()
+    return _ingestion_engine
+
+def get_answer_cache():
+    """Get the pre-initialized answer cache"""
+    if not _ml_ready:
+        raise NotReadyException()
+    return _answer_cache
+
+def get_answer_flights():
+    """Get the answers being generated right now, for identical questions to share"""
+    return _answer_flights
+
+def get_history_window():
+    """Get the in-memory window of recent chat messages"""
+    return _history_window
+
+def get_chat_model():
+    """The LLM answering questions, one client for all requests. Override with app.dependency_overrides to swap models"""
+    if not _ml_ready:
+        raise NotReadyException()
+    return _chat_model
+
+async def get_answer_runner(llm: "BaseChatModel" = Depends(get_chat_model)):
+    """
+    The answer chain, compiled once per model and run under the worker's LLM call limit.
+    Async so it's built on the event loop rather than raced for in the threadpool
+    """
+    global _answer_runner
+    if _answer_runner is None or _answer_runner.llm is not llm:
+        _answer_runner = LLMRunner(
+            llm,
+            build_answer_chain(llm),
+            _llm_limiter,
+            max_retries=settings.LLM_MAX_RETRIES,
+            backoff_base=settings.LLM_RETRY_BASE_SECONDS,
+            backoff_max=settings.LLM_RETRY_MAX_SECONDS
+        )
+    return _answer_runner
+
 def get_document_service(
-        db: Session = Depends(get_db),
-        vector_store: Chroma = Depends(get_vector_store),
-        text_splitter: RecursiveCharacterTextSplitter = Depends(get_text_splitter)
+        db: AsyncSession = Depends(get_db),
+        vector_stores: TenantVectorStores = Depends(get_vector_stores),
+        text_splitter: "RecursiveCharacterTextSplitter" = Depends(get_text_splitter),
+        ingestion_engine: IngestionEngine = Depends(get_ingestion_engine),
+        answer_cache: AnswerCache = Depends(get_answer_cache),
+        answer_flights: SingleFlight = Depends(get_answer_flights),
+        history_window: HistoryWindowCache = Depends(get_history_window),
+        answer_runner: LLMRunner = Depends(get_answer_runner),
+        current_user: str = Depends(get_current_user)
     ):
-    return DocumentService(db, vector_store, text_splitter)
\ No newline at end of file
+    return DocumentService(
+        db, vector_stores, text_splitter, ingestion_engine, answer_cache, answer_flights, history_window,
+        answer_runner, current_user
+    )
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Embedding sidecar: one process holds the embedding model and serves every uvicorn
+worker over a Unix socket, batching requests from all of them together.
+
+    uv run python -m app.core.embedding_server --socket /tmp/papertrail-embeddings.sock
+    EMBEDDING_SIDECAR_SOCKET=/tmp/papertrail-embeddings.sock uv run uvicorn app.main:app --workers 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+from app.core.config import settings
+from app.core.embeddings import (
+    OP_DOCUMENTS,
+    OP_QUERY,
+    REQUEST_HEADER,
+    BatchingEmbeddings,
+    build_embedding_model,
+    encode_error,
+    encode_vectors
+)
+from app.core.logging import logger
+
+
+class EmbeddingServer:
+    def __init__(self, embeddings: BatchingEmbeddings, socket_path: str):
+        self.embeddings = embeddings
+        self.socket_path = socket_path
+        self.requests = 0
+
+    async def serve(self, stop: asyncio.Event):
+        # A socket file left behind by a previous run would make bind fail
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        print(f"Embedding sidecar listening on {self.socket_path}")
+
+        async with server:
+            await stop.wait()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """One worker connection, serving its requests one after another"""
+        try:
+            while True:
+                op, length = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+                texts: list[str] = json.loads(await reader.readexactly(length))
+                writer.write(await self._embed(op, texts))
+                await writer.drain()
+                self.requests += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _embed(self, op: int, texts: list[str]) -> bytes:
+        try:
+            if op == OP_DOCUMENTS:
+                # Requests from every worker land in the same batching queue
+                return encode_vectors(await self.embeddings.aembed_documents(texts))
+            if op == OP_QUERY:
+                return encode_vectors([await self.embeddings.aembed_query(texts[0])])
+            return encode_error(f"Unknown operation {op}")
+        except Exception as e:
+            logger.error(f"Embedding request failed: {e}", exc_info=True)
+            return encode_error(str(e))
+
+
+async def main(socket_path: str):
+    embeddings = BatchingEmbeddings(
+        build_embedding_model(
+            settings.EMBEDDING_MODEL,
+            backend=settings.EMBEDDING_BACKEND,
+            onnx_file=settings.EMBEDDING_ONNX_FILE,
+            threads=settings.EMBEDDING_THREADS
+        ),
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_wait_ms=settings.EMBEDDING_BATCH_WAIT_MS
+    )
+    embeddings.embed_documents(["warm-up"])
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await EmbeddingServer(embeddings, socket_path).serve(stop)
+    finally:
+        embeddings.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=settings.EMBEDDING_SIDECAR_SOCKET or "/tmp/papertrail-embeddings.sock")
+    args = parser.parse_args()
+    asyncio.run(main(args.socket))
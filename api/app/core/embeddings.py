@@ -0,0 +1,383 @@
+import asyncio
+import contextlib
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Iterator, Optional, Sequence
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+from app.core.logging import logger
+from app.core.metrics import CACHE_LOOKUPS
+
+
+class LRUByteStore(ByteStore):
+    """
+    Bounded in-memory byte store that evicts the least recently used key.
+    Lookups are counted under papertrail_cache_lookups_total{cache=name}
+    """
+
+    def __init__(self, maxsize: int, name: str = "lru"):
+        self.maxsize = maxsize
+        self.name = name
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        # Embeddings are looked up from executor threads as well as the event loop
+        self._lock = threading.Lock()
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        values: list[Optional[bytes]] = []
+        with self._lock:
+            for key in keys:
+                value = self._data.get(key)
+                if value is not None:
+                    self._data.move_to_end(key)
+                values.append(value)
+        hits = sum(value is not None for value in values)
+        if hits:
+            CACHE_LOOKUPS.inc(hits, cache=self.name, result="hit")
+        if hits < len(values):
+            CACHE_LOOKUPS.inc(len(values) - hits, cache=self.name, result="miss")
+        return values
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        with self._lock:
+            for key, value in key_value_pairs:
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            keys = list(self._data)
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    # Everything is in memory, so skip the executor hop of the default async versions
+
+    async def amget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        return self.mget(keys)
+
+    async def amset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        self.mset(key_value_pairs)
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        self.mdelete(keys)
+
+
+def build_embedding_model(
+        model_name: str,
+        backend: str = "torch",
+        onnx_file: Optional[str] = None,
+        threads: Optional[int] = None
+) -> Embeddings:
+    """
+    Load the sentence-transformer on the requested runtime. The "onnx" and "openvino"
+    backends (optionally with an int8-quantized file such as
+    "onnx/model_qint8_avx512_vnni.onnx") produce vectors for the same model,
+    so they can be used against an existing collection
+    """
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    model_kwargs: dict[str, Any] = {"backend": backend}
+    runtime_kwargs: dict[str, Any] = {}
+
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+    elif backend == "onnx":
+        if onnx_file:
+            runtime_kwargs["file_name"] = onnx_file
+        if threads:
+            import onnxruntime # type: ignore
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            runtime_kwargs["session_options"] = session_options
+    elif backend == "openvino":
+        if threads:
+            runtime_kwargs["ov_config"] = {"INFERENCE_NUM_THREADS": str(threads)}
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    if runtime_kwargs:
+        model_kwargs["model_kwargs"] = runtime_kwargs
+
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
+
+
+async def aembed_queries(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+    """
+    Embed several queries with one embed_documents call to the model. Goes through
+    a CacheBackedEmbeddings' query cache like aembed_query does, rather than the
+    on-disk cache its aembed_documents keeps for chunks
+    """
+    store = getattr(embeddings, "query_embedding_store", None)
+    underlying: Embeddings = getattr(embeddings, "underlying_embeddings", embeddings)
+    vectors: list[Optional[list[float]]] = await store.amget(texts) if store is not None else [None] * len(texts)
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        fresh = await underlying.aembed_documents([texts[i] for i in missing])
+        if store is not None:
+            await store.amset([(texts[i], vector) for i, vector in zip(missing, fresh)])
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+    return vectors  # type: ignore
+
+
+class _EmbeddingRequest:
+    def __init__(self, texts: list[str], query: bool = False):
+        self.texts = texts
+        self.query = query  # a single text, for embed_query
+        self.future: Future[list[list[float]]] = Future()
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Coalesces embed_documents calls from concurrent uploads into batches of up to
+    batch_size texts, waiting at most max_wait_ms for a batch to fill.
+    A single background thread owns the model, so calls never compete for cores.
+    Queries go through it too, but skip the batching window
+    """
+
+    def __init__(self, underlying: Embeddings, batch_size: int = 64, max_wait_ms: int = 10):
+        self.underlying = underlying
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.texts_embedded = 0
+        self._queue: queue.Queue[Optional[_EmbeddingRequest]] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._submit(texts).result()
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return await asyncio.wrap_future(self._submit(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._submit([text], query=True).result()[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await asyncio.wrap_future(self._submit([text], query=True)))[0]
+
+    def close(self):
+        self._queue.put(None)
+
+    def _submit(self, texts: list[str], query: bool = False) -> Future[list[list[float]]]:
+        request = _EmbeddingRequest(texts, query)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self, first: _EmbeddingRequest) -> tuple[list[_EmbeddingRequest], list[_EmbeddingRequest], bool]:
+        """
+        Gather queued requests until the batch is full or the wait expires. A query
+        arriving meanwhile ends the wait, so it isn't held up behind the window.
+        Returns the document requests, the queries and whether the batcher was closed
+        """
+        pending, queries = [first], []
+        size = len(first.texts)
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.batch_size and not queries:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return pending, queries, True
+            if request.query:
+                queries.append(request)
+                continue
+            pending.append(request)
+            size += len(request.texts)
+
+        return pending, queries, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            first = self._queue.get()
+            if first is None:
+                break
+            if first.query:
+                pending, queries = [], [first]
+            else:
+                pending, queries, closed = self._collect(first)
+
+            # Queries first, they're latency sensitive
+            for batch in [[request] for request in queries] + [pending]:
+                try:
+                    self._embed(batch)
+                except Exception as e:
+                    # Keep the thread alive, or every later call would hang
+                    logger.error(f"Embedding batcher failed: {e}", exc_info=True)
+                    for request in batch:
+                        with contextlib.suppress(InvalidStateError):
+                            request.future.set_exception(e)
+
+    def _embed(self, requests: list[_EmbeddingRequest]):
+        # Callers cancelled while queued, e.g. a client gone or shutting down, are skipped.
+        # The rest can no longer be cancelled, so setting their results can't fail
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        texts = [text for request in requests for text in request.texts]
+
+        try:
+            vectors: list[list[float]] = []
+            if requests[0].query:
+                vectors.append(self.underlying.embed_query(texts[0]))
+            else:
+                for start in range(0, len(texts), self.batch_size):
+                    vectors.extend(self.underlying.embed_documents(texts[start:start + self.batch_size]))
+                    self.batches += 1
+                self.texts_embedded += len(texts)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        offset = 0
+        for request in requests:
+            request.future.set_result(vectors[offset:offset + len(request.texts)])
+            offset += len(request.texts)
+
+
+# Wire format between RemoteEmbeddings and the embedding sidecar (app.core.embedding_server).
+# Request: op (1 byte), payload length (4 bytes), JSON list of texts.
+# Response: status (1 byte), rows (4 bytes), dimensions (4 bytes), then rows * dimensions
+# float32s in native byte order, both ends run on the same machine. On error rows is the
+# length of a UTF-8 message that follows instead.
+OP_DOCUMENTS = 0
+OP_QUERY = 1
+REQUEST_HEADER = struct.Struct("!BI")
+RESPONSE_HEADER = struct.Struct("!BII")
+
+
+def encode_vectors(vectors: list[list[float]]) -> bytes:
+    dimensions = len(vectors[0]) if vectors else 0
+    values = array("f")
+    for vector in vectors:
+        values.extend(vector)
+    return RESPONSE_HEADER.pack(0, len(vectors), dimensions) + values.tobytes()
+
+
+def encode_error(message: str) -> bytes:
+    data = message.encode()
+    return RESPONSE_HEADER.pack(1, len(data), 0) + data
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Embedding sidecar closed the connection")
+        received += count
+    return bytes(buffer)
+
+
+class RemoteEmbeddings(Embeddings):
+    """
+    Embeddings computed by the embedding sidecar over a Unix socket, so every
+    uvicorn worker shares one copy of the model and the sidecar can batch
+    requests across workers. Keeps a small pool of open connections
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 120, max_idle_connections: int = 8):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_idle_connections = max_idle_connections
+        self._idle: list[socket.socket] = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._request(OP_DOCUMENTS, texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._request(OP_QUERY, [text])[0]
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+    def _request(self, op: int, texts: list[str]) -> list[list[float]]:
+        payload = json.dumps(texts).encode()
+        message = REQUEST_HEADER.pack(op, len(payload)) + payload
+
+        sock, reused = self._acquire()
+        try:
+            sock.sendall(message)
+            status, rows, dimensions = RESPONSE_HEADER.unpack(_recv_exactly(sock, RESPONSE_HEADER.size))
+        except OSError:
+            sock.close()
+            if not reused:
+                raise
+            # The idle connection went stale (e.g. the sidecar restarted), retry on a fresh one
+            sock, _ = self._acquire(fresh=True)
+            try:
+                sock.sendall(message)
+                status, rows, dimensions = RESPONSE_HEADER.unpack(_recv_exactly(sock, RESPONSE_HEADER.size))
+            except OSError:
+                sock.close()
+                raise
+
+        try:
+            if status != 0:
+                raise RuntimeError(f"Embedding sidecar error: {_recv_exactly(sock, rows).decode()}")
+            values = array("f")
+            values.frombytes(_recv_exactly(sock, rows * dimensions * values.itemsize))
+        except OSError:
+            sock.close()
+            raise
+        self._release(sock)
+
+        return [values[i * dimensions:(i + 1) * dimensions].tolist() for i in range(rows)]
+
+    def _acquire(self, fresh: bool = False) -> tuple[socket.socket, bool]:
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop(), True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock, False
+
+    def _release(self, sock: socket.socket):
+        with self._lock:
+            if len(self._idle) < self.max_idle_connections:
+                self._idle.append(sock)
+                return
+        sock.close()
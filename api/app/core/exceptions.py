@@ -7,4 +7,46 @@ class CredentialsException(HTTPException):
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=detail,
             headers={"WWW-Authenticate": "Bearer"},
-        )
\ No newline at end of file
+        )
+
+class SessionNotFoundException(HTTPException):
+    def __init__(self, detail: str = "Session not found"):
+        super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+
+class DocumentNotFoundException(HTTPException):
+    def __init__(self, detail: str = "Document not found"):
+        super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+
+class UnsupportedFileTypeException(HTTPException):
+    def __init__(self, detail: str = "Unsupported file type"):
+        super().__init__(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=detail)
+
+
+class ServiceOverloadedException(HTTPException):
+    def __init__(self, detail: str = "Server is busy, try again shortly", retry_after: int = 1):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class NotReadyException(HTTPException):
+    def __init__(self, detail: str = "Document features are still starting up, try again shortly"):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": "5"},
+        )
+
+
+class InvalidUploadException(HTTPException):
+    def __init__(self, detail: str = "Malformed upload"):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class PayloadTooLargeException(HTTPException):
+    def __init__(self, detail: str = "Upload is too large"):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
@@ -0,0 +1,623 @@
+"""
+In-process vector store for VECTOR_STORE_BACKEND=flat. Each user's vectors live
+in a memory-mapped NumPy file, so opening a store only maps it and the OS page
+cache shares it between workers. Chunk text and metadata sit in a SQLite table
+beside it. Search is an exact, vectorized scan, or with hnsw=True an HNSW
+graph (hnswlib) once a search covers enough rows for the graph to pay off.
+
+    <directory>/vectors-<generation>.npy  (capacity, dim) in float32, float16 or int8
+    <directory>/rows-<generation>.npy     (capacity, 2) float32: squared norm and int8 scale per row
+    <directory>/chunks.sqlite             row -> chunk id, text and metadata JSON, the rows deleted
+                                          since the last compaction, and the generation, size and version
+    <directory>/hnsw-<generation>.bin     the graph as of the first search after opening, if enabled
+    <directory>/lock                      held by the process writing to the store
+
+compact() writes the live rows into the next generation's files and switches
+to them in the same SQLite commit that renumbers the rows, so a crash at any
+point leaves one consistent generation.
+
+Several worker processes can share a directory. Writes take the lock file, and
+every commit bumps the version, so each process catches up on the rows others
+added and deleted (or remaps the files they grew or compacted) before its next
+search or write. Files are only ever replaced, never rewritten in place, so a
+mapping another process still holds stays readable until it remaps.
+"""
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from app.core.vector_store import VectorStore
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+INITIAL_CAPACITY = 1024
+SEARCH_BLOCK_ROWS = 1024  # rows converted to float32 at a time for float16/int8 stores
+HNSW_MIN_CANDIDATES = 10000  # fewer rows than this are scanned exactly, which is as fast
+SQL_BATCH = 500  # stays under SQLite's bound parameter limit
+# Integer metadata every search filters on, so it's also kept in memory as columns, -1 where missing
+COLUMNS = ("document_id", "version")
+
+_NUMPY_OPERATORS = {
+    "$eq": np.equal,
+    "$ne": np.not_equal,
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+_SQL_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_COLUMNS_SQL = ", ".join(f"json_extract(metadata, '$.{key}')" for key in COLUMNS)
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class FlatVectorStore(VectorStore):
+    """
+    Rows are append-only: a delete drops the chunk's metadata row and clears its
+    bit in the alive mask, leaving the vector in place until compact()
+    """
+
+    def __init__(self, directory: str, embeddings: Embeddings, dtype: str = "float32", hnsw: bool = False):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown vector dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.embeddings = embeddings
+        self.dtype = np.dtype(DTYPES[dtype])
+        self.hnsw = hnsw
+        self._index: Any = None
+        self._lock = threading.RLock()
+        self._lock_file = open(os.path.join(directory, "lock"), "a+b")
+
+        # Autocommit, transactions are begun explicitly
+        self.db = sqlite3.connect(
+            os.path.join(directory, "chunks.sqlite"), check_same_thread=False, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "row INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, document TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Rows deleted at each version, for other processes to catch up on. Emptied by compact()
+        self.db.execute("CREATE TABLE IF NOT EXISTS deletions (version INTEGER NOT NULL, row INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS deletions_version ON deletions (version)")
+
+        self.generation = -1
+        self.version = -1
+        self.size = 0
+        self.vectors: Optional[np.memmap] = None
+        self.rows: Optional[np.memmap] = None
+        self.alive = np.zeros(0, dtype=bool)
+        self.columns = {key: np.full(0, -1, dtype=np.int64) for key in COLUMNS}
+        self._mapped: Optional[tuple[int, int]] = None  # inodes of the mapped vectors and rows files
+
+        with self._lock, self._file_lock():
+            # Another process may be writing the next generation, so only clean up under the lock
+            self._remove_files(keep=self._read_state()[0])
+            self._refresh()
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self.vectors.shape[1] if self.vectors is not None else None
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return int(self.alive[:self.size].sum())
+
+    def deleted_count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return self.size - int(self.alive[:self.size].sum())
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Keeps other processes from writing to the store meanwhile. Take self._lock first"""
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """One consistent snapshot to read, or one commit to write"""
+        self.db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _read_state(self) -> tuple[int, int, int]:
+        """The committed (generation, version, size)"""
+        meta = dict(self.db.execute("SELECT key, value FROM meta WHERE key IN ('generation', 'version', 'size')"))
+        if "size" in meta:
+            size = int(meta["size"])
+        else:
+            # Stores written before the size was kept: rows past the last metadata row were never committed
+            size = (self.db.execute("SELECT max(row) FROM chunks").fetchone()[0] or -1) + 1
+        return int(meta.get("generation", 0)), int(meta.get("version", 0)), size
+
+    def _write_state(self, size: int, generation: Optional[int] = None):
+        """Record a change, inside the transaction making it. Under the file lock"""
+        state = [("version", str(self.version + 1)), ("size", str(size))]
+        if generation is not None:
+            state.append(("generation", str(generation)))
+        self.db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", state)
+
+    def _inodes(self) -> Optional[tuple[int, int]]:
+        try:
+            return os.stat(self._path("vectors")).st_ino, os.stat(self._path("rows")).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _map_files(self):
+        """Map the current generation's files, if it has any. Keeps the alive mask's length in step"""
+        # Read before mapping, so a file replaced in between is noticed and remapped next time
+        self._mapped = self._inodes()
+        self.vectors = self.rows = None
+        if self._mapped is not None:
+            self.vectors = np.load(self._path("vectors"), mmap_mode="r+")
+            self.rows = np.load(self._path("rows"), mmap_mode="r+")
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        if capacity > len(self.alive):
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:len(self.alive)] = self.alive
+            self.alive = alive
+            for key, column in self.columns.items():
+                self.columns[key] = np.full(capacity, -1, dtype=np.int64)
+                self.columns[key][:len(column)] = column
+            if self._index is not None:
+                self._index.resize_index(capacity)
+
+    def _refresh(self):
+        """
+        Catch up with the commits of other processes since this one last looked: new
+        and deleted rows, files grown or compacted. Call under self._lock
+        """
+        with self._transaction():
+            generation, version, size = self._read_state()
+            if version == self.version and generation == self.generation:
+                return
+
+            if generation != self.generation:
+                # Compacted, so every row may have moved: start over from the new files
+                self.generation, self.size = generation, 0
+                self.alive = np.zeros(0, dtype=bool)
+                self.columns = {key: np.full(0, -1, dtype=np.int64) for key in COLUMNS}
+                self._index = None
+                self._map_files()
+                deleted: list[int] = []
+                added = self.db.execute(f"SELECT row, {_COLUMNS_SQL} FROM chunks WHERE row < ?", (size,)).fetchall()
+            else:
+                inodes = self._inodes()
+                # Gone if compacted since this snapshot, then the next refresh moves to the new generation
+                if inodes is not None and inodes != self._mapped:
+                    self._map_files()  # grown by another process
+                deleted = [row for (row,) in self.db.execute(
+                    "SELECT row FROM deletions WHERE version > ? AND version <= ?", (self.version, version)
+                )]
+                added = self.db.execute(
+                    f"SELECT row, {_COLUMNS_SQL} FROM chunks WHERE row >= ? AND row < ?", (self.size, size)
+                ).fetchall()
+
+        for row, *values in added:
+            self.alive[row] = True
+            self._set_columns(row, dict(zip(COLUMNS, values)))
+        self._forget_rows([row for row in deleted if row < self.size])
+        if self._index is not None and added:
+            assert self.vectors is not None and self.rows is not None
+            new_rows = np.array([row for row, *_ in added if self.alive[row]], dtype=np.int64)
+            if len(new_rows):
+                self._index.add_items(self._decode(self.vectors[new_rows], self.rows[new_rows, 1]), new_rows)
+        self.size, self.version = max(self.size, size), version
+
+    def _set_columns(self, row: int, metadata: dict[str, Any]):
+        for key, column in self.columns.items():
+            value = metadata.get(key)
+            column[row] = value if _is_int(value) else -1
+
+    def _path(self, name: str, generation: Optional[int] = None) -> str:
+        extension = "bin" if name == "hnsw" else "npy"
+        return os.path.join(self.directory, f"{name}-{self.generation if generation is None else generation}.{extension}")
+
+    def _remove_files(self, keep: int):
+        """Delete the files of every generation but `keep`, left behind by a compaction"""
+        for filename in os.listdir(self.directory):
+            match = re.fullmatch(r"(?:vectors|rows|hnsw)-(\d+)\.(?:npy|bin)(?:\.json|\.tmp)?", filename)
+            if match and int(match.group(1)) != keep:
+                os.remove(os.path.join(self.directory, filename))
+
+    def _allocate(self, capacity: int, dim: int):
+        """Grow the files to `capacity` rows, writing new copies and swapping them in"""
+        files = []
+        for name, dtype, shape in (
+                ("vectors", self.dtype, (capacity, dim)),
+                ("rows", np.dtype(np.float32), (capacity, 2))
+        ):
+            path = self._path(name)
+            grown = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=dtype, shape=shape)
+            old = self.vectors if name == "vectors" else self.rows
+            if old is not None:
+                grown[:self.size] = old[:self.size]
+            grown.flush()
+            files.append(path)
+        for path in files:
+            # A search (here or in another process) still holding the old map keeps reading the unlinked file
+            os.replace(path + ".tmp", path)
+        self._map_files()
+
+    def _encode(self, matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Stored rows and their scales, so that stored * scale approximates matrix"""
+        if self.dtype == np.int8:
+            scales = np.abs(matrix).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.rint(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return matrix.astype(self.dtype), np.ones(len(matrix), dtype=np.float32)
+
+    def _decode(self, stored: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        decoded = stored.astype(np.float32)
+        if self.dtype == np.int8:
+            decoded *= scales[:, None]
+        return decoded
+
+    def _rows_for_ids(self, ids: list[str]) -> list[int]:
+        rows: list[int] = []
+        for start in range(0, len(ids), SQL_BATCH):
+            batch = ids[start:start + SQL_BATCH]
+            rows.extend(row for (row,) in self.db.execute(
+                f"SELECT row FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+            ))
+        return rows
+
+    def add(self, documents: list[Document], vectors: list[list[float]], ids: list[str]):
+        if not documents:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        stored, scales = self._encode(matrix)
+        norms = (self._decode(stored, scales) ** 2).sum(axis=1)
+
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is not None and matrix.shape[1] != self.dim:
+                raise ValueError(f"Vectors have {matrix.shape[1]} dimensions, this store holds {self.dim}")
+            # Same upsert semantics as Chroma
+            replaced = self._rows_for_ids(ids)
+
+            start, end = self.size, self.size + len(matrix)
+            if self.vectors is None or end > len(self.vectors):
+                capacity = max(INITIAL_CAPACITY, len(self.alive))
+                while capacity < end:
+                    capacity *= 2
+                self._allocate(capacity, matrix.shape[1])
+            assert self.vectors is not None and self.rows is not None
+            self.vectors[start:end] = stored
+            self.rows[start:end, 0] = norms
+            self.rows[start:end, 1] = scales
+            self.vectors.flush()
+            self.rows.flush()
+
+            # The metadata commit is what makes the rows count
+            with self._transaction():
+                self._delete_rows(replaced)
+                self.db.executemany(
+                    "INSERT INTO chunks (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [
+                        (row, chunk_id, document.page_content, json.dumps(document.metadata))
+                        for row, chunk_id, document in zip(range(start, end), ids, documents)
+                    ]
+                )
+                self._write_state(end)
+            self.version += 1
+            self._forget_rows(replaced)
+            self.alive[start:end] = True
+            for row, document in zip(range(start, end), documents):
+                self._set_columns(row, document.metadata)
+            self.size = end
+            if self._index is not None:
+                self._index.add_items(self._decode(stored, scales), np.arange(start, end))
+
+    def _delete_rows(self, rows: list[int]):
+        """Drop the rows' metadata and log them for other processes, inside the caller's transaction"""
+        for start in range(0, len(rows), SQL_BATCH):
+            batch = rows[start:start + SQL_BATCH]
+            self.db.execute(f"DELETE FROM chunks WHERE row IN ({','.join('?' * len(batch))})", batch)
+        self.db.executemany("INSERT INTO deletions (version, row) VALUES (?, ?)", [(self.version + 1, row) for row in rows])
+
+    def _forget_rows(self, rows: list[int]):
+        """Clear deleted rows from the in-memory mask and graph, once the delete is committed"""
+        if not rows:
+            return
+        self.alive[rows] = False
+        if self._index is not None:
+            for row in rows:
+                try:
+                    self._index.mark_deleted(row)
+                except RuntimeError:
+                    pass  # added by another process after the graph was built, and never indexed here
+
+    def delete(self, ids: list[str]):
+        with self._lock, self._file_lock():
+            self._refresh()
+            self._delete_and_forget(self._rows_for_ids(ids))
+
+    def delete_where(self, filter: dict[str, Any]):
+        with self._lock, self._file_lock():
+            self._refresh()
+            self._delete_and_forget(np.flatnonzero(self.alive[:self.size] & self._filter_mask(filter, self.size)).tolist())
+
+    def _delete_and_forget(self, rows: list[int]):
+        """Delete the rows and commit. Under both locks"""
+        if not rows:
+            return
+        with self._transaction():
+            self._delete_rows(rows)
+            self._write_state(self.size)
+        self.version += 1
+        self._forget_rows(rows)
+
+    def _sql_mask(self, key: str, operator: str, value: Any, size: int) -> np.ndarray:
+        path = '$."' + key.replace('"', '\\"') + '"'
+        if operator in ("$in", "$nin"):
+            values = list(value)
+            sql = (
+                f"SELECT row FROM chunks WHERE json_extract(metadata, ?) "
+                f"{'IN' if operator == '$in' else 'NOT IN'} ({','.join('?' * len(values))})"
+            )
+            params = [path, *values]
+        elif operator in _SQL_OPERATORS:
+            sql = f"SELECT row FROM chunks WHERE json_extract(metadata, ?) {_SQL_OPERATORS[operator]} ?"
+            params = [path, value]
+        else:
+            raise ValueError(f"Unsupported filter operator {operator}")
+        with self._lock:
+            rows = np.fromiter((row for (row,) in self.db.execute(sql, params)), dtype=np.int64)
+        mask = np.zeros(size, dtype=bool)
+        mask[rows[rows < size]] = True
+        return mask
+
+    def _condition_mask(self, key: str, operator: str, value: Any, size: int) -> np.ndarray:
+        values = value if operator in ("$in", "$nin") else [value]
+        if key not in self.columns or not all(_is_int(v) for v in values):
+            return self._sql_mask(key, operator, value, size)
+        column = self.columns[key][:size]
+        if operator == "$in":
+            return np.isin(column, values)
+        if operator == "$nin":
+            return ~np.isin(column, values)
+        if operator not in _NUMPY_OPERATORS:
+            raise ValueError(f"Unsupported filter operator {operator}")
+        return _NUMPY_OPERATORS[operator](column, value)
+
+    def _filter_mask(self, where: dict[str, Any], size: int) -> np.ndarray:
+        """Rows matching a Chroma-style where clause"""
+        masks = []
+        for key, condition in where.items():
+            if key == "$and":
+                masks.append(np.logical_and.reduce([self._filter_mask(clause, size) for clause in condition]))
+            elif key == "$or":
+                masks.append(np.logical_or.reduce([self._filter_mask(clause, size) for clause in condition]))
+            else:
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                masks.extend(
+                    self._condition_mask(key, operator, value, size) for operator, value in condition.items()
+                )
+        return np.logical_and.reduce(masks) if masks else np.ones(size, dtype=bool)
+
+    def _exact_search(
+            self,
+            queries: np.ndarray,
+            k: int,
+            candidates: np.ndarray,
+            vectors: np.ndarray,
+            rows: np.ndarray
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Top k of the candidate rows for each query, one pass over the vectors for them all"""
+        dots = np.empty((len(queries), len(candidates)), dtype=np.float32)
+        contiguous = candidates[-1] - candidates[0] + 1 == len(candidates)
+        if contiguous and self.dtype == np.float32:
+            # A slice of the mapping goes straight to BLAS, no copy
+            dots[:] = queries @ vectors[candidates[0]:candidates[-1] + 1].T
+        else:
+            # Converted a block at a time into one small buffer that stays in cache
+            buffer = np.empty((SEARCH_BLOCK_ROWS, vectors.shape[1]), dtype=np.float32)
+            for start in range(0, len(candidates), SEARCH_BLOCK_ROWS):
+                block_rows = candidates[start:start + SEARCH_BLOCK_ROWS]
+                if contiguous:
+                    block = vectors[block_rows[0]:block_rows[-1] + 1]
+                else:
+                    block = vectors[block_rows]
+                np.copyto(buffer[:len(block)], block)
+                dots[:, start:start + len(block)] = queries @ buffer[:len(block)].T
+        if self.dtype == np.int8:
+            dots *= rows[candidates, 1]
+        distances = rows[candidates, 0] - 2 * dots + (queries ** 2).sum(axis=1)[:, None]
+        np.maximum(distances, 0, out=distances)
+
+        k = min(k, len(candidates))
+        if k < len(candidates):
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(candidates)), (len(queries), len(candidates)))
+        results = []
+        for query_distances, query_top in zip(distances, top):
+            query_top = query_top[np.argsort(query_distances[query_top])]
+            results.append((candidates[query_top], query_distances[query_top]))
+        return results
+
+    def _load_index(self, size: int, vectors: np.ndarray, rows: np.ndarray) -> Any:
+        """
+        The saved HNSW graph, brought up to date with the rows added and deleted
+        since it was saved, or a new one over every live row
+        """
+        import hnswlib
+
+        index = hnswlib.Index(space="l2", dim=vectors.shape[1])  # squared L2, like the exact scan
+        index_path = self._path("hnsw")
+        indexed = 0
+        # The .json is written last, so with it the graph file is complete
+        if os.path.exists(index_path + ".json"):
+            with open(index_path + ".json") as f:
+                indexed = min(json.load(f)["rows"], size)
+            index.load_index(index_path, max_elements=len(vectors))
+            for row in np.flatnonzero(~self.alive[:indexed]).tolist():
+                try:
+                    index.mark_deleted(row)
+                except RuntimeError:
+                    pass  # deleted before the save
+        else:
+            index.init_index(max_elements=len(vectors), ef_construction=100, M=16)
+
+        live = indexed + np.flatnonzero(self.alive[indexed:size])
+        for start in range(0, len(live), SEARCH_BLOCK_ROWS):
+            block = live[start:start + SEARCH_BLOCK_ROWS]
+            index.add_items(self._decode(vectors[block], rows[block, 1]), block)
+        if size > indexed:
+            # Other processes save theirs too, so one at a time
+            with self._file_lock():
+                index.save_index(index_path + ".tmp")
+                os.replace(index_path + ".tmp", index_path)
+                with open(index_path + ".json", "w") as f:
+                    json.dump({"rows": size}, f)
+        return index
+
+    def _hnsw_search(
+            self,
+            index: Any,
+            query: np.ndarray,
+            k: int,
+            mask: Optional[np.ndarray]
+    ) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        index.set_ef(max(64, k))
+        try:
+            labels, distances = index.knn_query(
+                query, k=k, filter=None if mask is None else lambda row: row < len(mask) and bool(mask[row])
+            )
+        except RuntimeError:
+            # Too few matches reachable through the graph, e.g. under a narrow filter
+            return None
+        return labels[0].astype(np.int64), distances[0]
+
+    def search(
+            self,
+            embedding: list[float],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[tuple[Document, float]]:
+        return self.search_many([embedding], k, filter)[0]
+
+    def search_many(
+            self,
+            embeddings: list[list[float]],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[list[tuple[Document, float]]]:
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        while True:
+            with self._lock:
+                self._refresh()
+                generation, size, vectors, rows = self.generation, self.size, self.vectors, self.rows
+                if vectors is None or rows is None or size == 0:
+                    return [[] for _ in embeddings]
+                if self.hnsw and self._index is None:
+                    self._index = self._load_index(size, vectors, rows)
+                index = self._index
+                alive = self.alive[:size].copy()
+            mask = alive if not filter else alive & self._filter_mask(filter, size)
+            candidates = np.flatnonzero(mask)
+            if len(candidates) == 0:
+                return [[] for _ in embeddings]
+
+            found: list[Optional[tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
+            if index is not None and len(candidates) > HNSW_MIN_CANDIDATES:
+                found = [self._hnsw_search(index, query, k, None if not filter else mask) for query in queries]
+            missed = [i for i, result in enumerate(found) if result is None]
+            if missed:
+                for i, result in zip(missed, self._exact_search(queries[missed], k, candidates, vectors, rows)):
+                    found[i] = result
+
+            result_rows = sorted({row for result in found if result is not None for row in result[0].tolist()})
+            with self._lock, self._transaction():
+                if self._read_state()[0] != generation:
+                    continue  # compacted meanwhile, here or in another process, so the row numbers changed
+                records = {
+                    row: (chunk_id, document, metadata)
+                    for row, chunk_id, document, metadata in self.db.execute(
+                        f"SELECT row, id, document, metadata FROM chunks WHERE row IN ({','.join('?' * len(result_rows))})",
+                        result_rows
+                    )
+                }
+
+            results: list[list[tuple[Document, float]]] = []
+            for result in found:
+                assert result is not None
+                hits: list[tuple[Document, float]] = []
+                for row, distance in zip(result[0].tolist(), result[1].tolist()):
+                    if row not in records:
+                        continue  # deleted since the scan
+                    chunk_id, document, metadata = records[row]
+                    hits.append((Document(id=chunk_id, page_content=document, metadata=json.loads(metadata)), distance))
+                results.append(hits)
+            return results
+
+    def compact(self):
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.vectors is None or self.rows is None:
+                return
+            live = np.flatnonzero(self.alive[:self.size])
+            if len(live) == self.size:
+                return
+
+            generation = self.generation + 1
+            capacity = INITIAL_CAPACITY
+            while capacity < len(live):
+                capacity *= 2
+            vectors = np.lib.format.open_memmap(
+                self._path("vectors", generation), mode="w+", dtype=self.dtype, shape=(capacity, self.vectors.shape[1])
+            )
+            rows = np.lib.format.open_memmap(
+                self._path("rows", generation), mode="w+", dtype=np.float32, shape=(capacity, 2)
+            )
+            for start in range(0, len(live), SEARCH_BLOCK_ROWS):
+                block = live[start:start + SEARCH_BLOCK_ROWS]
+                vectors[start:start + len(block)] = self.vectors[block]
+                rows[start:start + len(block)] = self.rows[block]
+            vectors.flush()
+            rows.flush()
+
+            # Every row moves down, so renumbering in ascending order never collides
+            with self._transaction():
+                self.db.executemany(
+                    "UPDATE chunks SET row = ? WHERE row = ?",
+                    [(new, old) for new, old in enumerate(live.tolist()) if new != old]
+                )
+                self.db.execute("DELETE FROM deletions")
+                self._write_state(len(live), generation)
+
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:len(live)] = True
+            columns = {key: np.full(capacity, -1, dtype=np.int64) for key in COLUMNS}
+            for key, column in columns.items():
+                column[:len(live)] = self.columns[key][live]
+            self.vectors, self.rows, self.alive, self.columns = vectors, rows, alive, columns
+            self.size = len(live)
+            self.generation = generation
+            self.version += 1
+            self._mapped = self._inodes()
+            # Rebuilt over the live rows on the next search
+            self._index = None
+            self._remove_files(keep=generation)
@@ -0,0 +1,168 @@
+"""
+The shared LLM client: one pooled HTTP client and one compiled chain for every
+request, a per-worker cap on LLM calls in flight, and retries for rate limits
+and upstream failures.
+"""
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional
+from app.core.exceptions import ServiceOverloadedException
+from app.core.metrics import LLM_REJECTED, LLM_RETRIES, timed
+
+if TYPE_CHECKING:
+    import httpx
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.runnables import Runnable, RunnableConfig
+
+
+def build_chat_model(
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_connections: int = 100,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0
+) -> tuple["BaseChatModel", "httpx.AsyncClient"]:
+    """
+    A streaming ChatOpenAI on a keep-alive connection pool, and that pool's client
+    to close on shutdown. Its own retries are off, LLMRunner retries instead
+    """
+    import httpx
+    # Deferred, langchain_openai is slow to import
+    from langchain_openai import ChatOpenAI
+    from pydantic import SecretStr
+
+    # read applies between streamed chunks, so long answers don't time out as a whole
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    http_client = httpx.AsyncClient(
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    )
+    llm = ChatOpenAI(
+        api_key=SecretStr(api_key),
+        base_url=base_url,
+        streaming=True,
+        timeout=timeout,
+        max_retries=0,
+        http_async_client=http_client
+    )
+    return llm, http_client
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the LLM calls in flight. Up to max_queued more wait for a free slot, for at
+    most queue_timeout seconds; past either limit a call fails fast with a 503
+    rather than piling up behind a slow or rate-limited API
+    """
+
+    def __init__(self, limit: int, max_queued: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self._queued = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        if self._semaphore.locked() and self._queued >= self.max_queued:
+            LLM_REJECTED.inc()
+            raise ServiceOverloadedException("Too many questions are being answered, try again shortly")
+
+        self._queued += 1
+        try:
+            with timed("llm_queue"):
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            LLM_REJECTED.inc()
+            raise ServiceOverloadedException("Timed out waiting to reach the LLM, try again shortly")
+        finally:
+            self._queued -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors, timeouts and dropped connections, but not a spent quota"""
+    import httpx
+    import openai
+
+    # httpx errors surface unwrapped once the response is streaming
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        if error.code == "insufficient_quota":
+            return False
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class LLMRunner:
+    """
+    Streams a compiled chain's output under the shared concurrency limit. A call
+    that fails with a retryable error before anything was streamed is retried up
+    to max_retries times, after a full-jitter exponential backoff (or the API's
+    Retry-After, if longer), so callers that failed together don't retry together
+    """
+
+    def __init__(
+            self,
+            llm: "BaseChatModel",
+            chain: "Runnable[dict[str, Any], str]",
+            limiter: ConcurrencyLimiter,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 8.0
+    ):
+        self.llm = llm
+        self.chain = chain
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    async def astream(
+            self,
+            inputs: dict[str, Any],
+            config: Optional["RunnableConfig"] = None
+    ) -> AsyncIterator[str]:
+        async with self.limiter.slot():
+            attempt = 0
+            while True:
+                streamed = False
+                try:
+                    async for token in self.chain.astream(inputs, config=config):
+                        # The API opens with an empty chunk, a retry is still safe after it
+                        streamed = streamed or bool(token)
+                        yield token
+                    return
+                except Exception as e:
+                    # Once tokens are out a retry would repeat them, so only retry a failed start
+                    if streamed or attempt >= self.max_retries or not is_retryable(e):
+                        raise
+                    LLM_RETRIES.inc()
+                    await asyncio.sleep(self.backoff(attempt, e))
+                    attempt += 1
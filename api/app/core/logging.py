@@ -6,5 +6,6 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger("PaperTrail")
-# Set up logging for SQLAlchemy
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
\ No newline at end of file
+# SQLAlchemy's own statement logging formats every query on the hot path, so keep it
+# quiet. Slow and sampled statements are logged from app.core.database instead
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""
+In-process metrics, served at /metrics in the Prometheus text format so any
+scraper (or curl) can read them without a collector or client library.
+Each worker process keeps its own, so scrape every worker.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Seconds, from a cache hit up to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        # Without labels there is one series, reported as 0 before the first increment
+        self._values: dict[tuple[str, ...], float] = {} if labelnames else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: count in each bucket (not cumulative), sum and total count
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, (total, count)) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {int(count)}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {int(count)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, description: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, description, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+            self,
+            name: str,
+            description: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, description, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "papertrail_stage_seconds",
+    "Time spent in each stage of serving a request or ingesting an upload",
+    ("stage",)
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "papertrail_http_request_seconds",
+    "HTTP request latency until the response body is complete",
+    ("method", "route", "status")
+)
+DB_QUERY_SECONDS = registry.histogram(
+    "papertrail_db_query_seconds",
+    "SQL statement execution time"
+)
+DB_SLOW_QUERIES = registry.counter(
+    "papertrail_db_slow_queries_total",
+    "SQL statements slower than SLOW_QUERY_MS"
+)
+LLM_TOKENS = registry.counter(
+    "papertrail_llm_tokens_total",
+    "Tokens streamed back by the LLM"
+)
+LLM_RETRIES = registry.counter(
+    "papertrail_llm_retries_total",
+    "LLM calls retried after a rate limit, server error or connection failure"
+)
+LLM_REJECTED = registry.counter(
+    "papertrail_llm_rejected_total",
+    "LLM calls refused with a 503 because too many were already waiting"
+)
+ASK_GENERATIONS = registry.counter(
+    "papertrail_ask_generations_total",
+    "Retrievals and LLM generations started for questions the answer cache missed"
+)
+ASK_COALESCED = registry.counter(
+    "papertrail_ask_coalesced_total",
+    "Questions answered by joining an identical question's generation already in flight"
+)
+CACHE_LOOKUPS = registry.counter(
+    "papertrail_cache_lookups_total",
+    "Lookups in the in-process caches, by cache and whether they hit",
+    ("cache", "result")
+)
+
+
+def timed(stage: str):
+    """Record the duration of the block under papertrail_stage_seconds{stage=...}"""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request until its last body chunk is sent, so streamed answers
+    count in full. Plain ASGI rather than BaseHTTPMiddleware, which would buffer
+    the stream through an extra task
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = "500"
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The route template, not the raw path, so IDs don't create a series each
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status
+            )
@@ -1,11 +1,17 @@
-from typing import Any, Literal, TypedDict
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Literal, Optional, TypedDict, TypeVar
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from jwt import encode, decode, PyJWTError # type: ignore
 from datetime import datetime, timedelta, timezone
 from app.core.config import settings
+from app.core.exceptions import ServiceOverloadedException
 import uuid
 
+T = TypeVar("T")
+
 
 class JWTPayload(TypedDict):
     jti: uuid.UUID # Unique ID
@@ -19,14 +25,74 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Pinning min and max to the configured cost makes any other cost "needs update",
+# so changing BCRYPT_ROUNDS (up or down) rehashes on the next successful login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login", refreshUrl="auth/refresh")
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+class PasswordHasher:
+    """
+    Runs bcrypt on its own small thread pool (bcrypt releases the GIL), so a burst of
+    logins can't take over the shared threadpool the document endpoints run on.
+    Once max_pending hashes are running or queued, new ones fail fast with a 503.
+    The pool starts on first use, and again after shutdown
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(pwd_context.verify, plain_password, hashed_password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+        """(valid, new hash) where the new hash is set when the stored one uses an outdated cost"""
+        return await self._run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+    def shutdown(self):
+        """Stop the pool's threads, cancelling the hashes still queued"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise ServiceOverloadedException("Too many authentication requests, try again shortly")
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+            executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
 
 def create_jwt_token(data: dict[str, Any], expires_delta: timedelta | None = None):
     now = datetime.now(timezone.utc)
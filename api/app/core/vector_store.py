@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, Optional
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+
+def collection_name(owner: str) -> str:
+    """Chroma only accepts [a-zA-Z0-9._-] names, so derive one from the username (also a safe directory name)"""
+    return f"user-{hashlib.sha256(owner.encode()).hexdigest()[:32]}"
+
+
+class VectorStore(ABC):
+    """One user's chunks, searchable by embedding"""
+
+    embeddings: Embeddings
+
+    @abstractmethod
+    def add(self, documents: list[Document], vectors: list[list[float]], ids: list[str]):
+        """Write chunks whose vectors were computed already, replacing any with the same ids"""
+
+    @abstractmethod
+    def search(
+            self,
+            embedding: list[float],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[tuple[Document, float]]:
+        """
+        The k nearest chunks and their squared L2 distances, nearest first.
+        filter takes Chroma's where syntax, e.g. {"document_id": {"$in": [1, 2]}}
+        """
+
+    def search_many(
+            self,
+            embeddings: list[list[float]],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[list[tuple[Document, float]]]:
+        """search() for several queries under the same filter"""
+        return [self.search(embedding, k, filter) for embedding in embeddings]
+
+    @abstractmethod
+    def delete(self, ids: list[str]):
+        ...
+
+    async def adelete(self, ids: list[str]):
+        await asyncio.get_running_loop().run_in_executor(None, self.delete, ids)
+
+    @abstractmethod
+    def delete_where(self, filter: dict[str, Any]):
+        """Delete every chunk matching filter, in search()'s where syntax"""
+
+    async def adelete_where(self, filter: dict[str, Any]):
+        await asyncio.get_running_loop().run_in_executor(None, self.delete_where, filter)
+
+    @abstractmethod
+    def count(self) -> int:
+        """Live chunks"""
+
+    def deleted_count(self) -> int:
+        """Deleted chunks still taking up space in the index until compact()"""
+        return 0
+
+    def compact(self):
+        """Reclaim the space of deleted chunks and rebuild the index over the live ones"""
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, store: "Chroma"):
+        self.store = store
+        self.embeddings = store.embeddings  # type: ignore
+
+    def add(self, documents: list[Document], vectors: list[list[float]], ids: list[str]):
+        # Chroma.add_documents always embeds, so this goes to the collection directly
+        self.store._collection.upsert(
+            ids=ids,
+            embeddings=vectors, # type: ignore
+            documents=[document.page_content for document in documents],
+            metadatas=[document.metadata for document in documents]
+        )
+
+    def search(
+            self,
+            embedding: list[float],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[tuple[Document, float]]:
+        return self.store.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter)
+
+    def search_many(
+            self,
+            embeddings: list[list[float]],
+            k: int,
+            filter: Optional[dict[str, Any]] = None
+    ) -> list[list[tuple[Document, float]]]:
+        # One query call for all of them, which the LangChain wrapper doesn't expose
+        results = self.store._collection.query(
+            query_embeddings=embeddings,  # type: ignore
+            n_results=k,
+            where=filter,
+            include=["documents", "metadatas", "distances"]  # type: ignore
+        )
+        return [
+            [
+                (Document(page_content=document or "", metadata=dict(metadata or {}), id=chunk_id), distance)
+                for document, metadata, chunk_id, distance in zip(
+                    results["documents"][i], results["metadatas"][i], results["ids"][i], results["distances"][i]  # type: ignore
+                )
+            ]
+            for i in range(len(embeddings))
+        ]
+
+    def delete(self, ids: list[str]):
+        self.store.delete(ids)
+
+    def delete_where(self, filter: dict[str, Any]):
+        self.store._collection.delete(where=filter)  # type: ignore
+
+    def count(self) -> int:
+        return self.store._collection.count()
+
+    # Chroma drops deleted records from its tables and reuses their slots in the
+    # HNSW index by itself, so deleted_count() and compact() keep the no-op defaults
+
+
+class TenantVectorStores:
+    """
+    One store per user: a Chroma collection on a shared client, or a directory
+    of memory-mapped vectors (app/core/flat_vector_store.py) with backend="flat".
+    A query only ever searches the caller's own chunks, so its latency
+    doesn't grow with other users' data
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            persist_directory: str,
+            host: Optional[str] = None,
+            port: int = 8000,
+            backend: str = "chroma",
+            dtype: str = "float32",
+            hnsw: bool = False
+    ):
+        self.embeddings = embeddings
+        self.persist_directory = persist_directory
+        self.backend = backend
+        self.dtype = dtype
+        self.hnsw = hnsw
+        self.client: Any = None
+        if backend == "chroma":
+            import chromadb
+
+            if host:
+                # Several workers can share one Chroma server, rather than each
+                # opening its own client on the same directory
+                self.client = chromadb.HttpClient(host=host, port=port)
+            else:
+                self.client = chromadb.PersistentClient(path=persist_directory)
+        elif backend != "flat":
+            raise ValueError(f"Unknown vector store backend {backend!r}, expected 'chroma' or 'flat'")
+        self._stores: dict[str, VectorStore] = {}
+        self._lock = threading.Lock()
+
+    def _open(self, owner: str) -> VectorStore:
+        if self.backend == "flat":
+            from app.core.flat_vector_store import FlatVectorStore
+
+            return FlatVectorStore(
+                os.path.join(self.persist_directory, collection_name(owner)),
+                self.embeddings,
+                dtype=self.dtype,
+                hnsw=self.hnsw
+            )
+
+        from langchain_chroma import Chroma
+
+        return ChromaVectorStore(
+            Chroma(collection_name=collection_name(owner), embedding_function=self.embeddings, client=self.client)
+        )
+
+    def for_owner(self, owner: str) -> VectorStore:
+        store = self._stores.get(owner)
+        if store is None:
+            with self._lock:
+                store = self._stores.get(owner)
+                if store is None:
+                    store = self._stores[owner] = self._open(owner)
+        return store
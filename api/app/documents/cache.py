@@ -0,0 +1,141 @@
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+from app.core.metrics import CACHE_LOOKUPS
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+@dataclass
+class CachedAnswer:
+    owner: str
+    scope: str
+    answer: str
+    sources: list[str]
+    expires_at: float
+    embedding: Optional["np.ndarray"] = field(default=None, repr=False)
+
+
+class AnswerCache:
+    """
+    Two-level cache of generated answers.
+    Exact hits match on the normalized question; when semantic_threshold is set,
+    questions whose embedding has at least that cosine similarity to a cached one
+    also hit. Entries are scoped to the owner's corpus and its version, so an upload
+    only invalidates that user's answers. The version is kept in the database, shared
+    by every worker, and each worker's cache catches up with it through
+    set_corpus_version, within CORPUS_STATE_TTL_SECONDS.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float, semantic_threshold: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.semantic_threshold = semantic_threshold
+        self.corpus_versions: dict[str, int] = {}  # as last read from the database
+        self._entries: OrderedDict[tuple[str, int, str, str], CachedAnswer] = OrderedDict()
+
+    def corpus_version(self, owner: str) -> int:
+        return self.corpus_versions.get(owner, 0)
+
+    def set_corpus_version(self, owner: str, version: int):
+        """
+        The owner's corpus is at `version`. If it moved on, their indexed documents
+        changed, here or in another worker, so their cached answers are stale
+        """
+        # Versions only grow, so a slower read of an older one changes nothing
+        if version <= self.corpus_version(owner):
+            return
+        self.corpus_versions[owner] = version
+        for key in [key for key, entry in self._entries.items() if entry.owner == owner]:
+            del self._entries[key]
+
+    def get(
+            self,
+            owner: str,
+            scope: str,
+            question: str,
+            embedding: Optional[list[float]] = None
+    ) -> Optional[CachedAnswer]:
+        self._evict_expired()
+        key = self.key(owner, scope, question)
+        entry = self._entries.get(key)
+
+        if entry is None and embedding is not None and self.semantic_threshold is not None:
+            entry = self._nearest(owner, scope, embedding)
+
+        if entry is None:
+            CACHE_LOOKUPS.inc(cache="answer", result="miss")
+            return None
+
+        CACHE_LOOKUPS.inc(cache="answer", result="hit")
+        return entry
+
+    def put(
+            self,
+            owner: str,
+            scope: str,
+            question: str,
+            answer: str,
+            sources: list[str],
+            embedding: Optional[list[float]] = None,
+            corpus_version: Optional[int] = None
+    ):
+        # Don't cache an answer generated against a corpus that changed mid-request
+        if corpus_version is not None and corpus_version != self.corpus_version(owner):
+            return
+
+        key = self.key(owner, scope, question)
+        self._entries[key] = CachedAnswer(
+            owner=owner,
+            scope=scope,
+            answer=answer,
+            sources=sources,
+            expires_at=time.monotonic() + self.ttl_seconds,
+            embedding=self._unit(embedding) if embedding is not None else None
+        )
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def key(self, owner: str, scope: str, question: str) -> tuple[str, int, str, str]:
+        """Identifies a question within the owner's current corpus, also used to coalesce identical questions"""
+        return (owner, self.corpus_version(owner), scope, normalize_question(question))
+
+    def _unit(self, embedding: list[float]) -> "np.ndarray":
+        import numpy as np
+
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _nearest(self, owner: str, scope: str, embedding: list[float]) -> Optional[CachedAnswer]:
+        candidates = [
+            entry for entry in self._entries.values()
+            if entry.embedding is not None and entry.owner == owner and entry.scope == scope
+        ]
+        if not candidates:
+            return None
+
+        import numpy as np
+        similarities = np.stack([entry.embedding for entry in candidates]) @ self._unit(embedding) # type: ignore
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_threshold:
+            return None
+        return candidates[best]
+
+    def _evict_expired(self):
+        # Entries are kept in write order and share one TTL, so the oldest expire first
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            del self._entries[key]
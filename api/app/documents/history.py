@@ -0,0 +1,151 @@
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Optional, Sequence
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+from app.core.database import ChatSession, Message, SessionLocal
+from app.core.exceptions import SessionNotFoundException
+from app.core.metrics import CACHE_LOOKUPS, timed
+
+
+class HistoryWindowCache:
+    """
+    Keeps the last `window_size` messages of the most recently used sessions in memory.
+    Writes go through to the database first, then update the window.
+    Each worker process has its own windows, so a session's turns should be
+    served by one worker (e.g. sticky sessions) for the window to stay current
+    """
+
+    def __init__(self, window_size: int, max_sessions: int):
+        self.window_size = window_size
+        self.max_sessions = max_sessions
+        self._windows: OrderedDict[str, deque[BaseMessage]] = OrderedDict()
+        # Owner of each windowed session, None until its first message is written
+        self._owners: dict[str, Optional[str]] = {}
+        # Shared by every request this process handles
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, owner: str, limit: int) -> Optional[list[BaseMessage]]:
+        """The last `limit` messages, or None if they aren't all in memory for this owner"""
+        with self._lock:
+            window = self._windows.get(session_id)
+            if window is None or limit > self.window_size or self._owners.get(session_id) not in (None, owner):
+                CACHE_LOOKUPS.inc(cache="history_window", result="miss")
+                return None
+            CACHE_LOOKUPS.inc(cache="history_window", result="hit")
+            self._windows.move_to_end(session_id)
+            return list(window)[-limit:] if limit > 0 else []
+
+    def load(self, session_id: str, owner: Optional[str], messages: Sequence[BaseMessage]):
+        """Seed the window with the session's latest messages read from the database"""
+        with self._lock:
+            self._windows[session_id] = deque(messages, maxlen=self.window_size)
+            self._owners[session_id] = owner
+            self._windows.move_to_end(session_id)
+            while len(self._windows) > self.max_sessions:
+                evicted, _ = self._windows.popitem(last=False)
+                self._owners.pop(evicted, None)
+
+    def append(self, session_id: str, owner: str, messages: Sequence[BaseMessage]):
+        with self._lock:
+            window = self._windows.get(session_id)
+            if window is not None:
+                window.extend(messages)
+                self._owners[session_id] = owner
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._windows.pop(session_id, None)
+            self._owners.pop(session_id, None)
+
+
+class LimitedSQLChatMessageHistory:
+    """
+    Chat history in the message_store table, read and written through the
+    application's async engine and connection pool. Returns the last `limit`
+    messages, from the in-memory window when possible.
+    Every write also keeps the session's row in the sessions table current;
+    a session belongs to the user who wrote its first message.
+    Async only, with the method names of LangChain's BaseChatMessageHistory
+    """
+
+    def __init__(self, session_id: str, owner: str, window: HistoryWindowCache, limit: int = 5):
+        self.session_id = session_id
+        self.owner = owner
+        self.window = window
+        self.limit = limit
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        """Retrieve the last N messages, oldest first"""
+        with timed("history_read"):
+            cached = self.window.get(self.session_id, self.owner, self.limit)
+            if cached is not None:
+                return cached
+
+            async with SessionLocal() as session:
+                chat_session = await session.get(ChatSession, self.session_id)
+                if chat_session is not None and chat_session.owner != self.owner:
+                    raise SessionNotFoundException()
+
+                stmt = (
+                    select(Message).where(Message.session_id == self.session_id)
+                    .order_by(Message.id.desc()).limit(max(self.limit, self.window.window_size))
+                )
+                records = list(reversed((await session.scalars(stmt)).all()))
+
+            messages = messages_from_dict([json.loads(record.message) for record in records])
+            self.window.load(self.session_id, chat_session.owner if chat_session else None, messages)
+            return messages[-self.limit:] if self.limit > 0 else []
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Store a whole turn (question and answer) and update its session row in one transaction"""
+        with timed("history_write"):
+            for attempt in range(2):
+                now = datetime.now(timezone.utc)
+                async with SessionLocal() as session:
+                    updated = (await session.execute(
+                        update(ChatSession)
+                        .where(ChatSession.session_id == self.session_id, ChatSession.owner == self.owner)
+                        .values(updated_at=now, message_count=ChatSession.message_count + len(messages))
+                    )).rowcount
+                    if not updated:
+                        # Count messages written before the sessions table existed
+                        existing = await session.scalar(
+                            select(func.count()).select_from(Message).where(Message.session_id == self.session_id)
+                        ) or 0
+                        session.add(ChatSession(
+                            session_id=self.session_id,
+                            owner=self.owner,
+                            created_at=now,
+                            updated_at=now,
+                            message_count=existing + len(messages)
+                        ))
+                    session.add_all([
+                        Message(session_id=self.session_id, message=json.dumps(message_to_dict(message)))
+                        for message in messages
+                    ])
+                    try:
+                        await session.commit()
+                        break
+                    except IntegrityError:
+                        # The row exists: either another user's session, or a concurrent first write
+                        await session.rollback()
+                        chat_session = await session.get(ChatSession, self.session_id)
+                        if attempt or chat_session is None or chat_session.owner != self.owner:
+                            raise SessionNotFoundException()
+
+            self.window.append(self.session_id, self.owner, messages)
+
+    async def aclear(self) -> None:
+        async with SessionLocal() as session:
+            chat_session = await session.get(ChatSession, self.session_id)
+            if chat_session is None or chat_session.owner != self.owner:
+                raise SessionNotFoundException()
+            await session.execute(delete(Message).where(Message.session_id == self.session_id))
+            await session.delete(chat_session)
+            await session.commit()
+
+        self.window.invalidate(self.session_id)
@@ -0,0 +1,602 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional, Sequence
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.core.database import Corpus, DocumentRecord, IngestJob, SessionLocal
+from app.core.logging import logger
+from app.core.metrics import CACHE_LOOKUPS, STAGE_SECONDS, timed
+from app.documents.cache import AnswerCache
+from app.documents.models import FileIngestStatus, IngestJobResponse
+
+if TYPE_CHECKING:
+    # Keeps the vector store backends out of the spawned parsing workers
+    from app.core.vector_store import TenantVectorStores
+
+
+@dataclass
+class SavedUpload:
+    filename: str
+    path: str
+    content_hash: str  # SHA-256 of the file contents
+    document_id: Optional[int] = None  # registry entry the chunks are indexed under
+    is_new: bool = False  # False when replacing an older version of the same file
+    content_type: Optional[str] = None  # sniffed from the contents
+    already_indexed: bool = False
+    version: Optional[int] = None  # numbers the chunks, in the order versions were registered
+    begun_at: float = 0.0  # time.monotonic() when the version was numbered
+
+
+def count_pages(upload_path: str) -> Optional[int]:
+    """
+    Number of pages of a PDF, so it can be parsed a window of pages at a time.
+    None for other formats, or a PDF pypdf can't read, which are parsed whole
+    """
+    if not upload_path.lower().endswith(".pdf"):
+        return None
+    try:
+        from pypdf import PdfReader
+
+        return len(PdfReader(upload_path).pages)
+    except Exception as e:
+        logger.warning(f"Could not count the pages of {upload_path}, parsing it whole: {e}")
+        return None
+
+
+def _extract_pages(upload_path: str, first: int, last: int) -> str:
+    """Copy pages [first, last) of a PDF into a temporary file"""
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(upload_path)
+    writer = PdfWriter()
+    for page in reader.pages[first:last]:
+        writer.add_page(page)
+    fd, window_path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        writer.write(f)
+    return window_path
+
+
+def parse_and_split(
+        upload_path: str,
+        text_splitter: Any,
+        pages: Optional[tuple[int, int]] = None
+) -> tuple[list[Any], float, float]:
+    """
+    Parse a saved upload, or only pages [first, last) of a PDF, and split it into chunks.
+    Elements are split as they're loaded, so only one window's elements and chunks are
+    held at once. Runs inside the ingestion process pool, so it only takes picklable
+    arguments. Returns the chunks with the seconds spent parsing and splitting, for the metrics
+    """
+    from langchain_unstructured import UnstructuredLoader
+    from langchain_community.vectorstores.utils import filter_complex_metadata #type: ignore
+
+    started = time.perf_counter()
+    window_path = None
+    if pages is None:
+        loader = UnstructuredLoader(upload_path)
+    else:
+        window_path = _extract_pages(upload_path, *pages)
+        loader = UnstructuredLoader(window_path, starting_page_number=pages[0] + 1)
+
+    chunks: list[Any] = []
+    split_seconds = 0.0
+    try:
+        for element in loader.lazy_load():
+            if window_path is not None:
+                # Point back at the upload rather than the temporary window file
+                element.metadata["source"] = upload_path
+                for key in ("filename", "file_directory", "last_modified"):
+                    element.metadata.pop(key, None)
+            split_started = time.perf_counter()
+            # split_documents splits each element on its own, so this matches splitting them all at the end
+            chunks.extend(text_splitter.split_documents([element]))
+            split_seconds += time.perf_counter() - split_started
+    finally:
+        if window_path is not None:
+            os.remove(window_path)
+
+    chunks = filter_complex_metadata(chunks)
+    return chunks, time.perf_counter() - started - split_seconds, split_seconds
+
+
+def version_path(document_id: int, filename: str) -> str:
+    """Where to save a version of a document: a directory of its own, so it never overwrites the one being served"""
+    return os.path.join(settings.UPLOAD_DIR, str(document_id), uuid.uuid4().hex, os.path.basename(filename))
+
+
+def remove_version(path: str):
+    """Delete a saved version's file, with its directory unless it predates them"""
+    directory = os.path.dirname(path)
+    if os.path.normpath(os.path.dirname(directory)) == os.path.normpath(settings.UPLOAD_DIR):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@dataclass
+class CorpusState:
+    """An owner's corpus row: how many times their indexed documents changed, and the versions searches skip"""
+    version: int = 0
+    pending: list[int] = field(default_factory=list)  # being indexed
+    retired: list[int] = field(default_factory=list)  # replaced or deleted, their chunks not yet purged
+
+    @property
+    def hidden(self) -> list[int]:
+        return self.pending + self.retired
+
+
+async def load_corpus_state(db: AsyncSession, owner: str) -> CorpusState:
+    """The owner's corpus as every worker sees it, in one read"""
+    row = (await db.execute(
+        select(Corpus.version, Corpus.pending, Corpus.retired).where(Corpus.owner == owner)
+    )).one_or_none()
+    if row is None:
+        return CorpusState()
+    return CorpusState(row.version, json.loads(row.pending or "[]"), json.loads(row.retired or "[]"))
+
+
+async def ensure_corpus(owner: str):
+    """Create the owner's corpus row, so change_corpus can update it in place"""
+    async with SessionLocal() as db:
+        if await db.get(Corpus, owner) is not None:
+            return
+        db.add(Corpus(owner=owner))
+        with contextlib.suppress(IntegrityError):
+            await db.commit()  # else created concurrently
+
+
+async def change_corpus(
+        db: AsyncSession,
+        owner: str,
+        begin: bool = False,
+        finish: Optional[int] = None,
+        retire: Optional[int] = None,
+        purged: Sequence[int] = ()
+) -> CorpusState:
+    """
+    Record a change to the owner's indexed documents in the caller's transaction,
+    returning the corpus as changed. begin marks that version as a document version
+    being indexed; finish stops marking one; retire hides a version until its chunks
+    are purged, and purged stops hiding those that were
+    """
+    # Incremented in the database, which also locks the row until the caller commits,
+    # so concurrent changes from several workers all count
+    row = (await db.execute(
+        update(Corpus).where(Corpus.owner == owner).values(version=Corpus.version + 1)
+        .returning(Corpus.version, Corpus.pending, Corpus.retired)
+    )).one()
+    pending = [version for version in json.loads(row.pending or "[]") if version != finish]
+    if begin:
+        pending.append(row.version)
+    retired = [version for version in json.loads(row.retired or "[]") if version not in purged]
+    if retire is not None:
+        retired.append(retire)
+    await db.execute(
+        update(Corpus).where(Corpus.owner == owner).values(pending=json.dumps(pending), retired=json.dumps(retired))
+    )
+    return CorpusState(row.version, pending, retired)
+
+
+class CorpusStates:
+    """
+    Each owner's corpus as this worker last read or changed it, trusted for ttl_seconds
+    so most questions skip the database. Changes made here show at once, those made
+    by other workers within the TTL, which writers wait out where it matters
+    """
+
+    def __init__(self, answer_cache: AnswerCache, ttl_seconds: float):
+        self.answer_cache = answer_cache
+        self.ttl_seconds = ttl_seconds
+        self._states: dict[str, tuple[CorpusState, float]] = {}  # owner -> (state, when read)
+
+    async def get(self, owner: str) -> CorpusState:
+        cached = self._states.get(owner)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl_seconds:
+            CACHE_LOOKUPS.inc(cache="corpus_state", result="hit")
+            return cached[0]
+        CACHE_LOOKUPS.inc(cache="corpus_state", result="miss")
+        # Its own session, as streamed answers read it after the request's session is closed
+        async with SessionLocal() as db:
+            return self.changed(owner, await load_corpus_state(db, owner))
+
+    def changed(self, owner: str, state: CorpusState) -> CorpusState:
+        """
+        Keep a state just read or written, unless a newer one is already known, and
+        drop the owner's cached answers if it moved on. Returns the newest state
+        """
+        cached = self._states.get(owner)
+        if cached is None or state.version >= cached[0].version:
+            cached = self._states[owner] = (state, time.monotonic())
+        self.answer_cache.set_corpus_version(owner, cached[0].version)
+        return cached[0]
+
+    async def begin(self, owner: str) -> int:
+        """
+        Number a new document version, hidden from searches until it's switched to. Versions
+        of the same document registered later get higher numbers, whichever is indexed first
+        """
+        await ensure_corpus(owner)
+        async with SessionLocal() as db:
+            state = await change_corpus(db, owner, begin=True)
+            await db.commit()
+        self.changed(owner, state)
+        return state.version
+
+    async def retire(self, owner: str, version: int):
+        """Hide a version that won't be switched to, until its chunks are purged"""
+        async with SessionLocal() as db:
+            state = await change_corpus(db, owner, finish=version, retire=version)
+            await db.commit()
+        self.changed(owner, state)
+
+
+@dataclass
+class ReplacedVersion:
+    """What a switch left behind for the caller to remove"""
+    corpus: CorpusState
+    chunk_ids: list[str]  # to delete by ID, for a version indexed before chunks carried one
+    path: Optional[str]  # its file
+
+
+async def record_document(upload: SavedUpload, owner: str, chunk_ids: list[str]) -> Optional[ReplacedVersion]:
+    """
+    Switch the document over to its freshly indexed version, in one commit that points
+    the registry entry at the new chunks and file, reveals them and retires the old
+    version. Returns what's left of the old version to remove, or None if the upload
+    can't be switched to: identical content was registered concurrently, a version
+    registered after it was switched to first, or the document was deleted. Its
+    version is then retired instead
+    """
+    assert upload.version is not None
+    async with SessionLocal() as db:
+        record = await db.get(DocumentRecord, upload.document_id)
+        if record is None or (record.version is not None and record.version > upload.version):
+            return None
+
+        replaced = ReplacedVersion(CorpusState(), [] if record.version is not None else json.loads(record.chunk_ids), None)
+        # Whether or not this upload created the entry: a version uploaded under the
+        # same name while it was being indexed may have been switched to meanwhile
+        if record.path is not None:
+            replaced.path = record.path
+        elif replaced.chunk_ids:
+            replaced.path = os.path.join(settings.UPLOAD_DIR, str(record.id), os.path.basename(record.filename))
+        replaced.corpus = await change_corpus(db, owner, finish=upload.version, retire=record.version)
+        record.content_hash = upload.content_hash
+        record.chunk_ids = json.dumps(chunk_ids)
+        record.path = upload.path
+        record.version = upload.version
+        record.created_at = datetime.now(timezone.utc)
+
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            return None
+        return replaced
+
+
+async def discard_document(document_id: int):
+    """Drop the registry entry of a new upload that failed to index, unless another version was indexed under it"""
+    async with SessionLocal() as db:
+        record = await db.get(DocumentRecord, document_id)
+        if record is not None and record.path is None and record.chunk_ids == "[]":
+            await db.delete(record)
+            await db.commit()
+
+
+class IngestionEngine:
+    """
+    Runs uploads in the background: parsing and chunking fan out over a process pool
+    sized to the cores, then embedding and writing to the vector store run as a
+    separate, bounded stage on the event loop. Each job's progress is saved to the
+    database as it changes, so every worker can report on it
+    """
+
+    def __init__(self, vector_stores: "TenantVectorStores", text_splitter: Any, answer_cache: AnswerCache):
+        self.vector_stores = vector_stores
+        self.text_splitter = text_splitter
+        self.answer_cache = answer_cache
+        self.corpus_states = CorpusStates(answer_cache, settings.CORPUS_STATE_TTL_SECONDS)
+        # Spawned workers don't inherit the parent's loaded models and threads
+        self.pool = ProcessPoolExecutor(
+            max_workers=settings.INGEST_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self.embed_semaphore = asyncio.Semaphore(settings.INGEST_EMBED_CONCURRENCY)
+        # Jobs running in this worker, read from memory for the latest progress
+        self.jobs: dict[str, IngestJobResponse] = {}
+        self.owners: dict[str, str] = {}
+        self._saving: dict[str, asyncio.Lock] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._compacting: set[str] = set()
+
+    async def submit(self, owner: str, uploads: list[SavedUpload]) -> IngestJobResponse:
+        """Queue saved uploads for ingestion and return the new job"""
+        job = IngestJobResponse(
+            job_id=str(uuid.uuid4()),
+            status="running",
+            files=[
+                FileIngestStatus(
+                    filename=upload.filename,
+                    content_type=upload.content_type,
+                    status="already_indexed" if upload.already_indexed else "queued"
+                )
+                for upload in uploads
+            ],
+            created_at=datetime.now(timezone.utc)
+        )
+        self.jobs[job.job_id] = job
+        self.owners[job.job_id] = owner
+        await self._save(job, owner)
+
+        task = asyncio.create_task(self._run(job, owner, uploads))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def purge_retired(self, owner: str):
+        """
+        Delete the chunks of the owner's retired versions, whichever worker retired
+        them, then stop hiding those versions
+        """
+        async with SessionLocal() as db:
+            retired = (await load_corpus_state(db, owner)).retired
+        if not retired:
+            return
+        await self.vector_stores.for_owner(owner).adelete_where({"version": {"$in": retired}})
+        async with SessionLocal() as db:
+            state = await change_corpus(db, owner, purged=retired)
+            await db.commit()
+        self.corpus_states.changed(owner, state)
+
+    async def maybe_compact(self, owner: str):
+        """
+        Purge the chunks of the owner's retired versions, including any an earlier purge
+        failed on, then compact the vector store in the background once deleted chunks
+        make up VECTOR_COMPACT_DELETED_RATIO of it, so its size and search time follow
+        the live documents
+        """
+        await self.purge_retired(owner)
+        if owner in self._compacting:
+            return
+        store = self.vector_stores.for_owner(owner)
+        # Counting can read the store's files or its database, so keep it off the event loop
+        deleted, live = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: (store.deleted_count(), store.count())
+        )
+        if (
+                owner in self._compacting
+                or deleted < settings.VECTOR_COMPACT_MIN_DELETED
+                or deleted < settings.VECTOR_COMPACT_DELETED_RATIO * (deleted + live)
+        ):
+            return
+        self._compacting.add(owner)
+        task = asyncio.create_task(self._compact(owner))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, owner: str):
+        store = self.vector_stores.for_owner(owner)
+        try:
+            with timed("vector_compact"):
+                await asyncio.get_running_loop().run_in_executor(None, store.compact)
+        except Exception as e:
+            logger.error(f"Failed to compact the vector store of {owner}: {e}", exc_info=True)
+        finally:
+            self._compacting.discard(owner)
+
+    async def get_job(self, job_id: str, owner: str) -> Optional[IngestJobResponse]:
+        if job_id in self.jobs:
+            return self.jobs[job_id] if self.owners[job_id] == owner else None
+
+        async with SessionLocal() as db:
+            record = await db.get(IngestJob, job_id)
+        if record is None or record.owner != owner:
+            return None
+        return IngestJobResponse(
+            job_id=record.job_id,
+            status=record.status,
+            files=[FileIngestStatus(**file_status) for file_status in json.loads(record.files)],
+            created_at=record.created_at,
+            finished_at=record.finished_at
+        )
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _save(self, job: IngestJobResponse, owner: str):
+        """
+        Write the job's progress to the database. Failing to doesn't fail the
+        ingestion, the job is just reported as it was last saved
+        """
+        # One write at a time per job, each of its state when the write starts, so the last one saved wins
+        async with self._saving.setdefault(job.job_id, asyncio.Lock()):
+            try:
+                async with SessionLocal() as db:
+                    await db.merge(IngestJob(
+                        job_id=job.job_id,
+                        owner=owner,
+                        status=job.status,
+                        files=json.dumps([file_status.model_dump() for file_status in job.files]),
+                        created_at=job.created_at,
+                        finished_at=job.finished_at
+                    ))
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Failed to save the progress of ingestion job {job.job_id}: {e}")
+
+    async def _prune_jobs(self):
+        """Forget the oldest finished jobs past INGEST_JOB_HISTORY"""
+        async with SessionLocal() as db:
+            expired = (
+                select(IngestJob.job_id)
+                .where(IngestJob.status != "running")
+                .order_by(IngestJob.finished_at.desc())
+                .offset(settings.INGEST_JOB_HISTORY)
+            )
+            await db.execute(delete(IngestJob).where(IngestJob.job_id.in_(expired)))
+            await db.commit()
+
+    async def _run(self, job: IngestJobResponse, owner: str, uploads: list[SavedUpload]):
+        try:
+            await asyncio.gather(*(
+                self._ingest_file(job, file_status, owner, upload)
+                for file_status, upload in zip(job.files, uploads)
+                if not upload.already_indexed
+            ))
+
+            failed = sum(f.status == "failed" for f in job.files)
+            job.status = "failed" if job.files and failed == len(job.files) else "done"
+            job.finished_at = datetime.now(timezone.utc)
+            await self._save(job, owner)
+            logger.info(f"Ingestion job {job.job_id} finished: {len(job.files) - failed}/{len(job.files)} files indexed")
+        finally:
+            # Saved by now, from here on read from the database
+            del self.jobs[job.job_id], self.owners[job.job_id], self._saving[job.job_id]
+        try:
+            await self._prune_jobs()
+        except Exception as e:
+            logger.error(f"Failed to prune finished ingestion jobs: {e}")
+
+    async def _chunk_batches(self, file_status: FileIngestStatus, upload: SavedUpload) -> AsyncIterator[list[Any]]:
+        """
+        Parse the upload a window of pages at a time on the process pool, a couple of
+        windows ahead, and hand out its chunks in batches of INGEST_FLUSH_CHUNKS.
+        Memory stays bounded by the window and batch sizes rather than the document's
+        """
+        loop = asyncio.get_running_loop()
+        page_count = await loop.run_in_executor(self.pool, count_pages, upload.path)
+        file_status.pages = page_count
+        window = settings.INGEST_PAGE_WINDOW
+        windows: list[Optional[tuple[int, int]]] = (
+            [(first, min(first + window, page_count)) for first in range(0, page_count, window)]
+            if page_count else [None]
+        )
+
+        remaining = iter(windows)
+
+        def submit(pages: Optional[tuple[int, int]]) -> "asyncio.Future[tuple[list[Any], float, float]]":
+            return loop.run_in_executor(self.pool, parse_and_split, upload.path, self.text_splitter, pages)
+
+        pending = deque(submit(pages) for pages in itertools.islice(remaining, settings.INGEST_WINDOW_PREFETCH))
+        buffer: list[Any] = []
+        try:
+            while pending:
+                started = time.perf_counter()
+                chunks, parse_seconds, chunk_seconds = await pending.popleft()
+                file_status.parse_seconds = (file_status.parse_seconds or 0) + time.perf_counter() - started
+                STAGE_SECONDS.observe(parse_seconds, stage="ingest_parse")
+                STAGE_SECONDS.observe(chunk_seconds, stage="ingest_chunk")
+                pending.extend(submit(pages) for pages in itertools.islice(remaining, 1))
+                if page_count:
+                    file_status.pages_parsed = min(file_status.pages_parsed + window, page_count)
+
+                buffer.extend(chunks)
+                while len(buffer) >= settings.INGEST_FLUSH_CHUNKS:
+                    yield buffer[:settings.INGEST_FLUSH_CHUNKS]
+                    buffer = buffer[settings.INGEST_FLUSH_CHUNKS:]
+            if buffer:
+                yield buffer
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _ingest_file(self, job: IngestJobResponse, file_status: FileIngestStatus, owner: str, upload: SavedUpload):
+        loop = asyncio.get_running_loop()
+        vector_store = self.vector_stores.for_owner(owner)
+        chunk_ids: list[str] = []
+        try:
+            file_status.status = "parsing"
+            await self._save(job, owner)
+            # Searches skip the version's chunks until the whole file is indexed, rather
+            # than see part of it, or part of it next to the version it replaces
+            assert upload.version is not None
+            async for chunks in self._chunk_batches(file_status, upload):
+                for chunk in chunks:
+                    chunk.metadata["owner"] = owner
+                    chunk.metadata["document_id"] = upload.document_id
+                    chunk.metadata["version"] = upload.version  # what hides them
+                    chunk.metadata["source"] = upload.path
+
+                file_status.status = "embedding"
+                batch_ids = [str(uuid.uuid4()) for _ in chunks]
+                async with self.embed_semaphore:
+                    started = time.perf_counter()
+                    # Embedded here rather than inside add_documents, to time the two stages apart
+                    with timed("ingest_embed"):
+                        vectors = await vector_store.embeddings.aembed_documents(
+                            [chunk.page_content for chunk in chunks]
+                        )
+                    if not chunk_ids:
+                        # Other workers may go on trusting a corpus read before the version began,
+                        # not knowing to hide it, until their copy expires
+                        await asyncio.sleep(max(0.0, upload.begun_at + self.corpus_states.ttl_seconds - time.monotonic()))
+                    chunk_ids.extend(batch_ids)
+                    with timed("ingest_write"):
+                        await loop.run_in_executor(None, vector_store.add, chunks, vectors, batch_ids)
+                    file_status.embed_seconds = (file_status.embed_seconds or 0) + time.perf_counter() - started
+                file_status.chunks += len(chunks)
+                await self._save(job, owner)
+
+            replaced = await record_document(upload, owner, chunk_ids)
+            if replaced is None:
+                # The same content, or a later version, finished indexing first in another request,
+                # or the document was deleted
+                await self.corpus_states.retire(owner, upload.version)
+                await loop.run_in_executor(None, remove_version, upload.path)
+                file_status.status = "already_indexed"
+                await self._save(job, owner)
+                await self.purge_retired(owner)
+                return
+            self.corpus_states.changed(owner, replaced.corpus)
+            file_status.status = "done"
+            await self._save(job, owner)
+
+            if replaced.path is not None:
+                # Other workers may still serve the old version until they next read the corpus
+                await asyncio.sleep(self.corpus_states.ttl_seconds)
+
+            # Chunks from before versions were stamped on them can't be hidden, so they go straight away.
+            # Those of a versioned one are hidden since the switch, and purged with the others retired
+            if replaced.chunk_ids:
+                await vector_store.adelete(replaced.chunk_ids)
+            if replaced.path is not None:
+                await loop.run_in_executor(None, remove_version, replaced.path)
+            await self.maybe_compact(owner)
+        except Exception as e:
+            if file_status.status == "done":
+                # Only cleaning up the old version failed, the next purge retries its chunks
+                logger.error(f"Failed to remove the replaced version of {file_status.filename}: {e}", exc_info=True)
+                return
+            logger.error(f"Failed to ingest {file_status.filename}: {e}", exc_info=True)
+            file_status.status = "failed"
+            file_status.error = str(e)
+            try:
+                # The new file, and through its version the batches written before the
+                # failure. The version being served stays as it was
+                if upload.is_new and upload.document_id is not None:
+                    await discard_document(upload.document_id)
+                await loop.run_in_executor(None, remove_version, upload.path)
+                await self.corpus_states.retire(owner, upload.version)
+                await self.purge_retired(owner)
+            except Exception as cleanup_error:
+                logger.error(f"Failed to remove partial chunks of {file_status.filename}: {cleanup_error}")
+            await self._save(job, owner)
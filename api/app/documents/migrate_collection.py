@@ -0,0 +1,152 @@
+"""
+One-shot move of the chunks indexed before each user had a collection of their
+own, out of the shared Chroma collection into their owner's store, each source
+file registered as a document so it can be listed, replaced and deleted.
+
+    uv run python -m app.documents.migrate_collection [--owner alice]
+
+Chunks from back then carry no owner unless tagged with one, as every user
+searched the same corpus: --owner gives the untagged ones to that user, and
+without it they stay behind. Safe to run again, and once the old collection is
+empty it's dropped. Stop the API first unless it uses a Chroma server
+(CHROMA_HOST), as two processes mustn't open the same Chroma directory
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, Optional
+from langchain_core.documents import Document
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app.core.config import settings
+from app.core.database import DocumentRecord, SessionLocal, User
+from app.core.logging import logger
+from app.core.vector_store import TenantVectorStores
+from app.documents.ingestion import change_corpus, ensure_corpus
+
+LEGACY_COLLECTION = "langchain"  # LangChain's default name, used for everyone's chunks
+BATCH = 500
+
+
+def _content_hash(source: str, texts: list[str]) -> str:
+    """The source file's, as an upload of it would have, or its chunks' if it's gone"""
+    digest = hashlib.sha256()
+    try:
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(settings.UPLOAD_CHUNK_BYTES), b""):
+                digest.update(block)
+    except OSError:
+        digest = hashlib.sha256("\n".join(texts).encode())
+    return digest.hexdigest()
+
+
+async def _register(owner: str, filename: str, content_hash: str, ids: list[str]) -> Optional[int]:
+    """
+    The document the file's chunks move under, registered with them in one commit,
+    or the one a previous run registered. None if the owner already has another
+    document by that name or with that content
+    """
+    await ensure_corpus(owner)
+    async with SessionLocal() as db:
+        record = DocumentRecord(
+            owner=owner,
+            filename=filename,
+            content_hash=content_hash,
+            created_at=datetime.now(timezone.utc),
+            chunk_ids=json.dumps(ids)
+        )
+        db.add(record)
+        await change_corpus(db, owner)  # the owner's cached answers didn't see these
+        try:
+            await db.commit()
+            return record.id
+        except IntegrityError:
+            await db.rollback()
+        previous = await db.scalar(
+            select(DocumentRecord)
+            .where(DocumentRecord.owner == owner, DocumentRecord.content_hash == content_hash)
+        )
+        if previous is not None and json.loads(previous.chunk_ids) == ids:
+            return previous.id  # stopped after registering it, before the chunks were all moved
+        return None
+
+
+async def migrate(legacy_client: Any, vector_stores: TenantVectorStores, default_owner: Optional[str] = None) -> tuple[int, int]:
+    """Move the shared collection's chunks to their owners. Returns how many moved and how many stayed"""
+    if LEGACY_COLLECTION not in {collection.name for collection in legacy_client.list_collections()}:
+        return 0, 0
+    legacy = legacy_client.get_collection(LEGACY_COLLECTION)
+
+    listing = legacy.get(include=["metadatas"])
+    files: dict[tuple[str, str], list[str]] = {}
+    left = 0
+    for chunk_id, metadata in zip(listing["ids"], listing["metadatas"]):
+        owner = (metadata or {}).get("owner") or default_owner
+        if owner is None:
+            left += 1
+            continue
+        files.setdefault((owner, (metadata or {}).get("source") or ""), []).append(chunk_id)
+
+    moved = 0
+    for (owner, source), ids in files.items():
+        chunks = legacy.get(ids=ids, include=["embeddings", "documents", "metadatas"])
+        ids = list(chunks["ids"])
+        filename = os.path.basename(source) or "untitled.txt"
+        document_id = await _register(owner, filename, _content_hash(source, chunks["documents"]), ids)
+        if document_id is None:
+            logger.warning(f"Left {len(ids)} chunks of {source} in {LEGACY_COLLECTION}: {owner} already has {filename}")
+            left += len(ids)
+            continue
+
+        store = vector_stores.for_owner(owner)
+        for start in range(0, len(ids), BATCH):
+            end = start + BATCH
+            documents = [
+                Document(page_content=text or "", metadata={**(metadata or {}), "owner": owner, "document_id": document_id})
+                for text, metadata in zip(chunks["documents"][start:end], chunks["metadatas"][start:end])
+            ]
+            vectors = [list(map(float, vector)) for vector in chunks["embeddings"][start:end]]
+            store.add(documents, vectors, ids[start:end])
+        legacy.delete(ids=ids)
+        moved += len(ids)
+
+    if legacy.count() == 0:
+        legacy_client.delete_collection(LEGACY_COLLECTION)
+    return moved, left
+
+
+async def main(default_owner: Optional[str]):
+    if default_owner is not None:
+        async with SessionLocal() as db:
+            if await db.scalar(select(User.id).where(User.username == default_owner)) is None:
+                raise SystemExit(f"No user named {default_owner}")
+
+    # The vectors are copied as they are, never computed, so no embedding model is loaded
+    vector_stores = TenantVectorStores(
+        None,  # type: ignore
+        persist_directory=settings.FLAT_VECTOR_DIR if settings.VECTOR_STORE_BACKEND == "flat" else settings.CHROME_DIR,
+        host=settings.CHROMA_HOST,
+        port=settings.CHROMA_PORT,
+        backend=settings.VECTOR_STORE_BACKEND,
+        dtype=settings.FLAT_VECTOR_DTYPE
+    )
+    legacy_client = vector_stores.client
+    if legacy_client is None:
+        import chromadb
+
+        legacy_client = (
+            chromadb.HttpClient(host=settings.CHROMA_HOST, port=settings.CHROMA_PORT) if settings.CHROMA_HOST
+            else chromadb.PersistentClient(path=settings.CHROME_DIR)
+        )
+    moved, left = await migrate(legacy_client, vector_stores, default_owner)
+    logger.info(f"Moved {moved} chunks to their owners' collections, {left} left in {LEGACY_COLLECTION}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--owner", help="User to give the chunks that aren't tagged with an owner")
+    args = parser.parse_args()
+    asyncio.run(main(args.owner))
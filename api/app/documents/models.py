@@ -5,23 +5,83 @@ from datetime import datetime
 class QueryRequest(BaseModel):
     question: str
     session_id: Optional[str] = None
+    document_ids: Optional[list[int]] = None  # only search these documents
 
 class QueryResponse(BaseModel):
     answer: str
     sources: list[str] = []
     session_id: Optional[str] = None
+    cached: bool = False
+
+class BatchQueryRequest(BaseModel):
+    questions: list[QueryRequest]
+
+class BatchQueryResult(BaseModel):
+    index: int  # position in the request's questions
+    answer: Optional[str] = None
+    sources: list[str] = []
+    session_id: Optional[str] = None
+    cached: bool = False
+    error: Optional[str] = None  # set instead of an answer if this question failed
+
+class BatchQueryResponse(BaseModel):
+    results: list[BatchQueryResult]  # in request order
 
 class UploadResponse(BaseModel):
     message: str
-    files_processed: list[str]
+    job_id: str
+    files_queued: list[str]
+
+class FileIngestStatus(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+    status: str = "queued"  # 'queued', 'parsing', 'embedding', 'done', 'already_indexed' or 'failed'
+    chunks: int = 0
+    pages: Optional[int] = None  # PDFs, which are parsed a window of pages at a time
+    pages_parsed: int = 0
+    parse_seconds: Optional[float] = None
+    embed_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+class IngestJobResponse(BaseModel):
+    job_id: str
+    status: str  # 'running', 'done' or 'failed'
+    files: list[FileIngestStatus]
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+class DocumentInfo(BaseModel):
+    id: int
+    filename: str
+    content_hash: str
+    chunks: int  # 0 until the first version finishes indexing
+    created_at: datetime  # when the current version was indexed
+
+class DocumentListResponse(BaseModel):
+    documents: list[DocumentInfo]  # oldest first
+    next_cursor: Optional[int] = None  # pass as `cursor` for the next page
+
+class VectorIndexStats(BaseModel):
+    chunks: int
+    deleted_chunks: int  # still taking up space until the store is compacted
 
 class ChatMessage(BaseModel):
     id: int
     session_id: str
-    message: str
     type: str  # 'human', 'ai', or 'system'
-    created_at: datetime
-    
+    content: Any
+
 class ChatHistoryResponse(BaseModel):
-    messages: list[ChatMessage]
-    total: int
\ No newline at end of file
+    messages: list[ChatMessage]  # oldest first
+    total: int
+    next_cursor: Optional[int] = None  # pass as `before` for the previous page
+
+class SessionInfo(BaseModel):
+    session_id: str
+    created_at: datetime
+    updated_at: datetime
+    message_count: int
+
+class SessionListResponse(BaseModel):
+    sessions: list[SessionInfo]  # most recently active first
+    next_cursor: Optional[str] = None
\ No newline at end of file
@@ -1,7 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from app.core.config import settings
 from app.core.logging import logger
-from app.documents.models import QueryRequest, UploadResponse
+from app.documents.models import (
+    BatchQueryRequest, BatchQueryResponse, ChatHistoryResponse, DocumentInfo, DocumentListResponse, IngestJobResponse, QueryRequest, QueryResponse,
+    SessionListResponse, UploadResponse, VectorIndexStats
+)
 from app.documents.services import DocumentService
+from app.documents.uploads import multipart_openapi
 from app.core.dependencies import get_current_user, get_document_service
 
 router = APIRouter(
@@ -9,20 +15,26 @@ router = APIRouter(
     dependencies=[Depends(get_current_user)]
 )
 
-@router.post("/upload")
+@router.post("/upload", status_code=202, openapi_extra=multipart_openapi("files", many=True))
 async def upload_docs(
-    files: list[UploadFile],
+    request: Request,
     doc_service: DocumentService = Depends(get_document_service)
 ):
     """
-    Upload files here to be indexed and used as context for LLM
+    Upload files (as `files`) here to be indexed and used as context for LLM.
+    Indexing runs in the background, poll /upload/jobs/{job_id} for progress.
+    Files are written to disk as they arrive, and a file over MAX_UPLOAD_FILE_BYTES,
+    or a request over MAX_UPLOAD_REQUEST_BYTES, gets a 413 as soon as it passes the limit
     """
     try:
-        processed_files = await doc_service.upload_documents(files)
+        job = await doc_service.upload_documents(request.headers.get("content-type", ""), request.stream())
         return UploadResponse(
-            message=f"Processed {len(processed_files)} files",
-            files_processed=processed_files
+            message=f"Queued {len(job.files)} files for processing",
+            job_id=job.job_id,
+            files_queued=[f.filename for f in job.files]
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e, exc_info=True)
         raise HTTPException(
@@ -30,7 +42,119 @@ async def upload_docs(
             detail="An error occurred while trying to process the uploaded files"
         )
 
-@router.post("/ask")
+@router.get("/upload/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_upload_job(
+    job_id: str,
+    doc_service: DocumentService = Depends(get_document_service)
+):
+    """
+    Get the progress of an upload: per-file status, chunk counts and timings
+    """
+    job = await doc_service.get_upload_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return job
+
+@router.get("/documents", response_model=DocumentListResponse)
+async def list_documents(
+    limit: int = Query(50, ge=1, le=200, description="Maximum number of documents to return"),
+    cursor: int | None = Query(None, description="`next_cursor` from the previous page"),
+    doc_service: DocumentService = Depends(get_document_service)
+):
+    """
+    List the current user's documents in upload order
+    """
+    try:
+        return await doc_service.list_documents(limit, cursor)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while listing documents"
+        )
+
+@router.get("/documents/index", response_model=VectorIndexStats)
+async def get_index_stats(doc_service: DocumentService = Depends(get_document_service)):
+    """
+    Count the chunks in the current user's vector index, live and deleted but not yet reclaimed
+    """
+    return await doc_service.get_index_stats()
+
+@router.post("/documents/index/compact", response_model=VectorIndexStats)
+async def compact_index(doc_service: DocumentService = Depends(get_document_service)):
+    """
+    Reclaim the space of deleted chunks and rebuild the index now.
+    This also runs in the background once VECTOR_COMPACT_DELETED_RATIO of the chunks are deleted
+    """
+    try:
+        return await doc_service.compact_index()
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while compacting the index"
+        )
+
+@router.get("/documents/{document_id}", response_model=DocumentInfo)
+async def get_document(
+    document_id: int,
+    doc_service: DocumentService = Depends(get_document_service)
+):
+    """
+    Get one of the current user's documents
+    """
+    return await doc_service.get_document(document_id)
+
+@router.put("/documents/{document_id}", status_code=202, openapi_extra=multipart_openapi("file"))
+async def replace_document(
+    document_id: int,
+    request: Request,
+    doc_service: DocumentService = Depends(get_document_service)
+):
+    """
+    Upload a new version of a document (as `file`), which keeps its ID and name.
+    The old version answers questions until the new one is indexed,
+    poll /upload/jobs/{job_id} for progress
+    """
+    try:
+        job = await doc_service.replace_document(
+            document_id, request.headers.get("content-type", ""), request.stream()
+        )
+        return UploadResponse(
+            message=f"Queued a new version of document {document_id}",
+            job_id=job.job_id,
+            files_queued=[f.filename for f in job.files]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while trying to process the uploaded file"
+        )
+
+@router.delete("/documents/{document_id}")
+async def delete_document(
+    document_id: int,
+    doc_service: DocumentService = Depends(get_document_service)
+):
+    """
+    Delete a document: its file, its chunks in the vector index and its cached answers
+    """
+    try:
+        await doc_service.delete_document(document_id)
+        return {"message": f"Document {document_id} deleted"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while deleting the document"
+        )
+
+@router.post("/ask", response_model=QueryResponse)
 async def query_doc(
     request: QueryRequest,
     doc_svc: DocumentService = Depends(get_document_service),
@@ -39,11 +163,14 @@ async def query_doc(
     Give LLM a query that will use the specified document as context
     """
     try:
-        answer = doc_svc.query_document(
+        answer = await doc_svc.query_document(
             request.question,
-            request.session_id
+            request.session_id,
+            request.document_ids
         )
         return answer
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e, exc_info=True)
         raise HTTPException(
@@ -51,18 +178,64 @@ async def query_doc(
             detail="An error occurred while querying the LLM"
         )
 
-@router.get("/history")
+@router.post("/ask/stream")
+async def stream_query_doc(
+    request: QueryRequest,
+    doc_svc: DocumentService = Depends(get_document_service),
+):
+    """
+    Same as /ask, but streams the answer back as Server-Sent Events:
+    `sources` with the retrieved chunks, `token` for each generated token
+    and a final `done` carrying the session ID
+    """
+    return StreamingResponse(
+        doc_svc.stream_query_document(request.question, request.session_id, request.document_ids),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/ask/batch", response_model=BatchQueryResponse)
+async def query_doc_batch(
+    request: BatchQueryRequest,
+    stream: bool = Query(False, description="Stream each result as an NDJSON line as soon as it's ready"),
+    doc_svc: DocumentService = Depends(get_document_service),
+):
+    """
+    Ask many questions in one call, up to ASK_BATCH_MAX_QUESTIONS. Returns every
+    result in request order, or with `stream=true` one JSON line per result in the
+    order they finish, each carrying its `index`. A failed question gets an `error`
+    rather than failing the batch
+    """
+    if len(request.questions) > settings.ASK_BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A batch can have at most {settings.ASK_BATCH_MAX_QUESTIONS} questions"
+        )
+
+    results = doc_svc.query_documents_batch(request.questions)
+    if stream:
+        return StreamingResponse(
+            (result.model_dump_json() + "\n" async for result in results),
+            media_type="application/x-ndjson",
+            headers={"X-Accel-Buffering": "no"}
+        )
+    return BatchQueryResponse(results=sorted([result async for result in results], key=lambda result: result.index))
+
+@router.get("/history", response_model=ChatHistoryResponse)
 async def get_history(
-    session_id: str = Query(None, description="Filter by session ID"),
-    limit: int = Query(50, description="Maximum number of messages to return"),
+    session_id: str = Query(..., description="Session to read"),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of messages to return"),
+    before: int | None = Query(None, description="Cursor: only return messages older than this message ID"),
     doc_service: DocumentService = Depends(get_document_service)
 ):
     """
-    Get chat history, optionally filtered by session ID
+    Get a session's chat history, newest page first.
+    Pass `next_cursor` back as `before` to page further back
     """
     try:
-        history = doc_service.get_session_history(session_id, limit)
-        return history.messages
+        return await doc_service.get_history_page(session_id, limit, before)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e, exc_info=True)
         raise HTTPException(
@@ -79,11 +252,13 @@ async def clear_session_history(
     Clear chat history for a specific session
     """
     try:
-        success = doc_service.clear_chat_history(session_id)
+        success = await doc_service.clear_chat_history(session_id)
         if success:
             return {"message": f"Chat history cleared for session {session_id}"}
         else:
             raise HTTPException(status_code=404, detail="Session not found")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e, exc_info=True)
         raise HTTPException(
@@ -91,21 +266,23 @@ async def clear_session_history(
             detail="An error occurred while clearing chat history"
         )
     
-@router.get("/sessions")
+@router.get("/sessions", response_model=SessionListResponse)
 async def list_sessions(
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of sessions to return"),
+    cursor: str | None = Query(None, description="`next_cursor` from the previous page"),
     doc_service: DocumentService = Depends(get_document_service)
 ):
     """
-    List all unique session IDs from chat history
+    List the current user's sessions, most recently active first
     """
 
     try:
-        sessions = doc_service.get_all_sessions()
-        print(sessions)
-        return {"sessions": sessions}
+        return await doc_service.get_all_sessions(limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail="An error occurred while retrieving session IDs"
-        )
\ No newline at end of file
+        )
@@ -1,176 +1,707 @@
+import asyncio
+import base64
+import binascii
+import contextlib
+import json
 import os
-from app.shared.utils import format_docs_structured
-from app.core.config import setup_langsmith_env
-setup_langsmith_env()
-from operator import itemgetter
 import shutil
+import time
+from app.core.logging import logger
+from app.shared.utils import docs_to_chunks, format_docs_structured, format_sse, source_names
+from app.shared.context import pack_context
 from app.core.config import settings
 import uuid
-from typing import cast
-from fastapi import UploadFile
-from langchain_unstructured import UnstructuredLoader
-from langchain_chroma import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import ChatOpenAI
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from pydantic import SecretStr
-from app.core.database import Message, SessionLocal
+from uuid import UUID
+import anyio
+from typing import TYPE_CHECKING, Any, AsyncIterator
+from fastapi.concurrency import run_in_threadpool
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timezone
+from app.core.database import ChatSession, DocumentRecord, Message
+from app.core.exceptions import (
+    DocumentNotFoundException, InvalidUploadException, SessionNotFoundException, UnsupportedFileTypeException
+)
+from app.core.embeddings import aembed_queries
+from app.core.llm import LLMRunner
+from app.core.metrics import LLM_TOKENS, STAGE_SECONDS, timed
+from app.documents.history import HistoryWindowCache, LimitedSQLChatMessageHistory
+from app.core.vector_store import TenantVectorStores, VectorStore
+from app.documents.ingestion import (
+    CorpusState, IngestionEngine, SavedUpload, change_corpus, discard_document, ensure_corpus, remove_version,
+    version_path
+)
+from app.documents.uploads import EXTENSION_TYPES, StagedUpload, extension_accepts, stage_multipart
+from app.documents.cache import AnswerCache, CachedAnswer
+from app.documents.singleflight import AnswerFlight, SingleFlight
+from app.documents.models import (
+    BatchQueryResult, ChatHistoryResponse, ChatMessage, DocumentInfo, DocumentListResponse, IngestJobResponse,
+    QueryRequest, QueryResponse, SessionInfo, SessionListResponse, VectorIndexStats
+)
+from langchain_core.callbacks import AsyncCallbackHandler
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import ChatOpenAI
 from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import BaseMessage
-from langchain_community.vectorstores.utils import filter_complex_metadata #type: ignore
-from typing import Dict
-from langchain.schema.runnable import RunnableSerializable
-from langchain_core.runnables import chain
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.runnables import Runnable
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 class DocumentService:
     def __init__(
-            self, db: Session,
-            vector_store: Chroma,
-            text_splitter: RecursiveCharacterTextSplitter
+            self, db: AsyncSession,
+            vector_stores: TenantVectorStores,
+            text_splitter: "RecursiveCharacterTextSplitter",
+            ingestion_engine: IngestionEngine,
+            answer_cache: AnswerCache,
+            answer_flights: SingleFlight,
+            history_window: HistoryWindowCache,
+            answer_runner: LLMRunner,
+            owner: str
     ):
         self.db = db
-        self.vector_store = vector_store
+        self.vector_stores = vector_stores
+        self.owner = owner
         self.text_splitter = text_splitter
-        self.llm = ChatOpenAI(
-            api_key=SecretStr(settings.OPENAI_KEY), 
-            streaming=True
-        )
+        self.ingestion_engine = ingestion_engine
+        self.answer_cache = answer_cache
+        self.answer_flights = answer_flights
+        self.history_window = history_window
+        self.answer_runner = answer_runner
+        self.corpus = CorpusState()  # as of the last lookup
+
+    @property
+    def vector_store(self) -> VectorStore:
+        """The current user's own store"""
+        return self.vector_stores.for_owner(self.owner)
 
     def get_session_history(self, session_id: str, limit: int = 4):
         """Get chat message history for a session"""
         return LimitedSQLChatMessageHistory(
             session_id=session_id,
-            connection=settings.SQLALCHEMY_DATABASE_URL,
+            owner=self.owner,
+            window=self.history_window,
             limit=limit
         )
 
-    async def upload_documents(self, files: list[UploadFile]) -> list[str]:
-        processed_files: list[str] = []   
+    async def upload_documents(self, content_type: str, body: AsyncIterator[bytes]) -> IngestJobResponse:
+        """Save the files uploaded as 'files' in a multipart body and queue them for background ingestion"""
         os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-        
-        allowed_extensions = (
-            ".bmp", ".csv", ".doc", ".docx", ".eml", ".epub", ".heic",
-            ".html", ".jpeg", ".png", ".md", ".msg", ".odt", ".org",
-            ".p7s", ".pdf", ".ppt", ".pptx", ".rst", ".rtf", ".tiff",
-            ".txt", ".tsv", ".xls", ".xlsx", ".xml"
+
+        # Stream every file to disk before registering any, so a file over the
+        # limit rejects the request without leaving the others half-registered
+        staged = await stage_multipart(
+            content_type, body, "files", settings.UPLOAD_DIR,
+            settings.MAX_UPLOAD_FILE_BYTES, settings.UPLOAD_CHUNK_BYTES,
+            accept=lambda filename: filename.lower().endswith(tuple(EXTENSION_TYPES))
         )
+        return await self.ingestion_engine.submit(self.owner, await self._save_staged(staged))
 
-        for file in files:
-            if not file.filename or not file.filename.endswith(allowed_extensions):
-                continue
-            
-            upload_path = os.path.join(settings.UPLOAD_DIR, file.filename)
-            
-            with open(upload_path, "wb") as f:
-                shutil.copyfileobj(file.file, f)
-            
-            chunks = UnstructuredLoader(upload_path).load_and_split(self.text_splitter)
-            chunks = filter_complex_metadata(chunks)
-            
-            await self.vector_store.aadd_documents(chunks)
-            processed_files.append(file.filename)
-        
-        return processed_files
-
-    def query_document(self, question: str, session_id: str | None = None) -> str:
-        if not session_id:
-            session_id = str(uuid.uuid4())
-        
-            
-        @chain
-        def retriever(query: str):
-            docs_and_scores = self.vector_store.similarity_search_with_score(query)
-
-            docs: list[Document] = []
-
-            for doc, score in docs_and_scores:
-                doc.metadata["score"] = score #type: ignore
-                docs.append(doc)
-
-            return docs
-
-        prompt = ChatPromptTemplate.from_messages([ #type: ignore
-            (
-                "system",
-                "You are a helpful assistant. Answer questions based on the provided context if it exists. "
-                "If you don't know the answer, just say that you don't know, don't try to make up an answer. "
-                # "Answer in a concise manner."
-            ),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "Context: \n\n{context}. \n\nQuestion: \n\n{input}"),
-        ])
-        
-        # Create retrieval chain
-        retrieval_chain = cast(
-            RunnableSerializable[Dict[str, str], str],
-            (
-                {
-                    "context": itemgetter("input") | retriever | format_docs_structured,
-                    "input": itemgetter("input"),
-                    "history": itemgetter("history"),
-                }
-                | prompt
-                | self.llm
-                | StrOutputParser()
-            )
+    async def _save_staged(self, staged: list[StagedUpload]) -> list[SavedUpload]:
+        """
+        Register staged uploads and move them into place, or drop them if already indexed.
+        If one fails, none are queued: the documents registered so far are dropped again
+        """
+        uploads: list[SavedUpload] = []
+        try:
+            for upload in staged:
+                if not extension_accepts(upload.filename, upload.content_type):
+                    logger.warning(f"Skipping {upload.filename}: content looks like {upload.content_type}")
+                    continue
+
+                record = await self._claim_document(upload.filename, upload.content_hash)
+
+                # Identical content is already indexed, so only keep the file if it's new
+                if record is None:
+                    uploads.append(SavedUpload(
+                        upload.filename, "", upload.content_hash, content_type=upload.content_type, already_indexed=True
+                    ))
+                    continue
+
+                document_id, is_new = record
+                # Beside the version being served, which stays until this one is indexed
+                upload_path = version_path(document_id, upload.filename)
+                os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+                os.replace(upload.temp_path, upload_path)
+
+                uploads.append(SavedUpload(
+                    upload.filename, upload_path, upload.content_hash, document_id, is_new,
+                    content_type=upload.content_type,
+                    version=await self.ingestion_engine.corpus_states.begin(self.owner), begun_at=time.monotonic()
+                ))
+        except Exception:
+            for saved in uploads:
+                if saved.document_id is None:
+                    continue
+                if saved.version is not None:
+                    await self.ingestion_engine.corpus_states.retire(self.owner, saved.version)
+                if saved.is_new:
+                    await discard_document(saved.document_id)
+                    await run_in_threadpool(
+                        shutil.rmtree, os.path.join(settings.UPLOAD_DIR, str(saved.document_id)), ignore_errors=True
+                    )
+                else:
+                    await run_in_threadpool(remove_version, saved.path)
+            raise
+        finally:
+            # Every staged file not moved into place, skipped, duplicate or left over after a failure
+            for upload in staged:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(upload.temp_path)
+        return uploads
+
+    async def _claim_document(self, filename: str, content_hash: str) -> tuple[int, bool] | None:
+        """
+        Find or create the registry entry this upload will be indexed under.
+        Returns (document_id, is_new), or None if the user already has this content indexed
+        """
+        duplicate = await self.db.scalar(
+            select(DocumentRecord.id)
+            .where(DocumentRecord.owner == self.owner, DocumentRecord.content_hash == content_hash)
+        )
+        if duplicate is not None:
+            return None
+
+        record = await self.db.scalar(
+            select(DocumentRecord)
+            .where(DocumentRecord.owner == self.owner, DocumentRecord.filename == filename)
+        )
+        if record is not None:
+            # Keep serving the old version until the new one is indexed
+            return record.id, False
+
+        record = DocumentRecord(
+            owner=self.owner,
+            filename=filename,
+            content_hash=content_hash,
+            created_at=datetime.now(timezone.utc)
+        )
+        self.db.add(record)
+        try:
+            await self.db.commit()
+        except IntegrityError:
+            # The same content was claimed by a concurrent upload
+            await self.db.rollback()
+            return None
+        return record.id, True
+
+    async def get_upload_job(self, job_id: str) -> IngestJobResponse | None:
+        return await self.ingestion_engine.get_job(job_id, self.owner)
+
+    async def _get_document_record(self, document_id: int) -> DocumentRecord:
+        record = await self.db.get(DocumentRecord, document_id)
+        if record is None or record.owner != self.owner:
+            raise DocumentNotFoundException()
+        return record
+
+    def _document_info(self, record: DocumentRecord) -> DocumentInfo:
+        return DocumentInfo(
+            id=record.id,
+            filename=record.filename,
+            content_hash=record.content_hash,
+            chunks=len(json.loads(record.chunk_ids)),
+            created_at=record.created_at
         )
-                
-        # Wrap with message history
-        chain_with_history = RunnableWithMessageHistory(
-            retrieval_chain,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="history",
+
+    async def list_documents(self, limit: int = 50, cursor: int | None = None) -> DocumentListResponse:
+        """A page of the user's documents in upload order, starting after document id `cursor`"""
+        stmt = select(DocumentRecord).where(DocumentRecord.owner == self.owner)
+        if cursor is not None:
+            stmt = stmt.where(DocumentRecord.id > cursor)
+        rows = list((await self.db.scalars(stmt.order_by(DocumentRecord.id).limit(limit + 1))).all())
+        page = rows[:limit]
+        return DocumentListResponse(
+            documents=[self._document_info(row) for row in page],
+            next_cursor=page[-1].id if len(rows) > limit else None
         )
 
-        result = chain_with_history.invoke( # type: ignore
-            {"input": question},
-            config={"configurable": {"session_id": session_id}}
+    async def get_document(self, document_id: int) -> DocumentInfo:
+        return self._document_info(await self._get_document_record(document_id))
+
+    async def delete_document(self, document_id: int):
+        """Remove a document's registry entry, its chunks and its file"""
+        record = await self._get_document_record(document_id)
+        # Chunks from before versions were stamped on them are deleted by ID, the others are purged by version
+        chunk_ids: list[str] = json.loads(record.chunk_ids) if record.version is None else []
+        # The entry goes first, retiring its version in the same commit: an ingest of
+        # this document finishing now then finds it gone and retires its own
+        await ensure_corpus(self.owner)
+        await self.db.delete(record)
+        corpus = await change_corpus(self.db, self.owner, retire=record.version)
+        await self.db.commit()
+        self.ingestion_engine.corpus_states.changed(self.owner, corpus)
+
+        if chunk_ids:
+            await self.vector_store.adelete(chunk_ids)
+        await run_in_threadpool(
+            shutil.rmtree, os.path.join(settings.UPLOAD_DIR, str(document_id)), ignore_errors=True
         )
-        
-        return cast(str,result)
+        await self.ingestion_engine.maybe_compact(self.owner)
+
+    async def replace_document(self, document_id: int, content_type: str, body: AsyncIterator[bytes]) -> IngestJobResponse:
+        """
+        Queue a new version of a document, uploaded as 'file' in a multipart body.
+        It keeps its id and name, and the old version's chunks keep serving until
+        the new one is indexed
+        """
+        record = await self._get_document_record(document_id)
+        extension = os.path.splitext(record.filename)[1].lower()
+
+        def same_type(filename: str) -> bool:
+            # Checked as soon as the file's name arrives, before its content is read
+            if os.path.splitext(filename)[1].lower() != extension:
+                raise UnsupportedFileTypeException(f"A new version of {record.filename} must also be a {extension} file")
+            return True
+
+        os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+        uploads = await stage_multipart(
+            content_type, body, "file", settings.UPLOAD_DIR,
+            settings.MAX_UPLOAD_FILE_BYTES, settings.UPLOAD_CHUNK_BYTES,
+            accept=same_type, max_files=1
+        )
+        if not uploads:
+            raise InvalidUploadException("Upload the new version as 'file'")
+        staged = uploads[0]
+        if not extension_accepts(record.filename, staged.content_type):
+            os.remove(staged.temp_path)
+            raise UnsupportedFileTypeException(f"{staged.filename} content looks like {staged.content_type}")
+        # Registered under the existing name, so _claim_document finds this document
+        staged.filename = record.filename
+        return await self.ingestion_engine.submit(self.owner, await self._save_staged([staged]))
+
+    async def compact_index(self) -> VectorIndexStats:
+        """Reclaim the space of the user's deleted chunks now, rather than waiting for the background job"""
+        with timed("vector_compact"):
+            await run_in_threadpool(self.vector_store.compact)
+        return await self.get_index_stats()
+
+    async def get_index_stats(self) -> VectorIndexStats:
+        store = self.vector_store
+        return VectorIndexStats(
+            chunks=await run_in_threadpool(store.count),
+            deleted_chunks=store.deleted_count()
+        )
+
+    def _score_docs(self, docs_and_scores: list[tuple[Document, float]]) -> list[Document]:
+        """Attach the similarity score to each document's metadata"""
+        docs: list[Document] = []
+
+        for doc, score in docs_and_scores:
+            doc.metadata["score"] = score #type: ignore
+            docs.append(doc)
+
+        return docs
+
+    def _pack_docs(self, docs: list[Document]) -> list[Document]:
+        """Trim the retrieved chunks to the prompt's context token budget"""
+        packed, raw_tokens, packed_tokens = pack_context(
+            docs,
+            token_budget=settings.CONTEXT_TOKEN_BUDGET,
+            max_distance=settings.CONTEXT_MAX_DISTANCE,
+            max_overlap=settings.CHUNK_OVERLAP,
+            encoding=settings.CONTEXT_TOKEN_ENCODING
+        )
+        logger.info(
+            f"Packed context: {len(docs)} -> {len(packed)} chunks, "
+            f"{raw_tokens} -> {packed_tokens} tokens"
+        )
+        return packed
+
+    def _search_filter(self, document_ids: list[int] | None, hidden: list[int]) -> dict[str, Any] | None:
+        """
+        Narrow the search within the user's collection to specific documents, and
+        skip the document versions being indexed or replaced
+        """
+        conditions: list[dict[str, Any]] = []
+        if document_ids:
+            conditions.append({"document_id": {"$in": document_ids}})
+        if hidden:
+            conditions.append({"version": {"$nin": hidden}})
+        if len(conditions) > 1:
+            return {"$and": conditions}
+        return conditions[0] if conditions else None
+
+    def _cache_scope(self, document_ids: list[int] | None) -> str:
+        return ",".join(str(i) for i in sorted(set(document_ids))) if document_ids else "*"
+
+    async def _sync_corpus_state(self) -> int:
+        """
+        Catch up with changes to this user's documents made by any worker, as of at most
+        CORPUS_STATE_TTL_SECONDS ago: the answer cache, and the versions searches skip.
+        Returns the corpus version
+        """
+        self.corpus = await self.ingestion_engine.corpus_states.get(self.owner)
+        return self.answer_cache.corpus_version(self.owner)
+
+    async def _lookup_cached_answer(
+            self,
+            question: str,
+            document_ids: list[int] | None
+    ) -> tuple[CachedAnswer | None, list[float] | None]:
+        """Check the answer cache, embedding the question only if semantic lookup is enabled"""
+        await self._sync_corpus_state()
+        embedding = None
+        if self.answer_cache.semantic_threshold is not None:
+            # Passed on to the retriever on a miss, so the question is embedded once
+            with timed("query_embedding"):
+                embedding = await self.vector_store.embeddings.aembed_query(question)
+        cached = self.answer_cache.get(self.owner, self._cache_scope(document_ids), question, embedding)
+        return cached, embedding
+
+    async def _retrieve(
+            self,
+            question: str,
+            document_ids: list[int] | None,
+            embedding: list[float] | None,
+            hidden: list[int]
+    ) -> list[Document]:
+        """Search the user's collection for the question and pack the hits into the context budget"""
+        if embedding is None:
+            with timed("query_embedding"):
+                embedding = await self.vector_store.embeddings.aembed_query(question)
+        search_filter = self._search_filter(document_ids, hidden)
+        with timed("vector_search"):
+            docs_and_scores = await run_in_threadpool(
+                self.vector_store.search,
+                embedding, k=settings.RETRIEVAL_K, filter=search_filter
+            )
+        with timed("context_pack"):
+            return self._pack_docs(self._score_docs(docs_and_scores))
+
+    async def query_document(
+            self,
+            question: str,
+            session_id: str | None = None,
+            document_ids: list[int] | None = None
+    ) -> QueryResponse:
+        if not session_id:
+            session_id = str(uuid.uuid4())
 
-    def clear_chat_history(self, session_id: str) -> bool:
+        history = self.get_session_history(session_id)
+        cached, embedding = await self._lookup_cached_answer(question, document_ids)
+        if cached:
+            await history.aadd_messages([HumanMessage(content=question), AIMessage(content=cached.answer)])
+            return QueryResponse(
+                answer=cached.answer,
+                sources=cached.sources,
+                session_id=session_id,
+                cached=True
+            )
+        corpus_version = self.answer_cache.corpus_version(self.owner)
+
+        history_messages = await history.aget_messages()
+        with self._join_answer(question, document_ids, embedding, history_messages, corpus_version) as flight:
+            answer = await flight.answer()
+            sources = source_names(await flight.documents())
+        await history.aadd_messages([HumanMessage(content=question), AIMessage(content=answer)])
+
+        return QueryResponse(answer=answer, sources=sources, session_id=session_id)
+
+    def _join_answer(
+            self,
+            question: str,
+            document_ids: list[int] | None,
+            embedding: list[float] | None,
+            history_messages: list[BaseMessage],
+            corpus_version: int,
+            docs: list[Document] | None = None
+    ):
+        """
+        Retrieve and generate the answer to a question the cache missed, or join the
+        generation already running for the same question over the same documents
+        (with ASK_COALESCE). Joiners share the first asker's answer whatever their
+        own history, as with the answer cache, and each records it in its own session
+        """
+        scope = self._cache_scope(document_ids)
+        hidden = self.corpus.hidden
+
+        async def generate(flight: AnswerFlight):
+            found = docs if docs is not None else await self._retrieve(question, document_ids, embedding, hidden)
+            flight.set_documents(found)
+            async for token in self.answer_runner.astream(
+                {"context": format_context(found), "input": question, "history": history_messages},
+                config={"callbacks": [LLMTimingHandler()]}
+            ):
+                flight.add_token(token)
+            self.answer_cache.put(
+                self.owner, scope, question, "".join(flight.parts), source_names(found), embedding, corpus_version
+            )
+
+        key = self.answer_cache.key(self.owner, scope, question) if settings.ASK_COALESCE else object()
+        return self.answer_flights.join(key, generate)
+
+    async def query_documents_batch(self, requests: list[QueryRequest]) -> AsyncIterator[BatchQueryResult]:
+        """
+        Answer many questions at once: every question embedded in one call, the searches
+        run together per set of documents, then the completions concurrently, at most
+        ASK_BATCH_CONCURRENCY at a time. Questions sharing a session are answered in
+        order, each seeing the earlier answers as history. Yields each result as it
+        finishes, tagged with its position in the request
+        """
+        session_ids = [request.session_id or str(uuid.uuid4()) for request in requests]
+        semantic = self.answer_cache.semantic_threshold is not None
+        try:
+            questions = list(dict.fromkeys(request.question for request in requests))
+            with timed("query_embedding"):
+                embedding_of = dict(zip(questions, await aembed_queries(self.vector_store.embeddings, questions)))
+            corpus_version = await self._sync_corpus_state()
+
+            cached: dict[int, CachedAnswer] = {}
+            scopes: dict[str, list[int]] = {}
+            for i, request in enumerate(requests):
+                scope = self._cache_scope(request.document_ids)
+                hit = self.answer_cache.get(
+                    self.owner, scope, request.question, embedding_of[request.question] if semantic else None
+                )
+                if hit:
+                    cached[i] = hit
+                else:
+                    scopes.setdefault(scope, []).append(i)
+
+            # One search call per set of documents, the sets searched concurrently
+            with timed("vector_search"):
+                searches = await asyncio.gather(*(
+                    run_in_threadpool(
+                        self.vector_store.search_many,
+                        [embedding_of[requests[i].question] for i in indexes],
+                        k=settings.RETRIEVAL_K,
+                        filter=self._search_filter(requests[indexes[0]].document_ids, self.corpus.hidden)
+                    )
+                    for indexes in scopes.values()
+                ))
+            docs: dict[int, list[Document]] = {}
+            with timed("context_pack"):
+                for indexes, results in zip(scopes.values(), searches):
+                    for i, docs_and_scores in zip(indexes, results):
+                        docs[i] = self._pack_docs(self._score_docs(docs_and_scores))
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            for i, session_id in enumerate(session_ids):
+                yield BatchQueryResult(index=i, session_id=session_id, error="An error occurred while querying the LLM")
+            return
+
+        semaphore = asyncio.Semaphore(settings.ASK_BATCH_CONCURRENCY)
+        finished: asyncio.Queue[BatchQueryResult] = asyncio.Queue()
+
+        async def answer(i: int) -> BatchQueryResult:
+            request, session_id = requests[i], session_ids[i]
+            history = self.get_session_history(session_id)
+            if i in cached:
+                await history.aadd_messages(
+                    [HumanMessage(content=request.question), AIMessage(content=cached[i].answer)]
+                )
+                return BatchQueryResult(
+                    index=i, answer=cached[i].answer, sources=cached[i].sources, session_id=session_id, cached=True
+                )
+
+            history_messages = await history.aget_messages()
+            async with semaphore:
+                with self._join_answer(
+                    request.question, request.document_ids, embedding_of[request.question] if semantic else None,
+                    history_messages, corpus_version, docs[i]
+                ) as flight:
+                    text = await flight.answer()
+                    sources = source_names(await flight.documents())
+            await history.aadd_messages([HumanMessage(content=request.question), AIMessage(content=text)])
+            return BatchQueryResult(index=i, answer=text, sources=sources, session_id=session_id)
+
+        async def answer_session(indexes: list[int]):
+            for i in indexes:
+                try:
+                    result = await answer(i)
+                except HTTPException as e:  # unknown session, or the LLM is overloaded
+                    result = BatchQueryResult(index=i, session_id=session_ids[i], error=e.detail)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    result = BatchQueryResult(
+                        index=i, session_id=session_ids[i], error="An error occurred while querying the LLM"
+                    )
+                finished.put_nowait(result)
+
+        sessions: dict[str, list[int]] = {}
+        for i, session_id in enumerate(session_ids):
+            sessions.setdefault(session_id, []).append(i)
+        tasks = [asyncio.create_task(answer_session(indexes)) for indexes in sessions.values()]
+        try:
+            for _ in requests:
+                yield await finished.get()
+        finally:
+            # The client went away, or the caller stopped reading
+            for task in tasks:
+                task.cancel()
+
+    async def stream_query_document(
+            self,
+            question: str,
+            session_id: str | None = None,
+            document_ids: list[int] | None = None
+    ) -> AsyncIterator[str]:
+        """
+        Stream the answer as Server-Sent Events: the retrieved source chunks first,
+        then each token as the LLM produces it, then a final event with the session ID
+        """
+        if not session_id:
+            session_id = str(uuid.uuid4())
+
+        history = self.get_session_history(session_id)
+        answer_parts: list[str] = []
+
+        try:
+            # Also checks the session belongs to this user before anything is streamed
+            history_messages = await history.aget_messages()
+
+            cached, embedding = await self._lookup_cached_answer(question, document_ids)
+            if cached:
+                answer_parts.append(cached.answer)
+                yield format_sse("sources", {"chunks": [], "sources": cached.sources})
+                yield format_sse("token", {"token": cached.answer})
+                yield format_sse("done", {"session_id": session_id, "cached": True})
+                return
+            corpus_version = self.answer_cache.corpus_version(self.owner)
+
+            with self._join_answer(question, document_ids, embedding, history_messages, corpus_version) as flight:
+                docs = await flight.documents()
+                yield format_sse("sources", {"chunks": docs_to_chunks(docs), "sources": source_names(docs)})
+
+                async for token in flight.tokens():
+                    answer_parts.append(token)
+                    yield format_sse("token", {"token": token})
+
+            yield format_sse("done", {"session_id": session_id, "cached": False})
+        except HTTPException as e:  # unknown session, or the LLM is overloaded
+            yield format_sse("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            yield format_sse("error", {"detail": "An error occurred while querying the LLM"})
+        finally:
+            # Persist whatever was generated, even if the client went away mid-stream.
+            # Shielded so the write still completes while the response is being cancelled.
+            with anyio.CancelScope(shield=True):
+                if answer_parts:
+                    try:
+                        await history.aadd_messages(
+                            [HumanMessage(content=question), AIMessage(content="".join(answer_parts))]
+                        )
+                    except Exception as e:
+                        logger.error(e, exc_info=True)
+
+    async def clear_chat_history(self, session_id: str) -> bool:
         """Clear chat history for a specific session"""
         history = self.get_session_history(session_id)
-        history.clear()
+        await history.aclear()
         return True
 
-    def get_all_sessions(self):
-        """Get all unique session IDs from LangChain's message store"""
+    async def get_all_sessions(self, limit: int = 20, cursor: str | None = None) -> SessionListResponse:
+        """A page of the user's sessions, most recently active first"""
+        stmt = select(ChatSession).where(ChatSession.owner == self.owner)
+        if cursor:
+            updated_at, session_id = decode_session_cursor(cursor)
+            stmt = stmt.where(tuple_(ChatSession.updated_at, ChatSession.session_id) < (updated_at, session_id))
+        stmt = stmt.order_by(ChatSession.updated_at.desc(), ChatSession.session_id.desc()).limit(limit + 1)
 
-        stmt = select(Message.session_id).distinct()
-        ids = self.db.scalars(stmt).all()
-        return cast(list[str],ids)
+        rows = list((await self.db.scalars(stmt)).all())
+        page = rows[:limit]
+        return SessionListResponse(
+            sessions=[
+                SessionInfo(
+                    session_id=row.session_id,
+                    created_at=row.created_at,
+                    updated_at=row.updated_at,
+                    message_count=row.message_count
+                )
+                for row in page
+            ],
+            next_cursor=encode_session_cursor(page[-1].updated_at, page[-1].session_id) if len(rows) > limit else None
+        )
 
-        
-class LimitedSQLChatMessageHistory(SQLChatMessageHistory):
-    def __init__(self, session_id: str, connection: str, limit: int = 5):
-        super().__init__(session_id, connection)
-        self.limit = limit
+    async def get_history_page(self, session_id: str, limit: int = 50, before: int | None = None) -> ChatHistoryResponse:
+        """A page of a session's messages ending just before message id `before`, oldest first"""
+        chat_session = await self.db.get(ChatSession, session_id)
+        if chat_session is None or chat_session.owner != self.owner:
+            raise SessionNotFoundException()
 
-    @property
-    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
-        """Retrieve the last N messages from db using ORM style"""
+        stmt = select(Message).where(Message.session_id == session_id)
+        if before is not None:
+            stmt = stmt.where(Message.id < before)
+        rows = list((await self.db.scalars(stmt.order_by(Message.id.desc()).limit(limit + 1))).all())
+        total = chat_session.message_count
+        page = list(reversed(rows[:limit]))
+        messages: list[ChatMessage] = []
+        for row in page:
+            data = json.loads(row.message)
+            messages.append(ChatMessage(
+                id=row.id,
+                session_id=row.session_id,
+                type=data["type"],
+                content=data["data"]["content"]
+            ))
+        return ChatHistoryResponse(
+            messages=messages,
+            total=total,
+            next_cursor=page[0].id if len(rows) > limit else None
+        )
 
-        with SessionLocal() as session:
-            stmt = (
-                select(Message).where(Message.session_id == self.session_id)
-                .order_by(Message.id.desc()).limit(self.limit)
-            )
-            
-            results = session.scalars(stmt).all()
-            messages: list[BaseMessage] = []
-
-            for record in results:
-                # Use the converter to convert from SQL model to BaseMessage
-                message = self.converter.from_sql_model(record)
-                messages.append(message)
-            
-            return messages
\ No newline at end of file
+
+def encode_session_cursor(updated_at: datetime, session_id: str) -> str:
+    """Opaque keyset cursor pointing just past a session in the listing"""
+    raw = json.dumps([updated_at.isoformat(), session_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_session_cursor(cursor: str) -> tuple[datetime, str]:
+    """Raises ValueError for a malformed cursor"""
+    try:
+        updated_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(updated_at), str(session_id)
+    except (TypeError, binascii.Error, json.JSONDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def build_rag_prompt() -> ChatPromptTemplate:
+    """Prompt used to answer a question from the retrieved context and chat history"""
+    return ChatPromptTemplate.from_messages([ #type: ignore
+        (
+            "system",
+            "You are a helpful assistant. Answer questions based on the provided context if it exists. "
+            "If you don't know the answer, just say that you don't know, don't try to make up an answer. "
+            # "Answer in a concise manner."
+        ),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "Context: \n\n{context}. \n\nQuestion: \n\n{input}"),
+    ])
+
+
+def build_answer_chain(llm: "BaseChatModel") -> "Runnable[dict[str, Any], str]":
+    """Prompt, model and parser, compiled once and shared by every request"""
+    return build_rag_prompt() | llm | StrOutputParser()
+
+
+def format_context(docs: list[Document]) -> str:
+    with timed("context_format"):
+        return format_docs_structured(docs)
+
+
+class LLMTimingHandler(AsyncCallbackHandler):
+    """Records time to first token and total time of the LLM calls in one request"""
+
+    def __init__(self):
+        self.started: dict[UUID, float] = {}
+        self.streaming: set[UUID] = set()
+
+    async def on_chat_model_start(self, serialized: dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any):
+        self.started[run_id] = time.perf_counter()
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        LLM_TOKENS.inc()
+        if run_id in self.started and run_id not in self.streaming:
+            self.streaming.add(run_id)
+            STAGE_SECONDS.observe(time.perf_counter() - self.started[run_id], stage="llm_first_token")
+
+    async def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any):
+        started = self.started.pop(run_id, None)
+        if started is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_total")
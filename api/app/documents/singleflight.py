@@ -0,0 +1,125 @@
+import asyncio
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional
+from app.core.metrics import ASK_COALESCED, ASK_GENERATIONS
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+
+
+class AnswerFlight:
+    """
+    One retrieval and generation, shared by every request that joined it. Tokens
+    are kept as they arrive, so a request joining mid-stream replays them first
+    """
+
+    def __init__(self):
+        self.docs: Optional[list["Document"]] = None
+        self.parts: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+        self.task: Optional[asyncio.Task[None]] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # Waiters hold on to the event they saw, so swap in a fresh one for the next change
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def set_documents(self, docs: list["Document"]):
+        self.docs = docs
+        self._notify()
+
+    def add_token(self, token: str):
+        self.parts.append(token)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def documents(self) -> list["Document"]:
+        """The retrieved chunks, once retrieval is done"""
+        while self.docs is None:
+            changed = self._changed
+            if self.done:
+                raise self.error or RuntimeError("The answer finished without retrieving documents")
+            await changed.wait()
+        return self.docs
+
+    async def tokens(self) -> AsyncIterator[str]:
+        """Every token of the answer, from the first, as they are generated"""
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.done and sent == len(self.parts):
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+    async def answer(self) -> str:
+        """The whole answer, once generated"""
+        return "".join([token async for token in self.tokens()])
+
+
+class SingleFlight:
+    """
+    Coalesces identical questions asked while one is already being answered.
+    The first request for a key starts the generation in its own task, later
+    ones join it and read the same tokens. The task is cancelled once every
+    request that joined has gone, and the key is free again as soon as the
+    answer is done, from then on the answer cache serves it
+    """
+
+    def __init__(self):
+        self._flights: dict[Hashable, AnswerFlight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    @contextmanager
+    def join(self, key: Hashable, generate: Callable[[AnswerFlight], Awaitable[None]]) -> Iterator[AnswerFlight]:
+        """
+        Share the flight in progress for key, or start one running generate(flight).
+        generate outlives the request that started it, so it must not use that
+        request's database session
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = AnswerFlight()
+            flight.task = asyncio.create_task(self._run(key, flight, generate))
+            ASK_GENERATIONS.inc()
+        else:
+            ASK_COALESCED.inc()
+
+        flight.waiters += 1
+        try:
+            yield flight
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.done:
+                # Nobody is listening any more, stop paying for the generation
+                self._release(key, flight)
+                flight.task.cancel()  # type: ignore
+
+    async def _run(self, key: Hashable, flight: AnswerFlight, generate: Callable[[AnswerFlight], Awaitable[None]]):
+        try:
+            await generate(flight)
+        except BaseException as e:
+            flight.finish(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            flight.finish()
+        finally:
+            self._release(key, flight)
+
+    def _release(self, key: Hashable, flight: AnswerFlight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
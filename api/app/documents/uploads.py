@@ -0,0 +1,308 @@
+import contextlib
+import hashlib
+import os
+import re
+import uuid
+from dataclasses import dataclass, field
+from typing import IO, Any, AsyncIterator, Callable, Optional
+import python_multipart
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import parse_options_header
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.core.exceptions import InvalidUploadException, PayloadTooLargeException
+
+TEXT = "text/plain"
+ZIP = "application/zip"  # Office Open XML, OpenDocument and EPUB are zip containers
+OLE = "application/x-ole-storage"  # legacy Office formats and Outlook messages
+
+# Content types each accepted extension may sniff as. None accepts any content
+EXTENSION_TYPES: dict[str, Optional[tuple[str, ...]]] = {
+    ".bmp": ("image/bmp",),
+    ".csv": (TEXT,),
+    ".doc": (OLE,),
+    ".docx": (ZIP,),
+    ".eml": (TEXT,),
+    ".epub": (ZIP,),
+    ".heic": ("image/heic",),
+    ".html": (TEXT,),
+    ".jpeg": ("image/jpeg",),
+    ".png": ("image/png",),
+    ".md": (TEXT,),
+    ".msg": (OLE,),
+    ".odt": (ZIP,),
+    ".org": (TEXT,),
+    ".p7s": None,
+    ".pdf": ("application/pdf",),
+    ".ppt": (OLE,),
+    ".pptx": (ZIP,),
+    ".rst": (TEXT,),
+    ".rtf": ("application/rtf", TEXT),
+    ".tiff": ("image/tiff",),
+    ".txt": (TEXT,),
+    ".tsv": (TEXT,),
+    ".xls": (OLE,),
+    ".xlsx": (ZIP,),
+    ".xml": (TEXT,),
+}
+
+_SIGNATURES = (
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", ZIP),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", OLE),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"{\\rtf", "application/rtf"),
+    (b"\xff\xfe", TEXT),  # UTF-16 byte order marks
+    (b"\xfe\xff", TEXT),
+)
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Content type from a file's first bytes, by magic number, else text if it has no NUL bytes"""
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    # BMP's 'BM' could start a text file too, so also check its reserved header bytes are zero
+    if head.startswith(b"BM") and head[6:10] == b"\x00\x00\x00\x00":
+        return "image/bmp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    if b"\x00" not in head:
+        return TEXT
+    return "application/octet-stream"
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.3g} MB"
+    if size >= 1024:
+        return f"{size / 1024:.3g} KB"
+    return f"{size} bytes"
+
+
+def extension_accepts(filename: str, content_type: str) -> bool:
+    allowed = EXTENSION_TYPES.get(os.path.splitext(filename)[1].lower(), ())
+    return allowed is None or content_type in allowed
+
+
+@dataclass
+class StagedUpload:
+    """An upload streamed to a temporary file, not yet moved into place"""
+    filename: str
+    temp_path: str
+    content_hash: str  # SHA-256 of the contents
+    content_type: str  # sniffed from the first bytes
+    size: int
+
+
+def _write_chunk(out: IO[bytes], digest: "hashlib._Hash", chunk: bytes):
+    # hashlib releases the GIL for large buffers, so both run off the event loop
+    digest.update(chunk)
+    out.write(chunk)
+
+
+@dataclass
+class _FilePart:
+    filename: str
+    temp_path: str
+    out: IO[bytes]
+    digest: "hashlib._Hash" = field(default_factory=hashlib.sha256)
+    buffer: bytearray = field(default_factory=bytearray)
+    content_type: Optional[str] = None
+    size: int = 0
+
+    async def flush(self):
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        if self.content_type is None and chunk:
+            self.content_type = sniff_content_type(chunk[:512])
+        await run_in_threadpool(_write_chunk, self.out, self.digest, chunk)
+
+    def discard(self):
+        self.out.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.temp_path)
+
+
+async def stage_multipart(
+        content_type: str,
+        body: AsyncIterator[bytes],
+        field_name: str,
+        directory: str,
+        max_bytes: int,
+        chunk_bytes: int,
+        accept: Callable[[str], bool] = lambda filename: True,
+        max_files: int = 1000
+) -> list[StagedUpload]:
+    """
+    Parse a multipart/form-data body as it arrives, streaming each file sent as
+    field_name straight to its own temporary file, hashed and sniffed on the way and
+    written chunk_bytes at a time. Nothing is spooled first, so a file is written
+    to disk once and PayloadTooLargeException is raised as soon as it passes max_bytes.
+    Files accept() returns False for and other fields are skipped; accept may also
+    raise to reject the upload as soon as a file's name arrives.
+    If anything fails, the temporary files written so far are removed
+    """
+    mimetype, params = parse_options_header(content_type)
+    boundary = params.get(b"boundary")
+    if mimetype != b"multipart/form-data" or not boundary:
+        raise InvalidUploadException("Expected a multipart/form-data body")
+
+    parts: list[_FilePart] = []
+    ended: list[_FilePart] = []
+    current: Optional[_FilePart] = None
+    headers: dict[bytes, bytes] = {}
+    header_name = bytearray()
+    header_value = bytearray()
+
+    def on_part_begin():
+        nonlocal current
+        current = None
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_name.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_name).lower()] = bytes(header_value)
+        header_name.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        nonlocal current
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if options.get(b"name") != field_name.encode() or not options.get(b"filename"):
+            return
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        if not accept(filename):
+            return
+        if len(parts) >= max_files:
+            raise InvalidUploadException(f"At most {max_files} files can be uploaded at once")
+        temp_path = os.path.join(directory, f"{uuid.uuid4().hex}.part")
+        current = _FilePart(filename, temp_path, open(temp_path, "wb"))
+        parts.append(current)
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if current is None:
+            return
+        current.size += end - start
+        if current.size > max_bytes:
+            raise PayloadTooLargeException(
+                f"{current.filename} is larger than the {format_size(max_bytes)} limit per file"
+            )
+        current.buffer.extend(data[start:end])
+
+    def on_part_end():
+        if current is not None:
+            ended.append(current)
+
+    callbacks: Any = {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    }
+    parser = python_multipart.MultipartParser(boundary, callbacks)
+    staged: list[StagedUpload] = []
+
+    try:
+        async for chunk in body:
+            try:
+                parser.write(chunk)
+            except FormParserError as e:
+                raise InvalidUploadException(f"Malformed multipart body: {e}")
+
+            # The parser calls back synchronously, so the file writes happen here, off the event loop
+            for part in ended:
+                await part.flush()
+                part.out.close()
+                staged.append(StagedUpload(
+                    filename=part.filename,
+                    temp_path=part.temp_path,
+                    content_hash=part.digest.hexdigest(),
+                    content_type=part.content_type or TEXT,
+                    size=part.size
+                ))
+            ended.clear()
+            if current is not None and not current.out.closed and len(current.buffer) >= chunk_bytes:
+                await current.flush()
+
+        if current is not None and not current.out.closed:
+            raise InvalidUploadException("The upload ended in the middle of a file")
+    except BaseException:
+        for part in parts:
+            part.discard()
+        raise
+
+    return staged
+
+
+def multipart_openapi(field_name: str, many: bool = False) -> dict[str, Any]:
+    """OpenAPI request body for a route reading its files with stage_multipart"""
+    schema: dict[str, Any] = {"type": "string", "format": "binary"}
+    if many:
+        schema = {"type": "array", "items": schema}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "properties": {field_name: schema},
+        "required": [field_name],
+    }}}}}
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Caps the request body of the routes taking uploads: POST /upload and
+    PUT /documents/{id}. A declared Content-Length over the
+    limit is refused before anything is read. Otherwise the body is counted as it
+    arrives, so a chunked upload is cut off once it passes the limit, rather than
+    being spooled to disk in full first
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int, routes: tuple[tuple[str, str], ...] = (
+            ("POST", r"/upload"),
+            ("PUT", r"/documents/\d+")
+    )):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.routes = [(method, re.compile(pattern)) for method, pattern in routes]
+
+    def _limits(self, scope: Scope) -> bool:
+        return scope["type"] == "http" and any(
+            scope["method"] == method and pattern.fullmatch(scope["path"]) for method, pattern in self.routes
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not self._limits(scope):
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Uploads are limited to {format_size(self.max_bytes)} per request"
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing, so this becomes the 413
+                    raise PayloadTooLargeException(detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
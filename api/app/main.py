@@ -1,27 +1,87 @@
-from fastapi.concurrency import asynccontextmanager
+import asyncio
+from fastapi.concurrency import asynccontextmanager, run_in_threadpool
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import Connection, inspect, text
 from app.core.database import Base, engine
 from app.documents.router import router
+from app.documents.uploads import UploadSizeLimitMiddleware
 from app.auth.router import router as auth_router
-from app.core.dependencies import initialize_ml_components
+from app.core.config import settings, setup_langsmith_env
+from app.core.metrics import MetricsMiddleware, registry
+from app.core.dependencies import (
+    close_chat_model, close_principal_cache, ml_status, shutdown_ml_components, shutdown_password_hasher, warm_up_ml_components
+)
+
+def create_schema(conn: Connection):
+    Base.metadata.create_all(bind=conn)
+    # create_all skips tables that already exist, so add columns and indexes introduced since.
+    # New columns are nullable, so the rows already there stay valid
+    inspector = inspect(conn)
+    quote = conn.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                conn.execute(text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} "
+                    f"{column.type.compile(dialect=conn.dialect)}"
+                ))
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_langsmith_env()
+
     # Create database tables
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(create_schema)
     
-    # Initialize ML components (embeddings, vector store, etc.)
+    # Initialize ML components (embeddings, vector store, etc.) in the background,
+    # so auth and health routes serve straight away. /readyz reports when they're done.
     print("Initializing ML components...")
-    initialize_ml_components()
-    print("ML components initialized successfully!")
+    # app.state.embedding_model, when set, replaces the configured model (used by the benchmarks)
+    warm_up = asyncio.create_task(
+        run_in_threadpool(warm_up_ml_components, getattr(app.state, "embedding_model", None))
+    )
     
     yield
 
+    await warm_up
+    shutdown_ml_components()
+    shutdown_password_hasher()
+    await close_chat_model()
+    await close_principal_cache()
+    await engine.dispose()
+
 app = FastAPI(title="Smart Document Q&A API", lifespan=lifespan)
 
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=settings.MAX_UPLOAD_REQUEST_BYTES)
 app.include_router(router)
 app.include_router(auth_router)
 
+@app.get("/healthz", tags=["Health"])
+async def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz", tags=["Health"])
+async def readyz(response: Response):
+    """Readiness: the ML components are loaded and document routes can be served"""
+    status = ml_status()
+    if status != "ready":
+        response.status_code = 503
+    return {"status": status}
+
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+    async def metrics():
+        """Request, stage and database latency histograms in the Prometheus text format"""
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,109 @@
+import json
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from langchain_core.documents import Document
+from app.core.logging import logger
+from app.shared.utils import docs_to_chunks
+
+# Shortest shared text treated as splitter overlap rather than coincidence
+MIN_OVERLAP_CHARS = 20
+
+
+@lru_cache(maxsize=None)
+def _encoding(name: str):
+    import tiktoken
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # tiktoken downloads the encoding on first use, which can fail offline
+        logger.warning(f"Token encoding {name} unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str, encoding: str = "cl100k_base") -> int:
+    enc = _encoding(encoding)
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def chunk_tokens(doc: Document, encoding: str = "cl100k_base") -> int:
+    """Tokens the chunk takes up once serialized by format_docs_structured"""
+    return count_tokens(json.dumps(docs_to_chunks([doc])[0], ensure_ascii=False), encoding)
+
+
+def _overlap(first: str, second: str, max_overlap: int) -> int:
+    """Length of the longest suffix of `first` that is also a prefix of `second`"""
+    for size in range(min(len(first), len(second), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+
+def _location(doc: Document) -> Tuple[Optional[str], Optional[str]]:
+    md = doc.metadata or {}
+    return md.get("source") or md.get("file_path"), md.get("page_number")
+
+
+def merge_adjacent(docs: List[Document], max_overlap: int) -> List[Document]:
+    """
+    Merge chunks from the same source and page whose text overlaps
+    (the splitter repeats up to chunk_overlap characters between neighbours),
+    keeping the rank and best score of the higher ranked chunk
+    """
+    merged: List[Document] = []
+
+    for doc in docs:
+        text = doc.page_content
+        for kept in merged:
+            if _location(kept) != _location(doc):
+                continue
+            if text in kept.page_content:
+                break
+            if kept.page_content in text:
+                kept.page_content = text
+                break
+            if size := _overlap(kept.page_content, text, max_overlap):
+                kept.page_content += text[size:]
+                break
+            if size := _overlap(text, kept.page_content, max_overlap):
+                kept.page_content = text + kept.page_content[size:]
+                break
+        else:
+            merged.append(Document(page_content=text, metadata=dict(doc.metadata or {})))
+            continue
+
+        score, kept_score = doc.metadata.get("score"), kept.metadata.get("score")
+        if score is not None and (kept_score is None or score < kept_score):
+            kept.metadata["score"] = score
+
+    return merged
+
+
+def pack_context(
+        docs: List[Document],
+        token_budget: int,
+        max_distance: Optional[float] = None,
+        max_overlap: int = 200,
+        encoding: str = "cl100k_base"
+) -> Tuple[List[Document], int, int]:
+    """
+    Fit the retrieved chunks (in rank order) into a token budget.
+    Drops chunks further than max_distance, merges overlapping neighbours, then keeps
+    chunks in rank order while they fit. Returns (packed docs, raw tokens, packed tokens)
+    """
+    raw_tokens = sum(chunk_tokens(doc, encoding) for doc in docs)
+
+    if max_distance is not None:
+        docs = [doc for doc in docs if doc.metadata.get("score") is None or doc.metadata["score"] <= max_distance]
+
+    packed: List[Document] = []
+    packed_tokens = 0
+    for doc in merge_adjacent(docs, max_overlap):
+        tokens = chunk_tokens(doc, encoding)
+        if packed_tokens + tokens > token_budget:
+            continue
+        packed.append(doc)
+        packed_tokens += tokens
+
+    return packed, raw_tokens, packed_tokens
@@ -1,9 +1,9 @@
 from typing import List, Dict, Any, cast
 import json
-from langchain.schema import Document
+from langchain_core.documents import Document
 
-def format_docs_structured(docs: List[Document]) -> str:
-    """Return a compact JSON list of chunks with useful metadata."""
+def docs_to_chunks(docs: List[Document]) -> List[Dict[str, Any]]:
+    """Return the retrieved chunks as plain dicts with useful metadata."""
     items: List[Dict[str, Any]] = []
     for i, d in enumerate(docs, start=1):
         md = cast(dict[str, str], d.metadata) or {} #type: ignore
@@ -14,8 +14,27 @@ def format_docs_structured(docs: List[Document]) -> str:
             "score": md.get("score"),  # may be None unless you add it (see below)
             "page_content": d.page_content
         })
+    return items
+
+def format_docs_structured(docs: List[Document]) -> str:
+    """Return a compact JSON list of chunks with useful metadata."""
+    items = docs_to_chunks(docs)
     # Using separators reduces risk of JSON breakage if content includes braces
     return json.dumps({"chunks": items}, ensure_ascii=False)
 
+def source_names(docs: List[Document]) -> List[str]:
+    """Unique source names of the retrieved chunks, in rank order"""
+    names: Dict[str, None] = {}
+    for d in docs:
+        md = cast(dict[str, str], d.metadata) or {} #type: ignore
+        name = md.get("source") or md.get("file_path")
+        if name:
+            names[name] = None
+    return list(names)
+
 def format_docs(docs: list[Document]):
-    return "\n\n".join([doc.page_content for doc in docs])
\ No newline at end of file
+    return "\n\n".join([doc.page_content for doc in docs])
+
+def format_sse(event: str, data: Any) -> str:
+    """Encode a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
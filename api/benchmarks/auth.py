@@ -0,0 +1,126 @@
+"""
+Login burst benchmark against a running server.
+
+Sends steady document traffic (one user asking questions, or listing sessions)
+and measures its latency alone, then again while a burst of concurrent logins
+runs. Reports login p50/p99, how many logins were shed with 503, and the
+document endpoint's latency in both phases.
+
+    uv run uvicorn app.main:app &
+    uv run python -m benchmarks.auth --url http://localhost:8000 --logins 500 --login-concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import httpx
+from benchmarks.stats import percentiles
+
+
+async def register(client: httpx.AsyncClient, username: str, password: str) -> str:
+    await client.post("/auth/register", params={"username": username, "password": password})
+    response = await client.post("/auth/login", data={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def document_traffic(
+        client: httpx.AsyncClient,
+        token: str,
+        endpoint: str,
+        stop: asyncio.Event,
+        concurrency: int
+) -> list[float]:
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies: list[float] = []
+
+    async def worker():
+        while not stop.is_set():
+            started = time.perf_counter()
+            if endpoint == "ask":
+                response = await client.post("/ask", json={"question": "What is the notice period?"}, headers=headers)
+            else:
+                response = await client.get("/sessions", headers=headers)
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def login_burst(client: httpx.AsyncClient, users: list[str], password: str, total: int, concurrency: int):
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/auth/login", data={"username": users[i % len(users)], "password": password})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(login(i) for i in range(total)))
+    return latencies, statuses
+
+
+async def run(args: argparse.Namespace) -> dict[str, object]:
+    limits = httpx.Limits(max_connections=args.login_concurrency + args.doc_concurrency + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=120, limits=limits) as client:
+        prefix = uuid.uuid4().hex[:8]
+        token = await register(client, f"bench-{prefix}-reader", args.password)
+        users = [f"bench-{prefix}-{i}" for i in range(args.users)]
+        for username in users:
+            await register(client, username, args.password)
+
+        # Document traffic on its own
+        stop = asyncio.Event()
+        traffic = asyncio.create_task(document_traffic(client, token, args.endpoint, stop, args.doc_concurrency))
+        await asyncio.sleep(args.baseline_seconds)
+        stop.set()
+        baseline = await traffic
+
+        # Document traffic during the login burst
+        stop = asyncio.Event()
+        traffic = asyncio.create_task(document_traffic(client, token, args.endpoint, stop, args.doc_concurrency))
+        started = time.perf_counter()
+        login_latencies, statuses = await login_burst(client, users, args.password, args.logins, args.login_concurrency)
+        burst_seconds = time.perf_counter() - started
+        stop.set()
+        during_burst = await traffic
+
+    return {
+        "logins": {
+            **percentiles(login_latencies),
+            "per_sec": round(len(login_latencies) / burst_seconds, 1),
+            "statuses": statuses,
+        },
+        f"{args.endpoint}_baseline": {**percentiles(baseline), "requests": len(baseline)},
+        f"{args.endpoint}_during_logins": {**percentiles(during_burst), "requests": len(during_burst)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--password", default="benchmark-password")
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--login-concurrency", type=int, default=100)
+    parser.add_argument("--endpoint", choices=["ask", "sessions"], default="ask")
+    parser.add_argument("--doc-concurrency", type=int, default=4)
+    parser.add_argument("--baseline-seconds", type=float, default=10)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
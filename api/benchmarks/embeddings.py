@@ -0,0 +1,93 @@
+"""
+Embedding throughput micro-benchmark.
+
+Embeds the same synthetic chunks through each backend via BatchingEmbeddings
+and reports chunks/sec, plus the cosine similarity of each backend's vectors
+to the first backend's so compatibility with an existing collection can be checked.
+
+    uv run python -m benchmarks.embeddings --backends torch onnx --chunks 2000
+"""
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from app.core.embeddings import BatchingEmbeddings, build_embedding_model
+
+WORDS = (
+    "agreement notice period termination employee employer salary holiday policy "
+    "contract clause party obligation payment invoice schedule confidential data "
+    "report quarter revenue growth customer service delivery warranty liability"
+).split()
+
+
+def make_chunks(count: int, words_per_chunk: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=words_per_chunk)) for _ in range(count)]
+
+
+def run_backend(args: argparse.Namespace, backend: str, chunks: list[str]) -> tuple[dict[str, object], np.ndarray]:
+    model = build_embedding_model(
+        args.model,
+        backend=backend,
+        onnx_file=args.onnx_file if backend == "onnx" else None,
+        threads=args.threads
+    )
+    embeddings = BatchingEmbeddings(model, batch_size=args.batch_size, max_wait_ms=args.wait_ms)
+    embeddings.embed_documents(chunks[:args.batch_size])  # warm-up
+
+    # Split the corpus between concurrent "uploads" so cross-request batching is exercised
+    per_upload = -(-len(chunks) // args.uploads)
+    parts = [chunks[i:i + per_upload] for i in range(0, len(chunks), per_upload)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.uploads) as pool:
+        results = list(pool.map(embeddings.embed_documents, parts))
+    elapsed = time.perf_counter() - started
+    embeddings.close()
+
+    vectors = np.array([v for part in results for v in part], dtype=np.float32)
+    return {
+        "backend": backend,
+        "chunks": len(chunks),
+        "seconds": round(elapsed, 3),
+        "chunks_per_sec": round(len(chunks) / elapsed, 1),
+        "batches": embeddings.batches,
+    }, vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="sentence-transformers/all-mpnet-base-v2")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"])
+    parser.add_argument("--onnx-file", default=None, help='e.g. "onnx/model_qint8_avx512_vnni.onnx"')
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--words-per-chunk", type=int, default=150)
+    parser.add_argument("--uploads", type=int, default=4, help="concurrent callers")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--wait-ms", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.words_per_chunk)
+    results: list[dict[str, object]] = []
+    baseline = None
+
+    for backend in args.backends:
+        result, vectors = run_backend(args, backend, chunks)
+        normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        if baseline is None:
+            baseline = normed
+        result["mean_cosine_to_" + args.backends[0]] = round(float((normed * baseline).sum(axis=1).mean()), 5)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+A local OpenAI-compatible chat completions server, so the real ChatOpenAI client
+(its connection pool, timeouts and the retries around it) can be exercised
+without network access or an API key.
+
+    uv run python -m benchmarks.fake_openai --port 9000 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 uv run uvicorn app.main:app
+
+Answers with --answer-tokens words, the first after --first-token-ms and the
+rest --token-ms apart, streamed as server-sent events when asked to. A share of
+requests (--error-rate) fails with a 429 or a 503 before answering, and past
+--max-concurrency requests in flight the rest get a 429, like a rate-limited API.
+A share of streamed answers (--drop-rate) is cut off after the first token, like
+a connection dropped mid-answer. GET /stats reports the requests served, the
+errors returned and the TCP connections clients opened (distinct client ports),
+to check keep-alive reuse.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import AsyncIterator
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from benchmarks.embeddings import WORDS
+
+
+def build_app(args: argparse.Namespace) -> Starlette:
+    rng = random.Random(args.seed)
+    stats = {"requests": 0, "streamed": 0, "rate_limited": 0, "server_errors": 0, "dropped": 0, "max_in_flight": 0}
+    connections: set[tuple[str, int]] = set()
+    in_flight = 0
+
+    def chunk(completion_id: str, model: str, delta: dict[str, str], finish_reason: str | None = None) -> str:
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(body)}\n\n"
+
+    async def completions(request: Request) -> Response:
+        nonlocal in_flight
+        if request.client:
+            connections.add((request.client.host, request.client.port))
+        body = await request.json()
+        model = body.get("model", "fake")
+        stats["requests"] += 1
+
+        if in_flight >= args.max_concurrency or rng.random() < args.error_rate / 2:
+            stats["rate_limited"] += 1
+            error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return JSONResponse(error, status_code=429, headers={"Retry-After": str(args.retry_after)})
+        if rng.random() < args.error_rate / 2:
+            stats["server_errors"] += 1
+            error = {"error": {"message": "The server is overloaded", "type": "server_error", "code": None}}
+            return JSONResponse(error, status_code=503)
+
+        tokens = [word + " " for word in rng.choices(WORDS, k=args.answer_tokens)]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        in_flight += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], in_flight)
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep((args.first_token_ms + args.token_ms * (len(tokens) - 1)) / 1000)
+            finally:
+                in_flight -= 1
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+        drop = rng.random() < args.drop_rate
+
+        async def stream() -> AsyncIterator[str]:
+            nonlocal in_flight
+            try:
+                yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+                for i, token in enumerate(tokens):
+                    await asyncio.sleep((args.first_token_ms if i == 0 else args.token_ms) / 1000)
+                    yield chunk(completion_id, model, {"content": token})
+                    if drop:
+                        stats["dropped"] += 1
+                        # The server closes the connection without finishing the response
+                        raise ConnectionAbortedError("Dropped mid-answer")
+                yield chunk(completion_id, model, {}, "stop")
+                yield "data: [DONE]\n\n"
+                stats["streamed"] += 1
+            finally:
+                in_flight -= 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    async def get_stats(request: Request) -> Response:
+        return JSONResponse({**stats, "connections": len(connections)})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", completions, methods=["POST"]),
+        Route("/stats", get_stats),
+    ])
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 429 or 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of streams cut off after the first token")
+    parser.add_argument("--max-concurrency", type=int, default=1000, help="requests in flight before 429s")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After sent with 429s, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(build_app(args), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
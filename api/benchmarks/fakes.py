@@ -0,0 +1,140 @@
+"""
+Offline stand-ins for the OpenAI chat model and the sentence-transformer,
+plus a seeded document corpus, so benchmarks run without network or GPUs
+and give the same work on every run.
+"""
+import asyncio
+import hashlib
+import math
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from benchmarks.embeddings import WORDS, make_chunks
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """
+    Answers with words chosen deterministically from the prompt, streamed one token
+    at a time after first_token_latency_ms, then token_latency_ms per token,
+    roughly like a hosted model does
+    """
+
+    answer_tokens: int = 40
+    first_token_latency_ms: float = 300
+    token_latency_ms: float = 20
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _tokens(self, messages: list[BaseMessage]) -> list[str]:
+        prompt = "".join(str(message.content) for message in messages)
+        rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+        words = rng.choices(WORDS, k=self.answer_tokens)
+        return [word + " " for word in words[:-1]] + words[-1:]
+
+    def _delay(self, index: int) -> float:
+        return (self.first_token_latency_ms if index == 0 else self.token_latency_ms) / 1000
+
+    def _generate(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(sum(self._delay(i) for i in range(len(tokens))))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(sum(self._delay(i) for i in range(len(tokens))))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens(messages)):
+            time.sleep(self._delay(i))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._tokens(messages)):
+            await asyncio.sleep(self._delay(i))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Hashes each word into one of `size` signed buckets and L2-normalizes, so texts
+    sharing words land close together and retrieval still returns sensible chunks.
+    latency_ms_per_text simulates the cost of a real model
+    """
+
+    def __init__(self, size: int = 384, latency_ms_per_text: float = 0.0):
+        self.size = size
+        self.latency_ms_per_text = latency_ms_per_text
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.size
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.size
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.latency_ms_per_text:
+            time.sleep(self.latency_ms_per_text * len(texts) / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def make_corpus(
+        documents: int,
+        paragraphs: int = 20,
+        words_per_paragraph: int = 80,
+        seed: int = 0
+) -> list[tuple[str, str]]:
+    """(filename, text) pairs of plain-text documents with blank-line separated paragraphs"""
+    corpus: list[tuple[str, str]] = []
+    for i in range(documents):
+        body = "\n\n".join(make_chunks(paragraphs, words_per_paragraph, seed=seed * 100003 + i))
+        corpus.append((f"document-{seed}-{i:04d}.txt", body))
+    return corpus
+
+
+def make_questions(count: int, seed: int = 0) -> list[str]:
+    return [f"What does the {chunk}?" for chunk in make_chunks(count, 8, seed=-1 - seed)]
@@ -0,0 +1,184 @@
+"""
+Large document ingest benchmark.
+
+Generates a synthetic text PDF with --pages pages, then ingests it in fresh
+interpreters two ways:
+
+    whole      the whole document parsed and split in one pool task, then every
+               chunk embedded and written at once
+    streaming  IngestionEngine: windows of INGEST_PAGE_WINDOW pages parsed ahead,
+               chunks embedded and written in batches of INGEST_FLUSH_CHUNKS
+
+Reports wall time, chunk count and the peak RSS of the main process and of the
+largest parsing worker (Linux). Embeddings are hashed (benchmarks/fakes.py) so
+the numbers reflect parsing, splitting and writing rather than the model.
+
+    uv run python -m benchmarks.ingest --pages 2000 --output ingest.json
+    INGEST_PAGE_WINDOW=50 uv run python -m benchmarks.ingest --pages 2000 --modes streaming
+"""
+import os
+
+os.environ.setdefault("OPENAI_KEY", "benchmark")
+os.environ.setdefault("JWT_KEY", "benchmark-secret-key")
+os.environ.setdefault("LANGSMITH_API_KEY", "benchmark")
+os.environ.setdefault("LANGSMITH_TRACING", "false")
+
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from benchmarks.embeddings import make_chunks
+from benchmarks.stats import peak_rss_mb
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_pdf(path: str, pages: int, lines_per_page: int = 50, seed: int = 0):
+    """Write a plain PDF of Helvetica text lines, one content stream per page"""
+    lines = iter(make_chunks(pages * lines_per_page, 10, seed=seed))
+    offsets: list[int] = []
+
+    with open(path, "wb") as f:
+        def write_object(body: bytes):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % len(offsets) + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        write_object(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for i in range(pages):
+            text = " ".join(f"({next(lines)}) Tj T*" for _ in range(lines_per_page))
+            stream = f"BT /F1 10 Tf 14 TL 40 760 Td {text} ET".encode()
+            write_object(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * i)
+            )
+            write_object(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref))
+
+
+def parse_whole(path: str, text_splitter) -> list:
+    """Parsing as it was before page windows: load every element, then split them all"""
+    from langchain_unstructured import UnstructuredLoader
+    from langchain_community.vectorstores.utils import filter_complex_metadata #type: ignore
+
+    return filter_complex_metadata(UnstructuredLoader(path).load_and_split(text_splitter))
+
+
+async def ingest(mode: str, pdf_path: str) -> dict[str, object]:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from app.core.config import settings
+    from app.core.database import DocumentRecord, SessionLocal, engine
+    from app.core.vector_store import TenantVectorStores
+    from app.documents.cache import AnswerCache
+    from app.documents.ingestion import IngestionEngine, SavedUpload
+    from app.main import create_schema
+    from benchmarks.fakes import HashEmbeddings
+
+    vector_stores = TenantVectorStores(HashEmbeddings(), "./chroma")
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP, length_function=len
+    )
+    vector_store = vector_stores.for_owner("benchmark")
+
+    started = time.perf_counter()
+    if mode == "whole":
+        pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        chunks = await asyncio.get_running_loop().run_in_executor(pool, parse_whole, pdf_path, text_splitter)
+        pool.shutdown()
+        vectors = vector_store.embeddings.embed_documents([chunk.page_content for chunk in chunks])
+        ids = [str(i) for i in range(len(chunks))]
+        # Chroma caps the records per write, a single add_documents call fails past it
+        step = vector_stores.client.get_max_batch_size()
+        for start in range(0, len(chunks), step):
+            vector_store.add(chunks[start:start + step], vectors[start:start + step], ids[start:start + step])
+        chunk_count = len(chunks)
+    else:
+        async with engine.begin() as conn:
+            await conn.run_sync(create_schema)
+        async with SessionLocal() as db:
+            record = DocumentRecord(
+                owner="benchmark", filename="large.pdf", content_hash="", created_at=datetime.now(timezone.utc)
+            )
+            db.add(record)
+            await db.commit()
+
+        ingestion_engine = IngestionEngine(vector_stores, text_splitter, AnswerCache(maxsize=1, ttl_seconds=1))
+        job = await ingestion_engine.submit(
+            "benchmark", [SavedUpload("large.pdf", pdf_path, "benchmark", record.id, is_new=True)]
+        )
+        while job.status == "running":
+            await asyncio.sleep(0.05)
+        ingestion_engine.pool.shutdown()
+        if job.files[0].error:
+            raise RuntimeError(job.files[0].error)
+        chunk_count = job.files[0].chunks
+        await engine.dispose()
+
+    return {
+        "seconds": round(time.perf_counter() - started, 2),
+        "chunks": chunk_count,
+        "peak_rss_mb": peak_rss_mb(),
+        # Largest of the finished child processes, i.e. the parsing workers
+        "worker_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def run_child(mode: str, pdf_path: str) -> dict[str, object]:
+    workdir = tempfile.mkdtemp(prefix=f"papertrail-ingest-{mode}-")
+    output = os.path.join(workdir, "result.json")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [API_DIR, os.environ.get("PYTHONPATH")]))}
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.ingest", "--child", mode, "--pdf", pdf_path, "--output", output],
+        cwd=workdir, env=env, check=True
+    )
+    with open(output) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--modes", nargs="+", choices=["whole", "streaming"], default=["whole", "streaming"])
+    parser.add_argument("--pdf", default=None, help="ingest this PDF instead of generating one")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--child", choices=["whole", "streaming"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = asyncio.run(ingest(args.child, args.pdf))
+        with open(args.output, "w") as f:
+            json.dump(result, f)
+        return
+
+    pdf_path = args.pdf
+    if pdf_path is None:
+        pdf_path = os.path.join(tempfile.mkdtemp(), "large.pdf")
+        make_pdf(pdf_path, args.pages)
+
+    results: dict[str, object] = {
+        "pdf_mb": round(os.path.getsize(pdf_path) / (1024 * 1024), 1),
+        **{mode: run_child(mode, os.path.abspath(pdf_path)) for mode in args.modes},
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+"""
+Offline load benchmark for the whole API.
+
+Runs the app with a fake streaming chat model and hashed embeddings (see
+benchmarks/fakes.py), so no OpenAI key, network or model download is needed,
+against a fresh database and vector store in a temporary directory. Then drives
+a seeded workload through the real routes:
+
+    login     concurrent /auth/login
+    upload    /upload of a generated corpus, timed until every ingest job is done
+    ask       /ask with distinct questions (cache misses)
+    stream    /ask/stream, also reporting time to first token
+    batch     /ask/batch with the same number of distinct questions, --batch-size per request
+    burst     /ask with one new question per user, asked --burst times at once, as after an announcement
+    history   /history of the sessions created by the ask phase
+    sessions  /sessions
+
+Reports throughput, p50/p95/p99 latency and the server's peak RSS as JSON,
+optionally next to a previous run for comparison.
+
+    uv run python -m benchmarks.load --mode inprocess --output before.json
+    uv run python -m benchmarks.load --mode http --concurrency 32 --baseline before.json
+
+--mode inprocess calls the ASGI app directly (no sockets, the client shares the
+process); --mode http starts `uvicorn` in a subprocess on a free port. Time to
+first token is only measured in http mode, in-process responses arrive whole.
+
+--llm server swaps the fake chat model for the real OpenAI client pointed at
+benchmarks/fake_openai.py in a subprocess, so the LLM calls go over HTTP through
+the pooled client, the concurrency limit and the retries (--llm-error-rate
+injects 429s and 503s). The server's request, error and connection counts are
+reported under llm_server.
+"""
+import os
+
+# Settings are read on import, so the fakes need these before the app is imported
+os.environ.setdefault("OPENAI_KEY", "benchmark")
+os.environ.setdefault("JWT_KEY", "benchmark-secret-key")
+os.environ.setdefault("LANGSMITH_API_KEY", "benchmark")
+os.environ.setdefault("LANGSMITH_TRACING", "false")
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+import httpx
+from benchmarks.fakes import FakeStreamingChatModel, HashEmbeddings, make_corpus, make_questions
+from benchmarks.stats import peak_rss_mb, percentiles
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchmark-password"
+
+
+def build_app(args: argparse.Namespace):
+    """The real app, with the embedding model and (unless --llm server) the chat model replaced by the fakes"""
+    from app.core.dependencies import get_chat_model
+    from app.main import app
+
+    app.state.embedding_model = HashEmbeddings(latency_ms_per_text=args.embed_ms)
+    if args.llm == "server":
+        return app
+    llm = FakeStreamingChatModel(
+        answer_tokens=args.answer_tokens,
+        first_token_latency_ms=args.first_token_ms,
+        token_latency_ms=args.token_ms
+    )
+    app.dependency_overrides[get_chat_model] = lambda: llm
+    return app
+
+
+async def run_scenario(
+        count: int,
+        concurrency: int,
+        request: Callable[[int], Awaitable[Optional[float]]]
+) -> dict[str, object]:
+    """
+    Calls request(i) for i in range(count), at most `concurrency` at once. request
+    raises on failure and may return an extra timing (e.g. time to first token)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    extra: list[float] = []
+    errors: dict[str, int] = {}
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                timing = await request(i)
+            except Exception as e:
+                key = str(e.response.status_code) if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+                errors[key] = errors.get(key, 0) + 1
+                return
+            latencies.append((time.perf_counter() - started) * 1000)
+            if timing is not None:
+                extra.append(timing)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - started
+
+    result: dict[str, object] = {
+        "requests": count,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "per_sec": round(len(latencies) / elapsed, 1),
+        **percentiles(latencies),
+    }
+    if extra:
+        result["first_token"] = percentiles(extra)
+    return result
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("The app did not become ready in time")
+
+
+async def run_workload(client: httpx.AsyncClient, args: argparse.Namespace) -> dict[str, object]:
+    await wait_ready(client)
+    rng = random.Random(args.seed)
+    prefix = uuid.uuid4().hex[:8]
+    users = [f"load-{prefix}-{i}" for i in range(args.users)]
+    for username in users:
+        (await client.post("/auth/register", params={"username": username, "password": PASSWORD})).raise_for_status()
+
+    scenarios: dict[str, object] = {}
+    tokens: dict[str, str] = {}
+
+    async def login(i: int) -> None:
+        username = users[i % len(users)]
+        response = await client.post("/auth/login", data={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        tokens[username] = response.json()["access_token"]
+
+    scenarios["login"] = await run_scenario(max(args.logins, len(users)), args.concurrency, login)
+
+    def headers(i: int) -> dict[str, str]:
+        return {"Authorization": f"Bearer {tokens[users[i % len(users)]]}"}
+
+    # Every user uploads its share of the corpus; time until all jobs have finished
+    corpus = make_corpus(args.documents, args.paragraphs, seed=args.seed)
+    shares = [corpus[i::len(users)] for i in range(len(users))]
+    chunks = 0
+
+    async def upload(i: int) -> None:
+        nonlocal chunks
+        if not shares[i]:
+            return
+        files = [("files", (name, text.encode(), "text/plain")) for name, text in shares[i]]
+        response = await client.post("/upload", files=files, headers=headers(i))
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        while True:
+            job = (await client.get(f"/upload/jobs/{job_id}", headers=headers(i))).json()
+            if job["status"] != "running":
+                break
+            await asyncio.sleep(0.1)
+        failed = [f["filename"] for f in job["files"] if f["status"] == "failed"]
+        if failed:
+            raise RuntimeError(f"Ingest failed for {failed}")
+        chunks += sum(f["chunks"] for f in job["files"])
+
+    scenarios["upload"] = await run_scenario(len(users), args.concurrency, upload)
+    scenarios["upload"]["documents"] = len(corpus)
+    scenarios["upload"]["chunks"] = chunks
+
+    # Distinct questions, spread over a few sessions per user
+    questions = make_questions(args.asks * 2, seed=args.seed)
+    rng.shuffle(questions)
+
+    def session_id(i: int) -> str:
+        return f"{users[i % len(users)]}-session-{i // len(users) % args.sessions_per_user}"
+
+    async def ask(i: int) -> None:
+        response = await client.post(
+            "/ask",
+            json={"question": questions[i], "session_id": session_id(i)},
+            headers=headers(i)
+        )
+        response.raise_for_status()
+
+    scenarios["ask"] = await run_scenario(args.asks, args.concurrency, ask)
+
+    async def stream(i: int) -> float:
+        started = time.perf_counter()
+        first_token: Optional[float] = None
+        async with client.stream(
+            "POST",
+            "/ask/stream",
+            json={"question": questions[args.asks + i], "session_id": session_id(i)},
+            headers=headers(i)
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.startswith("event: error"):
+                    raise RuntimeError("Stream reported an error")
+                if first_token is None and line == "event: token":
+                    first_token = (time.perf_counter() - started) * 1000
+        if first_token is None:
+            raise RuntimeError("Stream ended without tokens")
+        # ASGITransport hands over the body only once the response is complete
+        return first_token if args.mode == "http" else None
+
+    scenarios["stream"] = await run_scenario(args.asks, args.concurrency, stream)
+
+    # The ask workload again, as a few batch requests instead of one request per question
+    batch_questions = make_questions(args.asks, seed=args.seed + 1)
+    batches = [batch_questions[start:start + args.batch_size] for start in range(0, args.asks, args.batch_size)]
+
+    async def batch(i: int) -> None:
+        response = await client.post(
+            "/ask/batch",
+            json={"questions": [{"question": question} for question in batches[i]]},
+            headers=headers(i)
+        )
+        response.raise_for_status()
+        failed = [result for result in response.json()["results"] if result["error"]]
+        if failed:
+            raise RuntimeError(f"{len(failed)} questions in the batch failed")
+
+    scenarios["batch"] = await run_scenario(len(batches), args.concurrency, batch)
+    scenarios["batch"]["questions"] = args.asks
+    scenarios["batch"]["questions_per_sec"] = round(args.asks / scenarios["batch"]["seconds"], 1)  # type: ignore
+
+    # Everyone asks the same fresh question at once, identical ones share a generation
+    burst_questions = make_questions(len(users), seed=args.seed + 2)
+
+    async def burst(i: int) -> None:
+        response = await client.post(
+            "/ask",
+            json={"question": burst_questions[i % len(users)], "session_id": session_id(i)},
+            headers=headers(i)
+        )
+        response.raise_for_status()
+
+    scenarios["burst"] = await run_scenario(args.burst, args.burst, burst)
+
+    async def history(i: int) -> None:
+        response = await client.get("/history", params={"session_id": session_id(i)}, headers=headers(i))
+        response.raise_for_status()
+
+    scenarios["history"] = await run_scenario(args.reads, args.concurrency, history)
+
+    async def sessions(i: int) -> None:
+        (await client.get("/sessions", headers=headers(i))).raise_for_status()
+
+    scenarios["sessions"] = await run_scenario(args.reads, args.concurrency, sessions)
+    return scenarios
+
+
+async def run_inprocess(args: argparse.Namespace) -> dict[str, object]:
+    app = build_app(args)
+    from app.main import lifespan
+
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            scenarios = await run_workload(client, args)
+        return {"scenarios": scenarios, "peak_rss_mb": peak_rss_mb()}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_http(args: argparse.Namespace) -> dict[str, object]:
+    port = free_port()
+    command = [sys.executable, "-m", "benchmarks.load", "--serve", "--port", str(port), *sys.argv[1:]]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [API_DIR, os.environ.get("PYTHONPATH")]))}
+    server = subprocess.Popen(command, env=env)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency + 10)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300, limits=limits) as client:
+            scenarios = await run_workload(client, args)
+        return {"scenarios": scenarios, "peak_rss_mb": peak_rss_mb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def start_llm_server(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    """benchmarks/fake_openai.py on a free port, and its base URL once it answers"""
+    port = free_port()
+    command = [
+        sys.executable, "-m", "benchmarks.fake_openai", "--port", str(port), "--seed", str(args.seed),
+        "--answer-tokens", str(args.answer_tokens), "--first-token-ms", str(args.first_token_ms),
+        "--token-ms", str(args.token_ms), "--error-rate", str(args.llm_error_rate)
+    ]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [API_DIR, os.environ.get("PYTHONPATH")]))}
+    server = subprocess.Popen(command, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{base_url}/stats").raise_for_status()
+            return server, f"{base_url}/v1"
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The fake OpenAI server did not start in time")
+
+
+def serve(args: argparse.Namespace):
+    import uvicorn
+
+    uvicorn.run(build_app(args), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result: dict[str, object], baseline: dict[str, object]) -> dict[str, object]:
+    """Relative change of each scenario's throughput and latency percentiles against the baseline"""
+    changes: dict[str, object] = {}
+    for name, current in result["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        changes[name] = {
+            key: f"{(current[key] - before[key]) / before[key] * 100:+.1f}%"
+            for key in ("per_sec", "p50_ms", "p95_ms", "p99_ms")
+            if current.get(key) is not None and before.get(key)
+        }
+    if baseline.get("peak_rss_mb"):
+        changes["peak_rss_mb"] = f"{result['peak_rss_mb'] - baseline['peak_rss_mb']:+.1f}"
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--documents", type=int, default=40)
+    parser.add_argument("--paragraphs", type=int, default=20, help="paragraphs per document")
+    parser.add_argument("--asks", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=25, help="questions per /ask/batch request")
+    parser.add_argument("--burst", type=int, default=64, help="concurrent requests in the burst scenario")
+    parser.add_argument("--sessions-per-user", type=int, default=3)
+    parser.add_argument("--reads", type=int, default=200, help="requests each for /history and /sessions")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--llm", choices=["model", "server"], default="model",
+                        help="fake chat model in process, or the OpenAI client against benchmarks/fake_openai.py")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of fake server calls failing")
+    parser.add_argument("--embed-ms", type=float, default=0.0, help="simulated embedding cost per text")
+    parser.add_argument("--baseline", default=None, help="previous --output to compare against")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=8000, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.output = args.output and os.path.abspath(args.output)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+
+    # A fresh database, vector store and upload directory for every run (settings paths are relative)
+    workdir = tempfile.mkdtemp(prefix="papertrail-load-")
+    os.chdir(workdir)
+    if args.serve:
+        serve(args)
+        return
+
+    llm_server = None
+    if args.llm == "server":
+        # Read by the settings, here and in the uvicorn subprocess of --mode http
+        llm_server, os.environ["OPENAI_BASE_URL"] = start_llm_server(args)
+
+    run = run_http if args.mode == "http" else run_inprocess
+    try:
+        result: dict[str, object] = {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("serve", "port", "baseline", "output")},
+            **asyncio.run(run(args)),
+        }
+        if llm_server is not None:
+            result["llm_server"] = httpx.get(os.environ["OPENAI_BASE_URL"].removesuffix("/v1") + "/stats").json()
+    finally:
+        if llm_server is not None:
+            llm_server.terminate()
+            llm_server.wait(timeout=30)
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["compared_to_baseline"] = compare(result, json.load(f))
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
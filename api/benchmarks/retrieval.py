@@ -0,0 +1,99 @@
+"""
+Tenant-scoped retrieval benchmark.
+
+Indexes a fixed corpus for one user, then grows the data of other users and
+measures that user's query latency against per-user collections (what the app
+uses) and against one shared collection filtered by owner metadata.
+
+    uv run python -m benchmarks.retrieval --user-chunks 2000 --other-chunks 0 20000 100000
+"""
+import argparse
+import json
+import statistics
+import tempfile
+import time
+import chromadb
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from app.core.vector_store import ChromaVectorStore, TenantVectorStores
+from benchmarks.embeddings import make_chunks
+
+
+def collection(tenants: TenantVectorStores, owner: str) -> Chroma:
+    store = tenants.for_owner(owner)
+    assert isinstance(store, ChromaVectorStore)
+    return store.store
+
+
+def add_chunks(store: Chroma, owner: str, count: int, offset: int, batch_size: int = 5000):
+    texts = make_chunks(count, 40, seed=offset)
+    for start in range(0, count, batch_size):
+        batch = texts[start:start + batch_size]
+        store.add_texts(
+            batch,
+            metadatas=[{"owner": owner, "document_id": 1} for _ in batch],
+            ids=[f"{owner}-{offset + start + i}" for i in range(len(batch))]
+        )
+
+
+def time_queries(store: Chroma, queries: list[str], search_filter: dict[str, str] | None) -> dict[str, float]:
+    latencies: list[float] = []
+    for query in queries:
+        started = time.perf_counter()
+        store.similarity_search_with_score(query, filter=search_filter)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-chunks", type=int, default=2000)
+    parser.add_argument("--other-chunks", type=int, nargs="+", default=[0, 20000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    embeddings = DeterministicFakeEmbedding(size=args.dimensions)
+    queries = make_chunks(args.queries, 12, seed=-1)
+
+    tenants = TenantVectorStores(embeddings, tempfile.mkdtemp())
+    shared = Chroma(
+        collection_name="shared",
+        embedding_function=embeddings,
+        client=chromadb.PersistentClient(path=tempfile.mkdtemp())
+    )
+    add_chunks(collection(tenants, "alice"), "alice", args.user_chunks, 0)
+    add_chunks(shared, "alice", args.user_chunks, 0)
+
+    results: list[dict[str, object]] = []
+    indexed_other = 0
+    for other_chunks in sorted(args.other_chunks):
+        # Spread the other users' data over several tenants
+        growth = other_chunks - indexed_other
+        for i in range(10):
+            owner = f"user{i}"
+            count = growth // 10
+            add_chunks(collection(tenants, owner), owner, count, indexed_other)
+            add_chunks(shared, owner, count, indexed_other)
+        indexed_other = other_chunks
+
+        result = {
+            "other_chunks": other_chunks,
+            "per_user_collection": time_queries(collection(tenants, "alice"), queries, None),
+            "shared_collection_filtered": time_queries(shared, queries, {"owner": "alice"}),
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
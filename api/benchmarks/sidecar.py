@@ -0,0 +1,103 @@
+"""
+Embedding sidecar benchmark.
+
+Runs N worker processes that each embed their share of a synthetic corpus,
+first with every worker loading its own model (the default) and then through
+one shared embedding sidecar. Reports overall chunks/sec and the resident
+memory of the workers and the sidecar (Linux, read from /proc).
+
+    uv run python -m benchmarks.sidecar --workers 8 --chunks 4000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from app.core.config import settings
+from benchmarks.embeddings import make_chunks
+from benchmarks.stats import rss_mb
+
+
+def worker(mode: str, socket_path: str, chunks: list[str], request_size: int, barrier, results):
+    from app.core.embeddings import BatchingEmbeddings, RemoteEmbeddings, build_embedding_model
+
+    if mode == "sidecar":
+        embeddings = RemoteEmbeddings(socket_path)
+    else:
+        embeddings = BatchingEmbeddings(
+            build_embedding_model(settings.EMBEDDING_MODEL, backend=settings.EMBEDDING_BACKEND),
+            batch_size=settings.EMBEDDING_BATCH_SIZE,
+            max_wait_ms=settings.EMBEDDING_BATCH_WAIT_MS
+        )
+    embeddings.embed_documents(chunks[:1])  # load the model / open the connection
+
+    barrier.wait()
+    for start in range(0, len(chunks), request_size):
+        embeddings.embed_documents(chunks[start:start + request_size])
+    results.put(rss_mb())
+
+
+def run(mode: str, args: argparse.Namespace, chunks: list[str], socket_path: str) -> dict[str, object]:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.workers + 1)
+    results = context.Queue()
+    share = len(chunks) // args.workers
+    processes = [
+        context.Process(
+            target=worker,
+            args=(mode, socket_path, chunks[i * share:(i + 1) * share], args.request_size, barrier, results)
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    barrier.wait()
+    started = time.perf_counter()
+    worker_rss = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    return {
+        "chunks_per_sec": round(share * args.workers / elapsed, 1),
+        "worker_rss_mb": round(sum(worker_rss) / len(worker_rss), 1),
+        "total_worker_rss_mb": round(sum(worker_rss), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=4000)
+    parser.add_argument("--words", type=int, default=150, help="words per chunk")
+    parser.add_argument("--request-size", type=int, default=16, help="chunks per embed_documents call")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.words)
+    results: dict[str, object] = {"per_worker_model": run("local", args, chunks, "")}
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "embeddings.sock")
+    sidecar = subprocess.Popen([sys.executable, "-m", "app.core.embedding_server", "--socket", socket_path])
+    try:
+        while not os.path.exists(socket_path):
+            if sidecar.poll() is not None:
+                raise RuntimeError("Embedding sidecar exited during startup")
+            time.sleep(0.1)
+        results["sidecar"] = {**run("sidecar", args, chunks, socket_path), "sidecar_rss_mb": rss_mb(sidecar.pid)}
+    finally:
+        sidecar.terminate()
+        sidecar.wait(timeout=30)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Cold start benchmark.
+
+Measures, in fresh interpreters, how long `import app.main` takes and how long
+a uvicorn worker takes to answer /healthz (accepting traffic) and /readyz
+(ML components warmed up). Each run uses a scratch working directory, so the
+database and Chroma files are created from scratch.
+
+    uv run python -m benchmarks.startup --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def child_env() -> dict[str, str]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [API_DIR, env.get("PYTHONPATH")]))
+    # The scratch directory has no .env, so pass the settings through
+    env_file = os.path.join(API_DIR, ".env")
+    if os.path.exists(env_file):
+        with open(env_file) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep and not key.startswith("#"):
+                    env.setdefault(key.strip(), value.strip().strip("\"'"))
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        cwd=tempfile.mkdtemp(), env=child_env(), capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def wait_for(url: str, started: float, timeout: float) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def time_server(timeout: float) -> dict[str, float]:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=tempfile.mkdtemp(), env=child_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        live = wait_for(f"http://127.0.0.1:{port}/healthz", started, timeout)
+        ready = wait_for(f"http://127.0.0.1:{port}/readyz", started, timeout)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {"healthz_seconds": live, "readyz_seconds": ready}
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {"median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    imports = [time_import() for _ in range(args.runs)]
+    servers = [time_server(args.timeout) for _ in range(args.runs)]
+
+    result = {
+        "import_app_main_seconds": summarize(imports),
+        "healthz_seconds": summarize([run["healthz_seconds"] for run in servers]),
+        "readyz_seconds": summarize([run["readyz_seconds"] for run in servers]),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
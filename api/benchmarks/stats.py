@@ -0,0 +1,38 @@
+"""Helpers shared by the benchmark scripts"""
+import resource
+import statistics
+
+
+def percentiles(latencies: list[float]) -> dict[str, float]:
+    """p50/p95/p99 of latencies in milliseconds"""
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[max(0, int(len(latencies) * 0.95) - 1)], 2),
+        "p99_ms": round(latencies[max(0, int(len(latencies) * 0.99) - 1)], 2),
+    }
+
+
+def _proc_status_mb(field: str, pid: int | str) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return 0.0
+
+
+def rss_mb(pid: int | str = "self") -> float:
+    """Current resident memory of a process (Linux)"""
+    return _proc_status_mb("VmRSS", pid)
+
+
+def peak_rss_mb(pid: int | str = "self") -> float:
+    """Peak resident memory of a process, falling back to getrusage for this process off Linux"""
+    try:
+        return _proc_status_mb("VmHWM", pid)
+    except FileNotFoundError:
+        if pid != "self":
+            raise
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
@@ -0,0 +1,219 @@
+"""
+Vector store backend benchmark.
+
+Writes the same seeded corpus (unit vectors at the embedding model's
+dimensions, clustered by document) into each backend, then opens every
+store in a fresh interpreter and reports:
+
+    write_s            time to add the whole corpus
+    open_ms            time to open the store, first_query_ms the query after it
+    unfiltered, filtered
+                       query latency percentiles, the filtered ones restricted to
+                       two documents with {"document_id": {"$in": [...]}} as /ask does
+    recall             share of the exact top k each backend returned
+    rss_mb             resident memory of the querying process after the queries
+
+Backends: chroma, flat (float32), flat-float16, flat-int8 and flat-hnsw (needs hnswlib).
+
+    uv run python -m benchmarks.vectorstore --chunks 100000 --output vectorstore.json
+    uv run python -m benchmarks.vectorstore --chunks 20000 --backends chroma flat flat-int8
+"""
+import os
+
+os.environ.setdefault("OPENAI_KEY", "benchmark")
+os.environ.setdefault("JWT_KEY", "benchmark-secret-key")
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from langchain_core.documents import Document
+from benchmarks.embeddings import make_chunks
+from benchmarks.stats import percentiles, rss_mb
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = {
+    "chroma": {"backend": "chroma"},
+    "flat": {"backend": "flat"},
+    "flat-float16": {"backend": "flat", "dtype": "float16"},
+    "flat-int8": {"backend": "flat", "dtype": "int8"},
+    "flat-hnsw": {"backend": "flat", "hnsw": True},
+}
+OWNER = "benchmark"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_vectors(count: int, documents: int, dimensions: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Unit vectors clustered by document around a random topic per document, as
+    chunks of one document embed close together. Returns them with their document ids
+    """
+    rng = np.random.default_rng(seed)
+    topics = _normalize(rng.standard_normal((documents, dimensions), dtype=np.float32))
+    document_ids = np.arange(count) % documents
+    noise = rng.standard_normal((count, dimensions), dtype=np.float32) / np.sqrt(dimensions)
+    return _normalize(topics[document_ids] + noise), document_ids
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int) -> np.ndarray:
+    """Chunks moved a little way off, like a question about that chunk"""
+    rng = np.random.default_rng(seed + 1)
+    noise = rng.standard_normal((count, vectors.shape[1]), dtype=np.float32) * 0.5 / np.sqrt(vectors.shape[1])
+    return _normalize(vectors[rng.integers(0, len(vectors), count)] + noise)
+
+
+def query_filter(i: int, documents: int) -> dict[str, object]:
+    return {"document_id": {"$in": [i % documents, (i + 1) % documents]}}
+
+
+def exact_top_k(
+        vectors: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        document_ids: np.ndarray | None = None,
+        documents: int = 0
+) -> list[set[int]]:
+    results: list[set[int]] = []
+    for i, query in enumerate(queries):
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        if document_ids is not None:
+            distances[~np.isin(document_ids, query_filter(i, documents)["document_id"]["$in"])] = np.inf  # type: ignore
+        results.append(set(np.argsort(distances)[:k].tolist()))
+    return results
+
+
+def open_stores(name: str, directory: str):
+    from app.core.vector_store import TenantVectorStores
+
+    options = BACKENDS[name]
+    return TenantVectorStores(
+        None,  # type: ignore  # vectors are passed in, nothing is embedded
+        persist_directory=directory,
+        backend=options["backend"],
+        dtype=options.get("dtype", "float32"),
+        hnsw=options.get("hnsw", False)
+    )
+
+
+def write(name: str, directory: str, data: str, batch_size: int) -> dict[str, object]:
+    vectors = np.load(os.path.join(data, "vectors.npy"))
+    document_ids = np.load(os.path.join(data, "document_ids.npy"))
+    texts = make_chunks(len(vectors), 40)
+
+    store = open_stores(name, directory).for_owner(OWNER)
+    started = time.perf_counter()
+    for start in range(0, len(vectors), batch_size):
+        end = min(start + batch_size, len(vectors))
+        store.add(
+            [
+                Document(page_content=texts[i], metadata={"owner": OWNER, "document_id": int(document_ids[i])})
+                for i in range(start, end)
+            ],
+            vectors[start:end].tolist(),
+            [str(i) for i in range(start, end)]
+        )
+    return {"write_s": round(time.perf_counter() - started, 2)}
+
+
+def query(name: str, directory: str, data: str, k: int, documents: int) -> dict[str, object]:
+    queries = np.load(os.path.join(data, "queries.npy"))
+
+    started = time.perf_counter()
+    store = open_stores(name, directory).for_owner(OWNER)
+    open_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    store.search(queries[0].tolist(), k)
+    first_query_ms = (time.perf_counter() - started) * 1000
+
+    result: dict[str, object] = {"open_ms": round(open_ms, 1), "first_query_ms": round(first_query_ms, 1)}
+    for mode in ("unfiltered", "filtered"):
+        latencies: list[float] = []
+        hits: list[list[int]] = []
+        for i, vector in enumerate(queries.tolist()):
+            started = time.perf_counter()
+            found = store.search(vector, k, query_filter(i, documents) if mode == "filtered" else None)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits.append([int(document.id) for document, _ in found])  # type: ignore
+        result[mode] = percentiles(latencies)
+        result[f"{mode}_hits"] = hits
+    result["rss_mb"] = rss_mb()
+    return result
+
+
+def run_child(*args: str) -> dict[str, object]:
+    with tempfile.TemporaryDirectory() as workdir:
+        output = os.path.join(workdir, "result.json")
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [API_DIR, os.environ.get("PYTHONPATH")]))}
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.vectorstore", "--child", *args, "--output", output],
+            cwd=workdir, env=env, check=True
+        )
+        with open(output) as f:
+            return json.load(f)
+
+
+def recall(hits: list[list[int]], expected: list[set[int]]) -> float:
+    found = sum(len(expected_ids & set(ids)) for ids, expected_ids in zip(hits, expected))
+    return round(found / max(1, sum(len(expected_ids) for expected_ids in expected)), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--child", nargs=3, metavar=("STEP", "BACKEND", "DIRECTORY"), help=argparse.SUPPRESS)
+    parser.add_argument("--data", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        step, name, directory = args.child
+        if step == "write":
+            result = write(name, directory, args.data, args.batch_size)
+        else:
+            result = query(name, directory, args.data, args.k, args.documents)
+        with open(args.output, "w") as f:
+            json.dump(result, f)
+        return
+
+    data = tempfile.mkdtemp(prefix="papertrail-vectors-")
+    vectors, document_ids = make_vectors(args.chunks, args.documents, args.dimensions, args.seed)
+    queries = make_queries(vectors, args.queries, args.seed)
+    np.save(os.path.join(data, "vectors.npy"), vectors)
+    np.save(os.path.join(data, "document_ids.npy"), document_ids)
+    np.save(os.path.join(data, "queries.npy"), queries)
+    expected = {
+        "unfiltered": exact_top_k(vectors, queries, args.k),
+        "filtered": exact_top_k(vectors, queries, args.k, document_ids, args.documents),
+    }
+
+    common = ["--data", data, "--k", str(args.k), "--documents", str(args.documents), "--batch-size", str(args.batch_size)]
+    results: dict[str, object] = {}
+    for name in args.backends:
+        directory = os.path.join(data, name)
+        result = run_child("write", name, directory, *common)
+        result.update(run_child("query", name, directory, *common))
+        for mode in ("unfiltered", "filtered"):
+            result[f"{mode}_recall"] = recall(result.pop(f"{mode}_hits"), expected[mode])  # type: ignore
+        results[name] = result
+        print(json.dumps({name: result}))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+The app runs against a throwaway SQLite database, vector store and upload
+directory, with the offline embedding model from the benchmarks. Settings
+are read when the app is imported, so point them here first.
+"""
+import os
+import tempfile
+import uuid
+
+_data_dir = tempfile.mkdtemp(prefix="papertrail-tests-")
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URL": f"sqlite:///{_data_dir}/db.sqlite",
+    "UPLOAD_DIR": os.path.join(_data_dir, "uploads"),
+    "CHROME_DIR": os.path.join(_data_dir, "chroma"),
+    "FLAT_VECTOR_DIR": os.path.join(_data_dir, "vectors"),
+    "EMBEDDING_CACHE_DIR": os.path.join(_data_dir, "embedding_cache"),
+    "CORPUS_STATE_TTL_SECONDS": "0",  # no other workers to wait for
+})
+os.environ.setdefault("OPENAI_KEY", "test")
+os.environ.setdefault("JWT_KEY", "test-secret-key-at-least-32-bytes!")
+os.environ.setdefault("LANGSMITH_API_KEY", "test")
+os.environ["LANGSMITH_TRACING"] = "false"
+
+import asyncio
+from typing import AsyncIterator
+import httpx
+import pytest
+from app.main import app, lifespan
+from benchmarks.fakes import HashEmbeddings
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def client() -> AsyncIterator[httpx.AsyncClient]:
+    """A client for the app, once the ML components are ready"""
+    app.state.embedding_model = HashEmbeddings()
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as c:
+            while (await c.get("/readyz")).json()["status"] == "starting":
+                await asyncio.sleep(0.05)
+            yield c
+    app.dependency_overrides.clear()
+
+
+async def _register(client: httpx.AsyncClient) -> dict[str, str]:
+    username, password = f"user-{uuid.uuid4().hex[:8]}", "password"
+    await client.post("/auth/register", params={"username": username, "password": password})
+    response = await client.post("/auth/login", data={"username": username, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+async def auth_headers(client: httpx.AsyncClient) -> dict[str, str]:
+    """Bearer headers for a freshly registered user"""
+    return await _register(client)
+
+
+@pytest.fixture
+async def other_auth_headers(client: httpx.AsyncClient) -> dict[str, str]:
+    """Bearer headers for a second user, with a corpus of their own"""
+    return await _register(client)
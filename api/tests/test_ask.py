@@ -0,0 +1,395 @@
+import asyncio
+import json
+import uuid
+from typing import Any, AsyncIterator, Optional
+import httpx
+import pytest
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.dependencies import get_chat_model, get_ingestion_engine
+from app.documents.ingestion import change_corpus, ensure_corpus
+from app.documents.singleflight import AnswerFlight, SingleFlight
+from app.main import app
+from benchmarks.fakes import FakeStreamingChatModel
+
+pytestmark = pytest.mark.anyio
+
+
+class CountingChatModel(FakeStreamingChatModel):
+    """Records how many answers it was generating at once"""
+
+    calls: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+    async def _astream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                yield chunk
+        finally:
+            self.in_flight -= 1
+
+
+class FailingChatModel(FakeStreamingChatModel):
+    """Streams its first tokens, then loses the connection, on prompts containing fail_on"""
+
+    fail_after: int = 1
+    fail_on: str = ""
+
+    async def _astream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        failing = self.fail_on in "".join(str(message.content) for message in messages)
+        sent = 0
+        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+            if failing and sent == self.fail_after:
+                raise ConnectionError("The model went away")
+            sent += 1
+            yield chunk
+
+
+async def counter(client: httpx.AsyncClient, name: str) -> float:
+    for line in (await client.get("/metrics")).text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+async def history(client: httpx.AsyncClient, headers: dict[str, str], session_id: str) -> list[tuple[str, str]]:
+    response = await client.get("/history", params={"session_id": session_id}, headers=headers)
+    assert response.status_code == 200
+    return [(message["type"], message["content"]) for message in response.json()["messages"]]
+
+
+async def test_parallel_asks_overlap(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    llm = CountingChatModel(answer_tokens=5, first_token_latency_ms=200, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+
+    responses = await asyncio.gather(*[
+        client.post("/ask", json={"question": f"question {i}"}, headers=auth_headers) for i in range(8)
+    ])
+
+    assert [r.status_code for r in responses] == [200] * 8
+    assert all(r.json()["answer"] for r in responses)
+    # Serial answering would never have more than one in flight
+    assert llm.max_in_flight == 8
+
+
+async def test_sessions_page_by_cursor(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    llm = FakeStreamingChatModel(answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+    for i in range(3):
+        response = await client.post("/ask", json={"question": f"q {i}", "session_id": f"s{i}"}, headers=auth_headers)
+        assert response.status_code == 200
+
+    first = (await client.get("/sessions", params={"limit": 2}, headers=auth_headers)).json()
+    rest = (await client.get("/sessions", params={"cursor": first["next_cursor"]}, headers=auth_headers)).json()
+
+    assert [s["session_id"] for s in first["sessions"] + rest["sessions"]] == ["s2", "s1", "s0"]
+    assert rest["next_cursor"] is None
+
+
+async def test_cached_answers_follow_changes_in_other_workers(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(get_ingestion_engine().corpus_states, "ttl_seconds", 1.0)
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    owner = (await client.get("/auth/protected", headers=auth_headers)).json()["user"]
+
+    async def ask() -> bool:
+        response = await client.post("/ask", json={"question": "Who signed it?"}, headers=auth_headers)
+        assert response.status_code == 200
+        return response.json()["cached"]
+
+    assert not await ask()
+    assert await ask()
+    # Another worker indexed a document: only the database knows
+    await ensure_corpus(owner)
+    async with SessionLocal() as db:
+        await change_corpus(db, owner)
+        await db.commit()
+    # Seen once this worker's copy of the corpus expires
+    assert await ask()
+    await asyncio.sleep(1.0)
+    assert not await ask()
+    assert await ask()
+
+
+async def test_identical_questions_share_one_generation(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    llm = CountingChatModel(answer_tokens=5, first_token_latency_ms=200, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+    generations = await counter(client, "papertrail_ask_generations_total")
+    coalesced = await counter(client, "papertrail_ask_coalesced_total")
+
+    sessions = [str(uuid.uuid4()) for _ in range(4)]
+
+    responses = await asyncio.gather(*[
+        client.post("/ask", json={"question": "What is the notice period?", "session_id": session_id}, headers=auth_headers)
+        for session_id in sessions
+    ])
+
+    assert [r.status_code for r in responses] == [200] * 4
+    answer = responses[0].json()["answer"]
+    assert [r.json()["answer"] for r in responses] == [answer] * 4
+    assert llm.calls == 1
+    assert await counter(client, "papertrail_ask_generations_total") == generations + 1
+    assert await counter(client, "papertrail_ask_coalesced_total") == coalesced + 3
+    # Every asker's session records the shared answer
+    for session_id in sessions:
+        assert await history(client, auth_headers, session_id) == [
+            ("human", "What is the notice period?"), ("ai", answer)
+        ]
+
+
+async def test_a_failed_generation_fails_every_joiner(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    llm = FailingChatModel(answer_tokens=5, first_token_latency_ms=200, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+    generations = await counter(client, "papertrail_ask_generations_total")
+
+    responses = await asyncio.gather(*[
+        client.post("/ask", json={"question": "Who signed it?"}, headers=auth_headers) for _ in range(3)
+    ])
+
+    assert [r.status_code for r in responses] == [500] * 3
+    assert await counter(client, "papertrail_ask_generations_total") == generations + 1
+    # Nothing cached or left in flight: the next ask generates afresh
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    response = await client.post("/ask", json={"question": "Who signed it?"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert not response.json()["cached"]
+
+
+async def test_generation_stops_once_every_joiner_leaves():
+    flights = SingleFlight()
+    started = asyncio.Event()
+
+    async def generate(flight: AnswerFlight):
+        started.set()
+        flight.add_token("partial")
+        await asyncio.sleep(60)
+
+    with flights.join("question", generate) as first:
+        with flights.join("question", generate) as second:
+            assert second is first
+            await started.wait()
+        await asyncio.sleep(0)
+        # One asker is still reading
+        assert not first.task.done()  # type: ignore
+    task = first.task
+    assert task is not None
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, 1)
+    assert len(flights) == 0
+
+
+async def test_joiners_replay_tokens_and_share_the_error():
+    flights = SingleFlight()
+    proceed = asyncio.Event()
+
+    async def generate(flight: AnswerFlight):
+        flight.set_documents([])
+        flight.add_token("first ")
+        await proceed.wait()
+        raise ConnectionError("The model went away")
+
+    async def read(flight: AnswerFlight) -> list[str]:
+        tokens = []
+        with pytest.raises(ConnectionError):
+            async for token in flight.tokens():
+                tokens.append(token)
+        return tokens
+
+    with flights.join("question", generate) as first:
+        await first.documents()
+        # Joins after the first token, which it still reads
+        with flights.join("question", generate) as second:
+            readers = asyncio.gather(read(first), read(second))
+            proceed.set()
+            assert await readers == [["first "], ["first "]]
+    assert len(flights) == 0
+
+
+async def ask_batch(client: httpx.AsyncClient, headers: dict[str, str], questions: list[str], **params: Any) -> httpx.Response:
+    return await client.post(
+        "/ask/batch", json={"questions": [{"question": question} for question in questions]}, params=params, headers=headers
+    )
+
+
+async def test_batch_results_come_back_in_request_order(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    questions = [f"Question number {i}?" for i in range(6)]
+
+    response = await ask_batch(client, auth_headers, questions)
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == list(range(6))
+    assert all(result["answer"] and result["error"] is None for result in results)
+    # Each question got its own session, holding its own turn
+    assert len({result["session_id"] for result in results}) == 6
+    assert (await history(client, auth_headers, results[4]["session_id"]))[0] == ("human", questions[4])
+
+
+async def test_a_failed_question_does_not_fail_the_batch(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    app.dependency_overrides[get_chat_model] = lambda: FailingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1, fail_on="explode"
+    )
+
+    response = await ask_batch(client, auth_headers, ["What is due?", "Why does it explode?", "Who pays?"])
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["error"] is None for result in results] == [True, False, True]
+    assert results[1]["answer"] is None
+    assert results[0]["answer"] and results[2]["answer"]
+
+
+async def test_batch_size_is_capped(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "ASK_BATCH_MAX_QUESTIONS", 3)
+
+    response = await ask_batch(client, auth_headers, [f"q{i}" for i in range(4)])
+
+    assert response.status_code == 422
+
+
+async def test_batch_completions_respect_the_concurrency_cap(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "ASK_BATCH_CONCURRENCY", 2)
+    llm = CountingChatModel(answer_tokens=3, first_token_latency_ms=100, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+
+    response = await ask_batch(client, auth_headers, [f"Capped question {i}?" for i in range(6)])
+
+    assert response.status_code == 200
+    assert llm.calls == 6
+    assert llm.max_in_flight == 2
+
+
+async def test_batch_streams_ndjson_as_results_finish(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+
+    response = await ask_batch(client, auth_headers, [f"Streamed question {i}?" for i in range(5)], stream="true")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(result["index"] for result in results) == list(range(5))
+    assert all(result["answer"] for result in results)
+
+
+def sse_events(body: str) -> list[tuple[str, Any]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+async def test_stream_sends_sources_then_tokens_then_done(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=5, first_token_latency_ms=1, token_latency_ms=1
+    )
+
+    response = await client.post("/ask/stream", json={"question": "When does it end?"}, headers=auth_headers)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = sse_events(response.text)
+    assert [name for name, _ in events] == ["sources"] + ["token"] * 5 + ["done"]
+    answer = "".join(data["token"] for name, data in events if name == "token")
+    session_id = events[-1][1]["session_id"]
+    assert events[-1][1]["cached"] is False
+    assert await history(client, auth_headers, session_id) == [("human", "When does it end?"), ("ai", answer)]
+
+
+async def test_stream_reports_a_failed_generation(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    app.dependency_overrides[get_chat_model] = lambda: FailingChatModel(
+        answer_tokens=5, first_token_latency_ms=1, token_latency_ms=1
+    )
+
+    response = await client.post("/ask/stream", json={"question": "When does it end?"}, headers=auth_headers)
+
+    events = sse_events(response.text)
+    assert [name for name, _ in events] == ["sources", "token", "error"]
+    assert events[-1][1] == {"detail": "An error occurred while querying the LLM"}
+
+
+async def stream_and_hang_up(headers: dict[str, str], body: dict[str, Any]) -> str:
+    """
+    POST /ask/stream straight to the app, disconnecting once the first token arrives,
+    as httpx's ASGI transport only returns a response once it's complete
+    """
+    received: list[bytes] = []
+    hang_up = asyncio.Event()
+    requested = False
+
+    async def receive() -> dict[str, Any]:
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+        await hang_up.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: dict[str, Any]):
+        if message["type"] == "http.response.body":
+            received.append(message.get("body", b""))
+            if b"event: token" in received[-1]:
+                hang_up.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/ask/stream", "raw_path": b"/ask/stream", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"test"), (b"content-type", b"application/json")]
+                   + [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000), "server": ("test", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), 10)
+    return b"".join(received).decode()
+
+
+async def test_stream_saves_the_partial_answer_when_the_client_leaves(
+        client: httpx.AsyncClient, auth_headers: dict[str, str]
+):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=50, first_token_latency_ms=1, token_latency_ms=50
+    )
+    session_id = str(uuid.uuid4())
+
+    body = await stream_and_hang_up(auth_headers, {"question": "Summarize the contract", "session_id": session_id})
+
+    events = sse_events(body)
+    assert "done" not in [name for name, _ in events]
+    streamed = "".join(data["token"] for name, data in events if name == "token")
+    [(_, question), (_, answer)] = await history(client, auth_headers, session_id)
+    assert question == "Summarize the contract"
+    # What was generated before the client left, at least what it received
+    assert answer.startswith(streamed)
+    assert len(answer.split()) < 50
@@ -0,0 +1,28 @@
+import asyncio
+import threading
+import httpx
+import pytest
+from app.main import app, lifespan
+from benchmarks.fakes import HashEmbeddings
+
+pytestmark = pytest.mark.anyio
+
+
+def bcrypt_threads() -> list[threading.Thread]:
+    return [thread for thread in threading.enumerate() if thread.name.startswith("bcrypt")]
+
+
+async def test_shutdown_stops_password_hashing_threads():
+    app.state.embedding_model = HashEmbeddings()
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/auth/register", params={"username": "shutdown", "password": "password"})
+            assert response.status_code == 200
+        assert bcrypt_threads()
+
+    for _ in range(50):
+        if not bcrypt_threads():
+            break
+        await asyncio.sleep(0.02)
+    assert not bcrypt_threads()
@@ -0,0 +1,86 @@
+from langchain_core.documents import Document
+from app.shared.context import chunk_tokens, merge_adjacent, pack_context
+
+# Long enough for the splitter's overlap to count as one, rather than coincidence
+OVERLAP = "the tenant pays for repairs to the heating system"
+
+
+def chunk(text: str, source: str = "lease.pdf", page: int = 1, score: float = 0.5) -> Document:
+    return Document(page_content=text, metadata={"source": source, "page_number": page, "score": score})
+
+
+def test_merges_overlapping_neighbours():
+    first = chunk(f"Rent is due monthly and {OVERLAP}", score=0.3)
+    second = chunk(f"{OVERLAP} within thirty days.", score=0.2)
+
+    [merged] = merge_adjacent([first, second], max_overlap=200)
+
+    assert merged.page_content == f"Rent is due monthly and {OVERLAP} within thirty days."
+    # Keeps the source, and the best score of the two
+    assert merged.metadata == {"source": "lease.pdf", "page_number": 1, "score": 0.2}
+    # The retrieved chunks are left as they were
+    assert first.page_content == f"Rent is due monthly and {OVERLAP}"
+
+
+def test_merges_a_neighbour_ranked_above_the_chunk_before_it():
+    before = chunk(f"Rent is due monthly and {OVERLAP}")
+    after = chunk(f"{OVERLAP} within thirty days.")
+
+    [merged] = merge_adjacent([after, before], max_overlap=200)
+
+    assert merged.page_content == f"Rent is due monthly and {OVERLAP} within thirty days."
+
+
+def test_keeps_chunks_from_other_pages_and_sources_apart():
+    docs = [
+        chunk(f"Rent is due monthly and {OVERLAP}"),
+        chunk(f"{OVERLAP} within thirty days.", page=2),
+        chunk(f"{OVERLAP} within thirty days.", source="other.pdf"),
+        chunk("Pets are not allowed."),  # same page, but no overlap
+    ]
+
+    merged = merge_adjacent(docs, max_overlap=200)
+
+    assert [doc.page_content for doc in merged] == [doc.page_content for doc in docs]
+    assert [(doc.metadata["source"], doc.metadata["page_number"]) for doc in merged] == [
+        ("lease.pdf", 1), ("lease.pdf", 2), ("other.pdf", 1), ("lease.pdf", 1)
+    ]
+
+
+def test_drops_duplicates_and_ignores_overlaps_past_the_limit():
+    text = f"Rent is due monthly and {OVERLAP}"
+
+    assert len(merge_adjacent([chunk(text), chunk(text), chunk(OVERLAP)], max_overlap=200)) == 1
+    # Longer than the splitter ever repeats, so taken for coincidence
+    assert len(merge_adjacent([chunk(text), chunk(f"{OVERLAP} within thirty days.")], max_overlap=len(OVERLAP) - 1)) == 2
+
+
+def test_packs_in_rank_order_within_the_budget():
+    docs = [chunk(f"Clause {i}: the deposit is {i} hundred pounds.", page=i) for i in range(5)]
+    tokens = chunk_tokens(docs[0])
+
+    packed, raw_tokens, packed_tokens = pack_context(docs, token_budget=3 * tokens + tokens // 2)
+
+    assert [doc.page_content for doc in packed] == [doc.page_content for doc in docs[:3]]
+    assert [doc.metadata["source"] for doc in packed] == ["lease.pdf"] * 3
+    assert raw_tokens == sum(chunk_tokens(doc) for doc in docs)
+    assert packed_tokens == sum(chunk_tokens(doc) for doc in packed) <= 3 * tokens + tokens // 2
+
+
+def test_a_chunk_over_the_budget_leaves_room_for_later_ones():
+    long = chunk(" ".join(["The landlord insures the building."] * 20), page=1)
+    short = chunk("Pets are not allowed.", page=2)
+
+    packed, _, _ = pack_context([long, short], token_budget=chunk_tokens(short) + 1)
+
+    assert packed == [short]
+
+
+def test_drops_distant_chunks_before_packing():
+    near, far = chunk("Pets are not allowed.", score=0.2), chunk("Parking is extra.", page=2, score=0.9)
+
+    packed, raw_tokens, _ = pack_context([near, far], token_budget=1000, max_distance=0.5)
+
+    assert packed == [near]
+    # Still counted as retrieved
+    assert raw_tokens == chunk_tokens(near) + chunk_tokens(far)
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.schema import CreateTable
+from app.core.database import Base, ChatSession, User
+from app.main import create_schema
+
+pytestmark = pytest.mark.anyio
+
+
+def test_timestamps_are_timezone_aware_on_postgres():
+    ddl = str(CreateTable(User.__table__).compile(dialect=postgresql.dialect()))  # type: ignore
+    assert "last_password_change TIMESTAMP WITH TIME ZONE" in ddl
+
+
+async def test_sqlite_returns_aware_utc_datetimes():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        changed = datetime(2025, 1, 1, 12, 0, tzinfo=timezone(timedelta(hours=2)))
+        await conn.execute(User.__table__.insert().values(  # type: ignore
+            username="alice", hashed_password="x", last_password_change=changed
+        ))
+        await conn.execute(ChatSession.__table__.insert().values(  # type: ignore
+            session_id="s", owner="alice", created_at=changed, updated_at=datetime(2025, 1, 1, 10, 0), message_count=0
+        ))
+
+        stored = await conn.scalar(select(User.last_password_change))
+        # Naive values are taken as UTC, so they compare with aware ones
+        newer = await conn.scalar(select(ChatSession.session_id).where(ChatSession.updated_at >= changed))
+    await engine.dispose()
+
+    assert stored == changed
+    assert stored.tzinfo == timezone.utc
+    assert newer == "s"
+
+
+async def test_schema_gains_columns_added_since():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        # documents as created before each version had its own file path
+        await conn.execute(text(
+            "CREATE TABLE documents (id INTEGER PRIMARY KEY, owner VARCHAR, filename VARCHAR, "
+            "content_hash VARCHAR(64), created_at DATETIME, chunk_ids TEXT)"
+        ))
+        await conn.run_sync(create_schema)
+        columns = await conn.run_sync(lambda sync: {c["name"] for c in inspect(sync).get_columns("documents")})
+    await engine.dispose()
+
+    assert "path" in columns
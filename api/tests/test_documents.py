@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import httpx
+import pytest
+from app.core.database import IngestJob, SessionLocal
+from app.core.dependencies import get_chat_model, get_ingestion_engine
+from app.documents.ingestion import load_corpus_state
+from app.main import app
+from benchmarks.fakes import FakeStreamingChatModel
+
+pytestmark = pytest.mark.anyio
+
+
+async def upload(client: httpx.AsyncClient, headers: dict[str, str], filename: str, content: bytes) -> dict:
+    """Upload one file and wait for its job to finish"""
+    response = await client.post("/upload", files=[("files", (filename, content))], headers=headers)
+    assert response.status_code == 202
+    return await wait_for_job(client, headers, response.json()["job_id"])
+
+
+async def wait_for_job(client: httpx.AsyncClient, headers: dict[str, str], job_id: str) -> dict:
+    for _ in range(200):
+        job = (await client.get(f"/upload/jobs/{job_id}", headers=headers)).json()
+        if job["status"] != "running":
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+async def test_delete_document(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    job = await upload(client, auth_headers, "contract.txt", b"The contract ends in March.")
+    assert job["status"] == "done"
+    document_id = (await client.get("/documents", headers=auth_headers)).json()["documents"][0]["id"]
+
+    response = await client.delete(f"/documents/{document_id}", headers=auth_headers)
+
+    assert response.status_code == 200
+    assert (await client.get(f"/documents/{document_id}", headers=auth_headers)).status_code == 404
+    assert (await client.get("/documents/index", headers=auth_headers)).json()["chunks"] == 0
+
+
+async def test_job_status_outlives_the_worker_running_it(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    job = await upload(client, auth_headers, "notes.txt", b"Notes from the kickoff meeting.")
+    assert job["status"] == "done"
+    # Finished, so no longer held in memory: this is what any other worker would read
+    assert job["job_id"] not in get_ingestion_engine().jobs
+
+    response = await client.get(f"/upload/jobs/{job['job_id']}", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()["files"][0]["status"] == "done"
+    assert response.json()["finished_at"] is not None
+
+
+async def test_job_started_by_another_worker(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    owner = (await client.get("/auth/protected", headers=auth_headers)).json()["user"]
+    async with SessionLocal() as db:
+        db.add(IngestJob(
+            job_id="elsewhere", owner=owner, status="running",
+            files=json.dumps([{"filename": "big.pdf", "status": "parsing", "pages": 300, "pages_parsed": 40}]),
+            created_at=datetime.now(timezone.utc)
+        ))
+        db.add(IngestJob(
+            job_id="not-mine", owner="someone-else", status="done", files="[]", created_at=datetime.now(timezone.utc)
+        ))
+        await db.commit()
+
+    job = (await client.get("/upload/jobs/elsewhere", headers=auth_headers)).json()
+    assert job["status"] == "running"
+    assert job["files"][0]["pages_parsed"] == 40
+    # Another user's job stays hidden
+    assert (await client.get("/upload/jobs/not-mine", headers=auth_headers)).status_code == 404
+
+
+async def sources_for(
+        client: httpx.AsyncClient, headers: dict[str, str], question: str, document_ids: list[int] | None = None
+) -> list[str]:
+    response = await client.post("/ask", json={"question": question, "document_ids": document_ids}, headers=headers)
+    assert response.status_code == 200
+    return response.json()["sources"]
+
+
+@pytest.fixture
+def fake_chat_model():
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+
+
+async def document_ids(client: httpx.AsyncClient, headers: dict[str, str]) -> dict[str, int]:
+    documents = (await client.get("/documents", headers=headers)).json()["documents"]
+    return {document["filename"]: document["id"] for document in documents}
+
+
+async def test_users_only_retrieve_their_own_chunks(
+        fake_chat_model: None, client: httpx.AsyncClient, auth_headers: dict[str, str], other_auth_headers: dict[str, str]
+):
+    assert (await upload(client, auth_headers, "lease.txt", b"The lease runs until June."))["status"] == "done"
+    assert (await upload(client, other_auth_headers, "memo.txt", b"The memo is about the budget."))["status"] == "done"
+
+    [own] = await sources_for(client, auth_headers, "When does the lease end?")
+    assert own.endswith("lease.txt")
+    # The other user's chunks are never candidates, even when asked for by id
+    [theirs] = await sources_for(client, other_auth_headers, "When does the lease end?")
+    assert theirs.endswith("memo.txt")
+    lease_id = (await document_ids(client, auth_headers))["lease.txt"]
+    assert await sources_for(client, other_auth_headers, "When does the lease end?", [lease_id]) == []
+
+
+async def test_search_narrowed_to_documents(
+        fake_chat_model: None, client: httpx.AsyncClient, auth_headers: dict[str, str]
+):
+    await upload(client, auth_headers, "lease.txt", b"The lease runs until June.")
+    await upload(client, auth_headers, "invoice.txt", b"The invoice is due in June.")
+    ids = await document_ids(client, auth_headers)
+    assert len(await sources_for(client, auth_headers, "What happens in June?")) == 2
+
+    [source] = await sources_for(client, auth_headers, "What happens in June?", [ids["invoice.txt"]])
+    assert source.endswith("invoice.txt")
+
+
+@dataclass
+class PausedReplacement:
+    owner: str
+    original: str  # the first version's file
+    job_id: str
+    release: threading.Event  # lets the new version's ingestion carry on
+
+
+async def replace_with_paused_ingest(
+        client: httpx.AsyncClient, headers: dict[str, str], monkeypatch: pytest.MonkeyPatch, fail: bool
+) -> PausedReplacement:
+    """
+    Index a first version of a document, then start replacing it, holding the new
+    version's ingestion after its chunks are written until released
+    """
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    owner = (await client.get("/auth/protected", headers=headers)).json()["user"]
+    await upload(client, headers, "policy.txt", b"The notice period is thirty days.")
+    document_id = (await client.get("/documents", headers=headers)).json()["documents"][0]["id"]
+    [original] = await sources_for(client, headers, "What is the notice period?")
+
+    store = get_ingestion_engine().vector_stores.for_owner(owner)
+    add = store.add
+    written, release = threading.Event(), threading.Event()
+
+    def add_and_wait(*args):
+        add(*args)
+        written.set()
+        release.wait(10)
+        if fail:
+            raise RuntimeError("The embedding service went away")
+
+    monkeypatch.setattr(store, "add", add_and_wait)
+    response = await client.put(
+        f"/documents/{document_id}",
+        files=[("file", ("policy.txt", b"The notice period is ninety days."))], headers=headers
+    )
+    assert response.status_code == 202
+    assert await asyncio.to_thread(written.wait, 10)
+    return PausedReplacement(owner, original, response.json()["job_id"], release)
+
+
+async def assert_nothing_hidden(client: httpx.AsyncClient, headers: dict[str, str], owner: str):
+    """No version is left hidden, and the index holds exactly the registered chunks"""
+    async with SessionLocal() as db:
+        assert (await load_corpus_state(db, owner)).hidden == []
+    documents = (await client.get("/documents", headers=headers)).json()["documents"]
+    chunks = (await client.get("/documents/index", headers=headers)).json()["chunks"]
+    assert chunks == sum(document["chunks"] for document in documents)
+
+
+async def test_replacement_switches_over_whole(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    paused = await replace_with_paused_ingest(client, auth_headers, monkeypatch, fail=False)
+
+    # Indexed but not switched over: only the old version is served, from its own file
+    assert await sources_for(client, auth_headers, "How long is the notice period?") == [paused.original]
+    assert os.path.exists(paused.original)
+
+    paused.release.set()
+    assert (await wait_for_job(client, auth_headers, paused.job_id))["status"] == "done"
+    [replacement] = await sources_for(client, auth_headers, "What notice period applies?")
+    assert replacement != paused.original
+    assert not os.path.exists(paused.original)
+    await assert_nothing_hidden(client, auth_headers, paused.owner)
+
+
+async def test_failed_replacement_keeps_the_original(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    paused = await replace_with_paused_ingest(client, auth_headers, monkeypatch, fail=True)
+
+    paused.release.set()
+    assert (await wait_for_job(client, auth_headers, paused.job_id))["status"] == "failed"
+    assert await sources_for(client, auth_headers, "What notice period applies?") == [paused.original]
+    # Only the original's directory is left
+    directory = os.path.dirname(paused.original)
+    assert os.listdir(os.path.dirname(directory)) == [os.path.basename(directory)]
+    await assert_nothing_hidden(client, auth_headers, paused.owner)
+
+
+async def test_first_upload_finishing_after_its_replacement(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    owner = (await client.get("/auth/protected", headers=auth_headers)).json()["user"]
+    store = get_ingestion_engine().vector_stores.for_owner(owner)
+    add = store.add
+    written, release = threading.Event(), threading.Event()
+
+    def add_first_slowly(*args):
+        add(*args)
+        if not written.is_set():
+            written.set()
+            release.wait(10)
+
+    monkeypatch.setattr(store, "add", add_first_slowly)
+    response = await client.post(
+        "/upload", files=[("files", ("policy.txt", b"The notice period is thirty days."))], headers=auth_headers
+    )
+    assert await asyncio.to_thread(written.wait, 10)
+    first_job = response.json()["job_id"]
+    document_id = (await client.get("/documents", headers=auth_headers)).json()["documents"][0]["id"]
+
+    # A second version under the same name, indexed while the first is still being written
+    response = await client.put(
+        f"/documents/{document_id}",
+        files=[("file", ("policy.txt", b"The notice period is ninety days, in writing."))], headers=auth_headers
+    )
+    assert (await wait_for_job(client, auth_headers, response.json()["job_id"]))["status"] == "done"
+    [replacement] = await sources_for(client, auth_headers, "What is the notice period?")
+
+    release.set()
+    assert (await wait_for_job(client, auth_headers, first_job))["files"][0]["status"] == "already_indexed"
+    # The later version stays, and nothing of the first is left
+    assert await sources_for(client, auth_headers, "How long is the notice period?") == [replacement]
+    assert os.listdir(os.path.dirname(os.path.dirname(replacement))) == [os.path.basename(os.path.dirname(replacement))]
+    await assert_nothing_hidden(client, auth_headers, owner)
+
+    assert (await client.delete(f"/documents/{document_id}", headers=auth_headers)).status_code == 200
+    assert (await client.get("/documents/index", headers=auth_headers)).json()["chunks"] == 0
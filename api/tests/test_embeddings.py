@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import pytest
+from app.core.embeddings import BatchingEmbeddings
+from benchmarks.fakes import HashEmbeddings
+
+pytestmark = pytest.mark.anyio
+
+
+class GatedEmbeddings(HashEmbeddings):
+    """Blocks every call until opened, and records the threads the model ran on"""
+
+    def __init__(self):
+        super().__init__(size=8)
+        self.gate = threading.Event()
+        self.threads: set[str] = set()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.threads.add(threading.current_thread().name)
+        self.gate.wait(10)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        self.threads.add(threading.current_thread().name)
+        return super().embed_query(text)
+
+
+async def test_cancelled_caller_does_not_stop_the_batcher():
+    model = GatedEmbeddings()
+    embeddings = BatchingEmbeddings(model, batch_size=1, max_wait_ms=0)
+    try:
+        # The first call holds the model, so the second waits in the queue
+        running = asyncio.create_task(embeddings.aembed_documents(["first"]))
+        queued = asyncio.create_task(embeddings.aembed_documents(["second"]))
+        await asyncio.sleep(0.05)
+        queued.cancel()  # e.g. its client went away
+        await asyncio.sleep(0.01)  # for the cancellation to reach the batcher's future
+        model.gate.set()
+
+        assert len(await asyncio.wait_for(running, 5)) == 1
+        assert len(await asyncio.wait_for(embeddings.aembed_documents(["third"]), 5)) == 1
+        assert embeddings.texts_embedded == 2  # the cancelled text was never embedded
+    finally:
+        embeddings.close()
+
+
+async def test_queries_run_on_the_batcher_thread():
+    model = GatedEmbeddings()
+    model.gate.set()
+    embeddings = BatchingEmbeddings(model, max_wait_ms=1000)
+    try:
+        documents = asyncio.create_task(embeddings.aembed_documents(["a chunk"]))
+        await asyncio.sleep(0.05)
+        # Answered without waiting out the window the documents are held for
+        assert await asyncio.wait_for(embeddings.aembed_query("a question"), 0.5) == model.embed_query("a question")
+        await asyncio.wait_for(documents, 5)
+        assert model.threads == {"embedding-batcher", threading.current_thread().name}
+    finally:
+        embeddings.close()
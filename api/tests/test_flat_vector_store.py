@@ -0,0 +1,54 @@
+from langchain_core.documents import Document
+from app.core.flat_vector_store import INITIAL_CAPACITY, FlatVectorStore
+from benchmarks.fakes import HashEmbeddings
+
+embeddings = HashEmbeddings()
+
+
+def add(store: FlatVectorStore, document_id: int, texts: list[str]):
+    documents = [Document(page_content=text, metadata={"document_id": document_id}) for text in texts]
+    ids = [f"{document_id}-{i}" for i in range(len(texts))]
+    store.add(documents, embeddings.embed_documents(texts), ids)
+
+
+def found(store: FlatVectorStore, text: str, document_id: int) -> list[str]:
+    hits = store.search(embeddings.embed_query(text), k=5, filter={"document_id": document_id})
+    return [document.page_content for document, _ in hits]
+
+
+def test_workers_see_each_others_writes(tmp_path):
+    # Two workers, each with its own store on the same directory
+    first = FlatVectorStore(str(tmp_path), embeddings)
+    second = FlatVectorStore(str(tmp_path), embeddings)
+
+    add(first, 1, ["alpha beta", "gamma delta"])
+    add(second, 2, ["epsilon zeta"])  # must not overwrite the first worker's rows
+    assert first.count() == second.count() == 3
+    assert found(second, "alpha beta", 1)[0] == "alpha beta"
+    assert found(first, "epsilon zeta", 2) == ["epsilon zeta"]
+
+    first.delete(["1-0"])
+    assert second.count() == 2
+    assert found(second, "alpha beta", 1) == ["gamma delta"]
+
+
+def test_workers_follow_growth_and_compaction(tmp_path):
+    first = FlatVectorStore(str(tmp_path), embeddings)
+    second = FlatVectorStore(str(tmp_path), embeddings)
+    add(first, 1, ["alpha"])
+    assert second.count() == 1
+
+    # Past the initial capacity the files are replaced by larger copies
+    add(first, 2, [f"word{i}" for i in range(INITIAL_CAPACITY)])
+    # Single words can share a hash bucket, so other words may tie with it
+    assert "word7" in found(second, "word7", 2)
+
+    second.delete([f"2-{i}" for i in range(INITIAL_CAPACITY // 2)])
+    second.compact()
+    assert first.deleted_count() == 0
+    assert first.count() == INITIAL_CAPACITY // 2 + 1
+    assert found(first, "alpha", 1) == ["alpha"]
+    assert f"word{INITIAL_CAPACITY - 1}" in found(first, f"word{INITIAL_CAPACITY - 1}", 2)
+
+    # Reopening picks up the state both workers left
+    assert FlatVectorStore(str(tmp_path), embeddings).count() == INITIAL_CAPACITY // 2 + 1
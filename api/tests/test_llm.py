@@ -0,0 +1,106 @@
+"""
+The OpenAI client against benchmarks/fake_openai.py, served over HTTP in a
+thread, so its connection pool, the concurrency cap and the retries run for real
+"""
+import argparse
+import asyncio
+import socket
+import threading
+from typing import Iterator
+import httpx
+import pytest
+import uvicorn
+from app.core import dependencies
+from app.core.config import settings
+from app.core.llm import ConcurrencyLimiter
+from benchmarks.fake_openai import add_arguments, build_app
+
+pytestmark = pytest.mark.anyio
+
+LLM_CONCURRENCY = 3
+
+
+class FakeOpenAI:
+    def __init__(self, **options: float):
+        parser = argparse.ArgumentParser()
+        add_arguments(parser)
+        args = parser.parse_args([])
+        args.answer_tokens, args.first_token_ms, args.token_ms, args.retry_after = 5, 50, 5, 0
+        vars(args).update(options)
+
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.base_url = f"http://127.0.0.1:{self.socket.getsockname()[1]}"
+        self.server = uvicorn.Server(uvicorn.Config(build_app(args), log_level="critical"))
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True)
+
+    def stats(self) -> dict[str, int]:
+        return httpx.get(f"{self.base_url}/stats").json()
+
+    def __enter__(self) -> "FakeOpenAI":
+        self.thread.start()
+        while not self.server.started:
+            self.thread.join(0.01)
+        return self
+
+    def __exit__(self, *exc_info: object):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+@pytest.fixture
+def fake_openai(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> Iterator[FakeOpenAI]:
+    """
+    The fake API, with the options of the test's fake_openai mark, which the app's
+    client points at once the `client` fixture starts it. Request this one first
+    """
+    marker = request.node.get_closest_marker("fake_openai")
+    with FakeOpenAI(**(marker.kwargs if marker else {})) as server:
+        monkeypatch.setattr(settings, "OPENAI_BASE_URL", f"{server.base_url}/v1")
+        monkeypatch.setattr(settings, "LLM_RETRY_BASE_SECONDS", 0.01)
+        monkeypatch.setattr(settings, "LLM_RETRY_MAX_SECONDS", 0.05)
+        monkeypatch.setattr(dependencies, "_llm_limiter", ConcurrencyLimiter(LLM_CONCURRENCY, 100, 30))
+        yield server
+
+
+async def ask(client: httpx.AsyncClient, headers: dict[str, str], question: str) -> httpx.Response:
+    return await client.post("/ask", json={"question": question}, headers=headers)
+
+
+async def test_requests_share_the_client_and_respect_the_cap(
+        fake_openai: FakeOpenAI, client: httpx.AsyncClient, auth_headers: dict[str, str]
+):
+    for batch in range(2):
+        responses = await asyncio.gather(*(
+            ask(client, auth_headers, f"Question {i} of round {batch}?") for i in range(4 * LLM_CONCURRENCY)
+        ))
+        assert [response.status_code for response in responses] == [200] * len(responses)
+
+    stats = fake_openai.stats()
+    assert stats["requests"] == 8 * LLM_CONCURRENCY
+    # Never more than the cap in flight, and the cap was reached
+    assert stats["max_in_flight"] == LLM_CONCURRENCY
+    # One pool for every request: its connections were reused, across rounds too
+    assert stats["connections"] <= LLM_CONCURRENCY
+
+
+@pytest.mark.fake_openai(max_concurrency=0)  # every request rate limited
+async def test_failures_before_the_first_token_are_retried(
+        fake_openai: FakeOpenAI, client: httpx.AsyncClient, auth_headers: dict[str, str]
+):
+    response = await ask(client, auth_headers, "What does the contract cover?")
+
+    assert response.status_code == 500
+    assert fake_openai.stats()["requests"] == 1 + settings.LLM_MAX_RETRIES
+
+
+@pytest.mark.fake_openai(drop_rate=1.0)
+async def test_no_retry_once_tokens_were_streamed(
+        fake_openai: FakeOpenAI, client: httpx.AsyncClient, auth_headers: dict[str, str]
+):
+    response = await ask(client, auth_headers, "What does the contract cover?")
+
+    assert response.status_code == 500
+    stats = fake_openai.stats()
+    assert stats["dropped"] == 1
+    assert stats["requests"] == 1
@@ -0,0 +1,31 @@
+import httpx
+import pytest
+from app.core.dependencies import get_chat_model
+from app.main import app
+from benchmarks.fakes import FakeStreamingChatModel
+
+pytestmark = pytest.mark.anyio
+
+
+def sample(metrics: str, series: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+async def test_cache_lookups_are_exported(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    llm = FakeStreamingChatModel(answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1)
+    app.dependency_overrides[get_chat_model] = lambda: llm
+    hit = 'papertrail_cache_lookups_total{cache="answer",result="hit"}'
+    query_embedding_miss = 'papertrail_cache_lookups_total{cache="query_embedding",result="miss"}'
+    before = (await client.get("/metrics")).text
+
+    for _ in range(2):
+        response = await client.post("/ask", json={"question": "What is the notice period?"}, headers=auth_headers)
+        assert response.status_code == 200
+
+    after = (await client.get("/metrics")).text
+    assert response.json()["cached"]
+    assert sample(after, hit) == sample(before, hit) + 1
+    assert sample(after, query_embedding_miss) > sample(before, query_embedding_miss)
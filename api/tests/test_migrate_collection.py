@@ -0,0 +1,48 @@
+import httpx
+import pytest
+from app.core.dependencies import get_chat_model, get_ingestion_engine
+from app.documents.migrate_collection import LEGACY_COLLECTION, migrate
+from app.main import app
+from benchmarks.fakes import FakeStreamingChatModel, HashEmbeddings
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_shared_collection_moves_to_its_owners(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], other_auth_headers: dict[str, str]
+):
+    app.dependency_overrides[get_chat_model] = lambda: FakeStreamingChatModel(
+        answer_tokens=3, first_token_latency_ms=1, token_latency_ms=1
+    )
+    owner = (await client.get("/auth/protected", headers=auth_headers)).json()["user"]
+    other = (await client.get("/auth/protected", headers=other_auth_headers)).json()["user"]
+    vector_stores = get_ingestion_engine().vector_stores
+    legacy_client = vector_stores.client
+    if legacy_client is None:
+        pytest.skip("The shared collection was only ever kept in Chroma")
+
+    # As indexed before each user had a collection: one untagged file, one tagged with its owner
+    texts = ["The warranty lasts two years.", "Repairs are free in the first year.", "The office moves in May."]
+    legacy = legacy_client.get_or_create_collection(LEGACY_COLLECTION)
+    legacy.add(
+        ids=["a", "b", "c"],
+        embeddings=HashEmbeddings().embed_documents(texts),
+        documents=texts,
+        metadatas=[{"source": "/old/warranty.txt"}, {"source": "/old/warranty.txt"},
+                   {"source": "/old/office.txt", "owner": other}]
+    )
+
+    assert await migrate(legacy_client, vector_stores, default_owner=owner) == (3, 0)
+
+    [warranty] = (await client.get("/documents", headers=auth_headers)).json()["documents"]
+    assert warranty["filename"] == "warranty.txt"
+    response = await client.post("/ask", json={"question": "How long is the warranty?"}, headers=auth_headers)
+    assert response.json()["sources"] == ["/old/warranty.txt"]
+    # Removed along with its document, as an uploaded one would be
+    assert (await client.delete(f"/documents/{warranty['id']}", headers=auth_headers)).status_code == 200
+    assert (await client.get("/documents/index", headers=auth_headers)).json()["chunks"] == 0
+
+    [office] = (await client.get("/documents", headers=other_auth_headers)).json()["documents"]
+    assert office["filename"] == "office.txt"
+    assert LEGACY_COLLECTION not in {collection.name for collection in legacy_client.list_collections()}
+    assert await migrate(legacy_client, vector_stores, default_owner=owner) == (0, 0)
@@ -0,0 +1,36 @@
+import pytest
+from app.auth.cache import InMemoryPrincipalCache
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_set_after_invalidate_is_dropped():
+    cache = InMemoryPrincipalCache(ttl_seconds=30)
+
+    # A token check misses and reads the user while their password is being changed
+    generation = await cache.generation("alice")
+    await cache.invalidate("alice")
+    await cache.set("alice", 1.0, generation)
+
+    assert await cache.get("alice") is None
+
+
+async def test_set_without_invalidation_is_cached():
+    cache = InMemoryPrincipalCache(ttl_seconds=30)
+    await cache.invalidate("bob")
+
+    generation = await cache.generation("alice")
+    await cache.set("alice", 1.0, generation)
+
+    assert await cache.get("alice") == 1.0
+
+
+async def test_set_older_than_forgotten_invalidations_is_dropped():
+    cache = InMemoryPrincipalCache(ttl_seconds=30, maxsize=2)
+
+    generation = await cache.generation("alice")
+    for username in ("alice", "bob", "carol"):
+        await cache.invalidate(username)
+    await cache.set("alice", 1.0, generation)
+
+    assert await cache.get("alice") is None
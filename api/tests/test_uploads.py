@@ -0,0 +1,133 @@
+import asyncio
+import os
+from typing import AsyncIterator
+import httpx
+import pytest
+from app.core.config import settings
+from app.core.dependencies import get_ingestion_engine
+from app.core.exceptions import PayloadTooLargeException
+from app.documents.services import DocumentService
+from app.documents.uploads import stage_multipart
+
+pytestmark = pytest.mark.anyio
+
+BOUNDARY = "boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart_body(files: list[tuple[str, bytes]], field_name: str = "files") -> bytes:
+    body = b""
+    for filename, content in files:
+        body += (
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+async def stream(body: bytes, chunk_size: int, sent: list[int]) -> AsyncIterator[bytes]:
+    for i in range(0, len(body), chunk_size):
+        sent.append(i)
+        yield body[i:i + chunk_size]
+
+
+async def test_files_are_staged_as_they_stream(tmp_path):
+    body = multipart_body([("a.txt", b"hello " * 1000), ("skip.exe", b"MZ"), ("b.pdf", b"%PDF-1.7 ...")])
+
+    staged = await stage_multipart(
+        CONTENT_TYPE, stream(body, 100, []), "files", str(tmp_path), max_bytes=10_000, chunk_bytes=512,
+        accept=lambda filename: not filename.endswith(".exe")
+    )
+
+    assert [(s.filename, s.content_type, s.size) for s in staged] == [
+        ("a.txt", "text/plain", 6000), ("b.pdf", "application/pdf", 12)
+    ]
+    with open(staged[0].temp_path, "rb") as f:
+        assert f.read() == b"hello " * 1000
+
+
+async def test_oversized_file_is_rejected_before_the_body_is_read(tmp_path):
+    body = multipart_body([("a.txt", b"x" * 1000), ("big.txt", b"x" * 100_000)])
+    sent: list[int] = []
+
+    with pytest.raises(PayloadTooLargeException):
+        await stage_multipart(CONTENT_TYPE, stream(body, 1000, sent), "files", str(tmp_path), 10_000, 512)
+
+    assert len(sent) < 20  # of 102 chunks
+    assert os.listdir(tmp_path) == []
+
+
+async def test_upload_over_the_file_limit_gets_413(
+        client: httpx.AsyncClient, auth_headers: dict[str, str], monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "MAX_UPLOAD_FILE_BYTES", 1000)
+    files = [("files", ("small.txt", b"fine")), ("files", ("big.txt", b"x" * 5000))]
+
+    response = await client.post("/upload", files=files, headers=auth_headers)
+
+    assert response.status_code == 413
+    assert [name for name in os.listdir(settings.UPLOAD_DIR) if name.endswith(".part")] == []
+
+
+async def test_uploaded_file_is_indexed(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    files = [("files", ("notes.txt", b"The notice period is thirty days.")), ("files", ("virus.exe", b"MZ"))]
+
+    response = await client.post("/upload", files=files, headers=auth_headers)
+    assert response.status_code == 202
+    assert response.json()["files_queued"] == ["notes.txt"]
+
+    job_id = response.json()["job_id"]
+    for _ in range(100):
+        job = (await client.get(f"/upload/jobs/{job_id}", headers=auth_headers)).json()
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    assert job["status"] == "done"
+    assert job["files"][0]["chunks"] > 0
+
+
+async def test_replacement_must_keep_the_extension(client: httpx.AsyncClient, auth_headers: dict[str, str]):
+    response = await client.post("/upload", files=[("files", ("policy.txt", b"Version one."))], headers=auth_headers)
+    job_url = f"/upload/jobs/{response.json()['job_id']}"
+    # Indexed before it's replaced, so the replacement doesn't race the first version
+    for _ in range(200):
+        if (await client.get(job_url, headers=auth_headers)).json()["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    document_id = (await client.get("/documents", headers=auth_headers)).json()["documents"][0]["id"]
+
+    wrong = await client.put(
+        f"/documents/{document_id}", files=[("file", ("policy.pdf", b"%PDF-1.7"))], headers=auth_headers
+    )
+    right = await client.put(
+        f"/documents/{document_id}", files=[("file", ("policy.txt", b"Version two."))], headers=auth_headers
+    )
+
+    assert wrong.status_code == 415
+    assert right.status_code == 202
+    assert right.json()["files_queued"] == ["policy.txt"]
+
+
+async def test_failed_registration_removes_every_staged_file(
+        client: httpx.AsyncClient, tmp_path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmp_path))
+    body = multipart_body([("a.txt", b"first"), ("b.txt", b"second"), ("c.txt", b"third")])
+    staged = await stage_multipart(CONTENT_TYPE, stream(body, 100, []), "files", str(tmp_path), 10_000, 512)
+    claims = iter([(10_001, True), RuntimeError("database went away")])
+
+    async def claim_document(filename: str, content_hash: str):
+        claim = next(claims)
+        if isinstance(claim, Exception):
+            raise claim
+        return claim
+
+    service = DocumentService.__new__(DocumentService)
+    service.owner = "someone"
+    service.ingestion_engine = get_ingestion_engine()  # numbers each registered version
+    monkeypatch.setattr(service, "_claim_document", claim_document)
+    with pytest.raises(RuntimeError):
+        await service._save_staged(staged)
+
+    assert os.listdir(tmp_path) == []